@@ -0,0 +1,691 @@
+"""
+Cache Benchmark Suite: reproducible comparison of cache_v1, cache_v2 and cache_v3.
+
+Runs cache_v1.LRUCache, cache_v2.LRUCache and cache_v3.PersistentLRUTTLCache
+(default OrderedDict storage as "v3", compact storage as "v3c") under
+identical, seeded workloads and emits one JSON record per case.
+
+Workloads:
+- uniform: keys drawn uniformly from the key space
+- zipf: keys drawn from a Zipfian distribution (skewed, realistic)
+- scan: Zipfian traffic polluted by periodic one-off sequential scans
+- ttl: uniform traffic where every write carries a short TTL
+- flush_load: fill to N entries, time one flush() and one cold load
+- memory: fill to N entries (each with a TTL) and report traced bytes per
+  entry, excluding the pre-built keys and the shared value
+
+Access workloads are read-through: get(), and set() on a miss.
+
+Design Decisions:
+- Adapters: each version is wrapped so all share get/set/flush/load
+- Determinism: op sequences are generated up front from a seeded Random,
+  outside the timed region
+- Latency: every op is timed with perf_counter_ns for exact p50/p99
+- Isolation: each case runs in a fresh spawned process by default, so
+  peak RSS (ru_maxrss) belongs to that case alone
+- Output: JSON Lines (one record per case) for diffing and regression checks
+
+Usage:
+    python cache_bench.py --impls v2 v3 --workloads zipf scan --output now.jsonl
+    python cache_bench.py --baseline before.jsonl --tolerance 0.10
+    python cache_bench.py --test
+
+License: MIT
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Callable, Iterable
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - non-Unix platforms
+    resource = None  # type: ignore[assignment]
+
+import cache_v1
+import cache_v2
+import cache_v3
+
+
+ACCESS_WORKLOADS = ("uniform", "zipf", "scan", "ttl")
+SIZED_WORKLOADS = ("flush_load", "memory")
+ALL_WORKLOADS = ACCESS_WORKLOADS + SIZED_WORKLOADS
+IMPLEMENTATIONS = ("v1", "v2", "v3", "v3c")
+DEFAULT_SIZES = (10_000, 1_000_000, 10_000_000)
+VALUE = "x" * 64
+
+
+# =============================================================================
+# ADAPTERS
+# =============================================================================
+
+class CacheAdapter:
+    """
+    Uniform facade over the three cache versions.
+
+    Subclasses bind the version-specific constructor and method names.
+    """
+
+    name = ""
+
+    def __init__(self, capacity: int, path: str) -> None:
+        self.capacity = capacity
+        self.path = path
+        self.cache = self._create()
+
+    def _create(self) -> Any:
+        raise NotImplementedError
+
+    def get(self, key: str) -> Any:
+        return self.cache.get(key)
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def load(self) -> None:
+        """Replace the cache with a fresh instance loaded from ``path``."""
+        self.cache = self._create()
+
+
+class V1Adapter(CacheAdapter):
+    name = "v1"
+
+    def _create(self) -> Any:
+        return cache_v1.LRUCache(max_size=self.capacity, persistence_path=self.path)
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self.cache.set(key, value, ttl=ttl)
+
+    def flush(self) -> None:
+        self.cache.save()
+
+
+class V2Adapter(CacheAdapter):
+    name = "v2"
+
+    def _create(self) -> Any:
+        return cache_v2.LRUCache(max_size=self.capacity, persistence_path=self.path)
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self.cache.set(key, value, ttl_seconds=ttl)
+
+    def flush(self) -> None:
+        self.cache.flush()
+
+
+class V3Adapter(CacheAdapter):
+    name = "v3"
+
+    def _create(self) -> Any:
+        return cache_v3.PersistentLRUTTLCache(
+            max_size=self.capacity, persist_path=self.path
+        )
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self.cache.set(key, value, ttl_seconds=ttl)
+
+    def flush(self) -> None:
+        self.cache.flush()
+
+
+class V3CompactAdapter(V3Adapter):
+    name = "v3c"
+
+    def _create(self) -> Any:
+        return cache_v3.PersistentLRUTTLCache(
+            max_size=self.capacity, persist_path=self.path, storage="compact"
+        )
+
+
+ADAPTERS: dict[str, type[CacheAdapter]] = {
+    "v1": V1Adapter,
+    "v2": V2Adapter,
+    "v3": V3Adapter,
+    "v3c": V3CompactAdapter,
+}
+
+
+# =============================================================================
+# WORKLOAD GENERATION
+# =============================================================================
+
+def zipf_sampler(n: int, s: float, rng: random.Random) -> Callable[[], int]:
+    """
+    Build a sampler returning ranks in [0, n) with P(i) proportional to 1/(i+1)^s.
+
+    Uses a precomputed cumulative table and binary search (O(log n) per draw).
+    """
+    cdf = list(itertools.accumulate(1.0 / (i + 1) ** s for i in range(n)))
+    total = cdf[-1]
+    rand = rng.random
+    return lambda: bisect.bisect_left(cdf, rand() * total)
+
+
+def generate_ops(
+    workload: str,
+    n_ops: int,
+    key_space: int,
+    seed: int,
+    *,
+    zipf_s: float = 0.99,
+    scan_every: int = 10_000,
+    scan_length: int = 2_000
+) -> array:
+    """
+    Generate a deterministic key-index sequence for an access workload.
+
+    Indices >= key_space denote one-off scan keys (never repeated).
+
+    Args:
+        workload: One of ACCESS_WORKLOADS
+        n_ops: Number of operations
+        key_space: Number of distinct regular keys
+        seed: Random seed
+        zipf_s: Zipf exponent for 'zipf' and 'scan'
+        scan_every: Ops between scans for 'scan'
+        scan_length: Keys per scan for 'scan'
+
+    Returns:
+        array('q') of key indices
+
+    Raises:
+        ValueError: If workload is unknown
+    """
+    rng = random.Random(seed)
+    ops = array('q')
+
+    if workload in ("uniform", "ttl"):
+        randrange = rng.randrange
+        ops.extend(randrange(key_space) for _ in range(n_ops))
+    elif workload == "zipf":
+        draw = zipf_sampler(key_space, zipf_s, rng)
+        ops.extend(draw() for _ in range(n_ops))
+    elif workload == "scan":
+        draw = zipf_sampler(key_space, zipf_s, rng)
+        next_scan_key = key_space
+        while len(ops) < n_ops:
+            ops.extend(draw() for _ in range(min(scan_every, n_ops - len(ops))))
+            length = min(scan_length, n_ops - len(ops))
+            ops.extend(range(next_scan_key, next_scan_key + length))
+            next_scan_key += length
+    else:
+        raise ValueError(f"unknown access workload: {workload!r}")
+
+    return ops
+
+
+# =============================================================================
+# MEASUREMENT
+# =============================================================================
+
+def peak_rss_kib() -> int | None:
+    """Peak resident set size of this process in KiB (None if unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentile(sorted_values: array | list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence."""
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return float(sorted_values[idx])
+
+
+def run_access_case(
+    impl: str,
+    workload: str,
+    *,
+    capacity: int,
+    key_space: int,
+    n_ops: int,
+    seed: int,
+    ttl_range: tuple[float, float] = (0.001, 0.05)
+) -> dict:
+    """
+    Run one read-through access workload against one implementation.
+
+    Returns:
+        Result record (see module docstring)
+    """
+    ops = generate_ops(workload, n_ops, key_space, seed)
+    max_index = max(ops) if ops else 0
+    keys = [f"k{i}" for i in range(max_index + 1)]
+    ttl_rng = random.Random(seed + 1)
+    lo, hi = ttl_range
+    ttls = (
+        [ttl_rng.uniform(lo, hi) for _ in range(n_ops)]
+        if workload == "ttl" else None
+    )
+    latencies = array('q', bytes(8 * n_ops))
+    hits = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ADAPTERS[impl](capacity, os.path.join(tmp, "bench.json"))
+        get = cache.get
+        put = cache.set
+        clock = time.perf_counter_ns
+
+        start = clock()
+        for i, idx in enumerate(ops):
+            key = keys[idx]
+            t0 = clock()
+            if get(key) is None:
+                put(key, VALUE, ttls[i] if ttls is not None else None)
+            else:
+                hits += 1
+            latencies[i] = clock() - t0
+        elapsed = (clock() - start) / 1e9
+
+    ordered = sorted(latencies)
+    return {
+        "impl": impl,
+        "workload": workload,
+        "capacity": capacity,
+        "key_space": key_space,
+        "ops": n_ops,
+        "seed": seed,
+        "elapsed_s": elapsed,
+        "ops_per_sec": n_ops / elapsed if elapsed else 0.0,
+        "hit_ratio": hits / n_ops if n_ops else 0.0,
+        "p50_us": percentile(ordered, 0.50) / 1000,
+        "p99_us": percentile(ordered, 0.99) / 1000,
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def run_flush_load_case(impl: str, *, entries: int, seed: int) -> dict:
+    """
+    Fill a cache with ``entries`` items, then time one flush() and one load.
+
+    ops_per_sec is the slower of flush and load throughput in entries/s;
+    p99_us is the slower of the two single operations.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.json")
+        cache = ADAPTERS[impl](entries, path)
+        for i in range(entries):
+            cache.set(f"k{i}", VALUE)
+
+        t0 = time.perf_counter()
+        cache.flush()
+        flush_s = time.perf_counter() - t0
+        file_bytes = os.path.getsize(path)
+
+        t0 = time.perf_counter()
+        cache.load()
+        load_s = time.perf_counter() - t0
+
+    slowest = max(flush_s, load_s)
+    return {
+        "impl": impl,
+        "workload": "flush_load",
+        "capacity": entries,
+        "entries": entries,
+        "seed": seed,
+        "flush_s": flush_s,
+        "load_s": load_s,
+        "file_bytes": file_bytes,
+        "ops_per_sec": entries / slowest if slowest else 0.0,
+        "p99_us": slowest * 1e6,
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def run_memory_case(
+    impl: str,
+    *,
+    entries: int,
+    seed: int,
+    ttl: float = 3600.0
+) -> dict:
+    """
+    Measure steady-state memory per entry with tracemalloc.
+
+    Keys are built before tracing starts and every entry shares one value
+    object, so the result is the cache's own per-entry overhead.
+    """
+    keys = [f"k{i}" for i in range(entries)]
+    with tempfile.TemporaryDirectory() as tmp:
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            cache = ADAPTERS[impl](entries, os.path.join(tmp, "bench.json"))
+            for key in keys:
+                cache.set(key, VALUE, ttl)
+            traced = tracemalloc.get_traced_memory()[0] - baseline
+        finally:
+            tracemalloc.stop()
+        del cache
+
+    return {
+        "impl": impl,
+        "workload": "memory",
+        "capacity": entries,
+        "entries": entries,
+        "seed": seed,
+        "traced_bytes": traced,
+        "bytes_per_entry": traced / entries if entries else 0.0,
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def run_case(case: dict) -> dict:
+    """Dispatch one case description (picklable, for worker processes)."""
+    case = dict(case)
+    workload = case.pop("workload")
+    impl = case.pop("impl")
+    if workload == "flush_load":
+        return run_flush_load_case(impl, **case)
+    if workload == "memory":
+        return run_memory_case(impl, **case)
+    return run_access_case(impl, workload, **case)
+
+
+def build_cases(
+    impls: Iterable[str],
+    workloads: Iterable[str],
+    *,
+    capacity: int,
+    key_space: int,
+    n_ops: int,
+    sizes: Iterable[int],
+    seed: int
+) -> list[dict]:
+    """Expand the impl x workload (x size) matrix into case descriptions."""
+    cases = []
+    for workload in workloads:
+        for impl in impls:
+            if workload in SIZED_WORKLOADS:
+                for size in sizes:
+                    cases.append({
+                        "impl": impl, "workload": workload,
+                        "entries": size, "seed": seed,
+                    })
+            else:
+                cases.append({
+                    "impl": impl, "workload": workload, "capacity": capacity,
+                    "key_space": key_space, "n_ops": n_ops, "seed": seed,
+                })
+    return cases
+
+
+def run_suite(cases: list[dict], *, isolate: bool = True) -> list[dict]:
+    """
+    Run cases sequentially.
+
+    Args:
+        cases: Case descriptions from build_cases()
+        isolate: Run each case in a fresh spawned process so peak RSS and
+            allocator state are not shared between cases
+
+    Returns:
+        Result records in case order
+    """
+    if not isolate:
+        return [run_case(case) for case in cases]
+
+    results = []
+    ctx = get_context("spawn")
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            results.append(pool.submit(run_case, case).result())
+    return results
+
+
+def environment_info() -> dict:
+    """Metadata record describing the machine and interpreter."""
+    return {
+        "record": "environment",
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.time(),
+    }
+
+
+def _case_id(record: dict) -> tuple:
+    return (
+        record.get("impl"), record.get("workload"),
+        record.get("capacity"), record.get("entries"),
+    )
+
+
+def compare_results(
+    baseline: list[dict],
+    current: list[dict],
+    tolerance: float = 0.10
+) -> list[dict]:
+    """
+    Find cases whose throughput dropped, or whose bytes per entry grew,
+    by more than ``tolerance``.
+
+    Args:
+        baseline: Records from a previous run
+        current: Records from this run
+        tolerance: Allowed fractional ops/s drop (0.10 = 10%)
+
+    Returns:
+        One dict per regressed case with the metric, both values and change
+    """
+    previous = {_case_id(r): r for r in baseline if "impl" in r}
+    regressions = []
+    for record in current:
+        before = previous.get(_case_id(record))
+        if before is None:
+            continue
+        # (metric, sign): sign -1 means lower is worse, +1 higher is worse
+        for metric, sign in (("ops_per_sec", -1), ("bytes_per_entry", 1)):
+            if not before.get(metric) or metric not in record:
+                continue
+            change = record[metric] / before[metric] - 1.0
+            if change * sign > tolerance:
+                regressions.append({
+                    "impl": record["impl"],
+                    "workload": record["workload"],
+                    "capacity": record.get("capacity"),
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "current": record[metric],
+                    "change": change,
+                })
+    return regressions
+
+
+def read_jsonl(path: str) -> list[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--impls", nargs="+", choices=IMPLEMENTATIONS,
+                        default=list(IMPLEMENTATIONS))
+    parser.add_argument("--workloads", nargs="+", choices=ALL_WORKLOADS,
+                        default=list(ALL_WORKLOADS))
+    parser.add_argument("--capacity", type=int, default=10_000)
+    parser.add_argument("--key-space", type=int, default=100_000)
+    parser.add_argument("--ops", type=int, default=200_000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="entry counts for the flush_load and memory workloads")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="run all cases in this process (peak RSS is shared)")
+    parser.add_argument("--output", help="write JSON Lines here instead of stdout")
+    parser.add_argument("--baseline", help="JSON Lines from a previous run to compare")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--test", action="store_true", help="run the self-tests")
+    args = parser.parse_args(argv)
+
+    if args.test:
+        return 0 if run_tests() else 1
+
+    cases = build_cases(
+        args.impls, args.workloads, capacity=args.capacity,
+        key_space=args.key_space, n_ops=args.ops, sizes=args.sizes,
+        seed=args.seed,
+    )
+    results = run_suite(cases, isolate=not args.no_isolate)
+    records = [environment_info()] + results
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for record in records:
+            out.write(json.dumps(record) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.baseline:
+        regressions = compare_results(read_jsonl(args.baseline), results, args.tolerance)
+        for reg in regressions:
+            print(
+                f"REGRESSION {reg['impl']}/{reg['workload']} {reg['metric']}: "
+                f"{reg['baseline']:.0f} -> {reg['current']:.0f} "
+                f"({reg['change']:+.1%})",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+# =============================================================================
+# TEST SUITE
+# =============================================================================
+
+import unittest
+from unittest import TestCase
+
+
+class TestWorkloads(TestCase):
+    """Workload generation is deterministic and shaped as described."""
+
+    def test_same_seed_same_sequence(self):
+        """Same seed should reproduce the same op sequence."""
+        for workload in ACCESS_WORKLOADS:
+            a = generate_ops(workload, 500, 100, seed=7)
+            b = generate_ops(workload, 500, 100, seed=7)
+            self.assertEqual(a, b, workload)
+            self.assertEqual(len(a), 500)
+
+    def test_zipf_is_skewed(self):
+        """Rank 0 should be drawn far more often than under uniform."""
+        ops = generate_ops("zipf", 10_000, 1_000, seed=1)
+        self.assertGreater(ops.count(0), 10_000 / 1_000 * 20)
+        self.assertTrue(all(0 <= i < 1_000 for i in ops))
+
+    def test_scan_inserts_one_off_keys(self):
+        """Scan keys should lie outside the key space and never repeat."""
+        ops = generate_ops("scan", 1_000, 50, seed=1, scan_every=100, scan_length=20)
+        scan_keys = [i for i in ops if i >= 50]
+        self.assertEqual(len(scan_keys), len(set(scan_keys)))
+        self.assertGreater(len(scan_keys), 0)
+
+    def test_unknown_workload_raises(self):
+        with self.assertRaises(ValueError):
+            generate_ops("bogus", 10, 10, seed=1)
+
+
+class TestRunner(TestCase):
+    """Cases run against every implementation and emit complete records."""
+
+    def test_access_case_all_impls(self):
+        """Each implementation should complete an access workload."""
+        for impl in IMPLEMENTATIONS:
+            record = run_access_case(
+                impl, "zipf", capacity=50, key_space=200, n_ops=2_000, seed=3
+            )
+            self.assertEqual(record["ops"], 2_000)
+            self.assertGreater(record["ops_per_sec"], 0)
+            self.assertGreater(record["hit_ratio"], 0)
+            self.assertGreaterEqual(record["p99_us"], record["p50_us"])
+
+    def test_same_hit_ratio_across_impls(self):
+        """Without TTLs all three are plain LRU, so hit ratios must match."""
+        ratios = {
+            run_access_case(
+                impl, "scan", capacity=30, key_space=100, n_ops=3_000, seed=5
+            )["hit_ratio"]
+            for impl in IMPLEMENTATIONS
+        }
+        self.assertEqual(len(ratios), 1)
+
+    def test_flush_load_case(self):
+        """flush_load should report both timings and the file size."""
+        for impl in IMPLEMENTATIONS:
+            record = run_flush_load_case(impl, entries=500, seed=1)
+            self.assertGreater(record["file_bytes"], 0)
+            self.assertGreaterEqual(record["flush_s"], 0)
+            self.assertGreaterEqual(record["load_s"], 0)
+
+    def test_memory_case(self):
+        """Compact storage should report fewer bytes per entry."""
+        ordered = run_memory_case("v3", entries=5_000, seed=1)
+        compact = run_memory_case("v3c", entries=5_000, seed=1)
+        self.assertGreater(ordered["bytes_per_entry"], 0)
+        self.assertLess(compact["bytes_per_entry"], ordered["bytes_per_entry"])
+
+    def test_isolated_suite(self):
+        """Spawned-process execution should return records in case order."""
+        cases = build_cases(
+            ["v3"], ["uniform", "flush_load"], capacity=10, key_space=20,
+            n_ops=100, sizes=[10], seed=1,
+        )
+        results = run_suite(cases, isolate=True)
+        self.assertEqual([r["workload"] for r in results], ["uniform", "flush_load"])
+        json.dumps(results)  # Machine-readable
+
+    def test_compare_flags_regressions(self):
+        """Throughput drops beyond tolerance should be reported."""
+        base = [{"impl": "v3", "workload": "zipf", "capacity": 10, "ops_per_sec": 100.0}]
+        ok = [{"impl": "v3", "workload": "zipf", "capacity": 10, "ops_per_sec": 95.0}]
+        bad = [{"impl": "v3", "workload": "zipf", "capacity": 10, "ops_per_sec": 80.0}]
+        self.assertEqual(compare_results(base, ok, tolerance=0.10), [])
+        regressions = compare_results(base, bad, tolerance=0.10)
+        self.assertEqual(len(regressions), 1)
+        self.assertAlmostEqual(regressions[0]["change"], -0.2)
+
+        mem_base = [{"impl": "v3", "workload": "memory", "capacity": 10,
+                     "entries": 10, "bytes_per_entry": 100.0}]
+        mem_now = [dict(mem_base[0], bytes_per_entry=130.0)]
+        regressions = compare_results(mem_base, mem_now, tolerance=0.10)
+        self.assertEqual(regressions[0]["metric"], "bytes_per_entry")
+
+
+def run_tests():
+    """Run all tests."""
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(loader.loadTestsFromTestCase(TestWorkloads))
+    suite.addTests(loader.loadTestsFromTestCase(TestRunner))
+
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+
+    return result.wasSuccessful()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
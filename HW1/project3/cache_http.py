@@ -0,0 +1,926 @@
+"""
+Cache HTTP: response-caching middleware for WSGI and ASGI apps.
+
+Wraps an app so that cacheable GET/HEAD responses are kept in a
+PersistentLRUTTLCache and replayed without calling the app again.
+
+    app = WSGICacheMiddleware(app, cache, vary=("accept-encoding",))
+    app = ASGICacheMiddleware(app, cache, vary=("accept-encoding",))
+
+What is cached:
+    Key:     scheme, host, mount prefix (SCRIPT_NAME / root_path), path,
+             query string and the request's values of the configured vary
+             headers; the method is not part of it, as a HEAD is answered
+             from the GET entry
+    Stored:  status 200 responses whose Cache-Control allows shared caching,
+             up to max_body_bytes; TTL = s-maxage, else max-age, else
+             default_ttl (None: responses without max-age are not cached)
+    Skipped: no-store, private, no-cache, Set-Cookie, Vary: * or a Vary
+             header outside the configured set; requests with
+             Authorization or Cache-Control: no-store bypass the cache,
+             Cache-Control: no-cache skips the lookup but refreshes the entry
+
+Hits carry Age and X-Cache: HIT; every stored response has an ETag (the
+app's own, or a hash of the body), and a request whose If-None-Match
+matches it gets 304 Not Modified without a body.
+
+Design Decisions:
+- Storage: one bytes value per response, a length-prefixed pickle of
+  (status, headers, etag, stored_at) followed by the body; headers are
+  kept already encoded for the protocol (str for WSGI, bytes for ASGI)
+- Zero-copy: the cache needs a PickleCodec, which keeps large bytes values
+  out-of-band and returns them as a memoryview of the cached buffer; the
+  body is sliced from that view, never joined or re-encoded. ASGI sends
+  the slices; WSGI (PEP 3333 requires bytes) copies one chunk at a time
+- Buffering: a cacheable miss is buffered (up to max_body_bytes) so its
+  ETag can be sent with it; anything else streams straight through, and a
+  body that outgrows the limit is flushed and streamed uncached
+- Concurrency: the cache is not thread-safe, so the WSGI middleware takes
+  a lock around cache calls only (never around the app); the ASGI one
+  runs on one event loop and needs none
+
+Usage:
+    python cache_http.py --bench --requests 5000 --concurrency 16
+    python cache_http.py --test
+
+License: MIT
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import pickle
+import random
+import struct
+import sys
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+from cache_v3 import PersistentLRUTTLCache, PickleCodec
+
+
+# Response headers a 304 repeats (RFC 9110 15.4.5); the rest are dropped
+NOT_MODIFIED_HEADERS = frozenset((
+    "cache-control", "content-location", "date", "etag", "expires",
+    "last-modified", "vary",
+))
+CHUNK_BYTES = 1 << 16
+_LENGTH = struct.Struct(">I")
+
+
+def parse_cache_control(value: str | None) -> dict[str, str | None]:
+    """Directives of a Cache-Control header, names lower-cased."""
+    directives: dict[str, str | None] = {}
+    for part in (value or "").split(","):
+        name, sep, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip().strip('"') if sep else None
+    return directives
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match against an ETag, with weak comparison as RFC 9110 requires."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == bare for tag in if_none_match.split(",")
+    )
+
+
+class CachedResponse:
+    """A stored response: body is a memoryview slice of the cached value."""
+
+    __slots__ = ('status', 'headers', 'etag', 'stored_at', 'body')
+
+    def __init__(self, status: Any, headers: list, etag: str, stored_at: float, body: Any) -> None:
+        self.status = status
+        self.headers = headers
+        self.etag = etag
+        self.stored_at = stored_at
+        self.body = body
+
+    def pack(self) -> bytes:
+        meta = pickle.dumps(
+            (self.status, self.headers, self.etag, self.stored_at), protocol=5
+        )
+        return b"".join((_LENGTH.pack(len(meta)), meta, self.body))
+
+    @classmethod
+    def unpack(cls, value: bytes | memoryview) -> CachedResponse:
+        view = memoryview(value)
+        size = _LENGTH.unpack_from(view)[0]
+        end = _LENGTH.size + size
+        status, headers, etag, stored_at = pickle.loads(view[_LENGTH.size:end])
+        return cls(status, headers, etag, stored_at, view[end:])
+
+
+class _ResponseCache:
+    """Policy, keys and storage shared by the WSGI and ASGI middleware."""
+
+    def __init__(
+        self,
+        cache: PersistentLRUTTLCache,
+        *,
+        vary: Iterable[str] = (),
+        default_ttl: float | None = None,
+        max_body_bytes: int = 1 << 20,
+        now_fn: Callable[[], float] | None = None
+    ) -> None:
+        """
+        Args:
+            cache: Where responses are kept; its codec must be a PickleCodec
+            vary: Request headers that select between variants of a URL
+            default_ttl: TTL for cacheable responses without max-age (None:
+                do not cache them)
+            max_body_bytes: Larger responses are not cached
+            now_fn: Clock for the Age header (default: time.time)
+
+        Raises:
+            ValueError: If the cache cannot store bytes values, or
+                max_body_bytes < 0
+        """
+        if not isinstance(cache.codec, PickleCodec):
+            raise ValueError("response caching needs a cache created with codec=PickleCodec()")
+        if max_body_bytes < 0:
+            raise ValueError(f"max_body_bytes must be >= 0, got {max_body_bytes}")
+        self.cache = cache
+        self.vary = tuple(sorted({name.lower() for name in vary}))
+        self.default_ttl = default_ttl
+        self.max_body_bytes = max_body_bytes
+        self._now_fn = now_fn if now_fn is not None else time.time
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.not_modified = 0
+        self.bypassed = 0
+
+    def key(
+        self,
+        scheme: str,
+        host: str,
+        prefix: str,
+        path: str,
+        query: str,
+        header: Callable[[str], str | None]
+    ) -> str:
+        """
+        Cache key for a request; header(name) reads a request header.
+        
+        Host and mount prefix keep virtual hosts and apps mounted at
+        different prefixes from sharing entries.
+        """
+        parts = [scheme, host.lower(), prefix, path, query]
+        parts.extend(f"{name}:{header(name) or ''}" for name in self.vary)
+        digest = hashlib.blake2b("\n".join(parts).encode('utf-8'), digest_size=16)
+        return "http:" + digest.hexdigest()
+
+    @staticmethod
+    def bypass(header: Callable[[str], str | None]) -> tuple[bool, bool]:
+        """(skip lookup, skip store) for a GET/HEAD request."""
+        if header("authorization"):
+            return True, True
+        directives = parse_cache_control(header("cache-control"))
+        no_store = "no-store" in directives
+        return no_store or "no-cache" in directives, no_store
+
+    def ttl(self, status: int, headers: list[tuple[str, str]]) -> float | None:
+        """TTL a response may be cached for, or None if it must not be."""
+        if status != 200:
+            return None
+        cache_control = vary = None
+        for name, value in headers:
+            name = name.lower()
+            if name == "set-cookie":
+                return None
+            if name == "cache-control":
+                cache_control = value
+            elif name == "vary":
+                vary = value
+        if vary is not None:
+            names = {v.strip().lower() for v in vary.split(",") if v.strip()}
+            if "*" in names or not names <= set(self.vary):
+                return None
+        directives = parse_cache_control(cache_control)
+        if directives.keys() & {"no-store", "private", "no-cache"}:
+            return None
+        for name in ("s-maxage", "max-age"):
+            if name in directives:
+                try:
+                    seconds = int(directives[name] or "")
+                except ValueError:
+                    return None
+                return seconds if seconds > 0 else None
+        return self.default_ttl
+
+    def lookup(self, key: str) -> CachedResponse | None:
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedResponse.unpack(value)
+
+    def store(
+        self,
+        key: str,
+        status: Any,
+        headers: list,
+        body: bytes,
+        ttl: float,
+        *,
+        encode: Callable[[str], Any] = str
+    ) -> CachedResponse:
+        """
+        Store a complete response, adding ETag and Content-Length.
+
+        Args:
+            encode: Converts header names/values to the protocol's form
+        """
+        etag = None
+        kept = []
+        for name, value in headers:
+            lower = _text(name).lower()
+            if lower == "etag":
+                etag = _text(value)
+            elif lower != "content-length":
+                kept.append((name, value))
+        if etag is None:
+            etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        kept.append((encode("ETag"), encode(etag)))
+        kept.append((encode("Content-Length"), encode(str(len(body)))))
+        response = CachedResponse(status, kept, etag, self._now_fn(), memoryview(body))
+        self.cache.set(key, response.pack(), ttl)
+        self.stores += 1
+        return response
+
+    def reply_headers(
+        self,
+        response: CachedResponse,
+        not_modified: bool,
+        *,
+        cached: bool,
+        encode: Callable[[str], Any] = str
+    ) -> list:
+        """Headers to send for a stored response (filtered for a 304)."""
+        headers = response.headers
+        if not_modified:
+            headers = [h for h in headers if _text(h[0]).lower() in NOT_MODIFIED_HEADERS]
+        else:
+            headers = list(headers)
+        if cached:
+            age = max(0, int(self._now_fn() - response.stored_at))
+            headers.append((encode("Age"), encode(str(age))))
+        headers.append((encode("X-Cache"), encode("HIT" if cached else "MISS")))
+        return headers
+
+
+def _text(value: str | bytes) -> str:
+    return value.decode('latin-1') if isinstance(value, bytes) else value
+
+
+def _latin1(value: str) -> bytes:
+    return value.encode('latin-1')
+
+
+class WSGICacheMiddleware(_ResponseCache):
+    """
+    WSGI middleware answering repeated GET/HEAD requests from the cache.
+
+    See _ResponseCache for the arguments. The app runs outside the lock, so
+    concurrent misses for one URL may each call it; the last store wins.
+    """
+
+    def __init__(self, app: Callable, cache: PersistentLRUTTLCache, **kwargs: Any) -> None:
+        super().__init__(cache, **kwargs)
+        self.app = app
+        self._lock = threading.Lock()
+
+    def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        method = environ.get("REQUEST_METHOD", "GET")
+        header = lambda name: environ.get("HTTP_" + name.upper().replace("-", "_"))
+        skip_lookup, skip_store = self.bypass(header) if method in ("GET", "HEAD") else (True, True)
+        if skip_store and skip_lookup:
+            self.bypassed += 1
+            return self.app(environ, start_response)
+
+        host = environ.get("HTTP_HOST") or "%s:%s" % (
+            environ.get("SERVER_NAME", ""), environ.get("SERVER_PORT", "")
+        )
+        key = self.key(
+            environ.get("wsgi.url_scheme", "http"), host, environ.get("SCRIPT_NAME", ""),
+            environ.get("PATH_INFO", ""), environ.get("QUERY_STRING", ""), header
+        )
+        if not skip_lookup:
+            with self._lock:
+                response = self.lookup(key)
+            if response is not None:
+                return self._reply(response, environ, start_response, cached=True)
+        if method == "HEAD" or skip_store:
+            return self.app(environ, start_response)
+        return self._fill(key, environ, start_response)
+
+    def _reply(
+        self,
+        response: CachedResponse,
+        environ: dict,
+        start_response: Callable,
+        *,
+        cached: bool
+    ) -> Iterable[bytes]:
+        not_modified = etag_matches(environ.get("HTTP_IF_NONE_MATCH"), response.etag)
+        if not_modified:
+            self.not_modified += 1
+            start_response("304 Not Modified", self.reply_headers(response, True, cached=cached))
+            return []
+        start_response(response.status, self.reply_headers(response, False, cached=cached))
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return []
+        return _chunks(response.body)
+
+    def _fill(self, key: str, environ: dict, start_response: Callable) -> Iterator[bytes]:
+        """Run the app; buffer and store the response if it is cacheable."""
+        state: dict[str, Any] = {}
+
+        def capture(status: str, headers: list, exc_info: Any = None) -> Callable:
+            # An error restart (exc_info) is never cached
+            ttl = None if exc_info is not None else self.ttl(int(status.split(" ", 1)[0]), headers)
+            if ttl is None:
+                # A later call replaces the response: drop anything buffered
+                state.clear()
+                return start_response(status, headers, exc_info)
+            state.update(status=status, headers=headers, ttl=ttl, buffer=[], size=0)
+
+            def write(data: bytes) -> None:
+                # Legacy write(): buffered like the returned iterable
+                for out in self._buffer(state, data, start_response):
+                    state["write"](out)
+            return write
+
+        result = self.app(environ, capture)
+        try:
+            for data in result:
+                if "buffer" not in state:
+                    yield data
+                    continue
+                for out in self._buffer(state, data, start_response):
+                    yield out
+            if state.get("buffer") is not None:
+                body = b"".join(state["buffer"])
+                with self._lock:
+                    response = self.store(key, state["status"], state["headers"], body, state["ttl"])
+                yield from self._reply(response, environ, start_response, cached=False)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    def _buffer(self, state: dict, data: bytes, start_response: Callable) -> list[bytes]:
+        """Add a body chunk; once over max_body_bytes, send all uncached."""
+        buffer = state["buffer"]
+        if buffer is None:
+            return [data]
+        buffer.append(data)
+        state["size"] += len(data)
+        if state["size"] <= self.max_body_bytes:
+            return []
+        state["buffer"] = None
+        state["write"] = start_response(state["status"], state["headers"])
+        return buffer
+
+
+def _chunks(body: memoryview) -> Iterator[bytes]:
+    """A body as bytes chunks (WSGI servers only accept bytes)."""
+    for start in range(0, len(body), CHUNK_BYTES):
+        yield body[start:start + CHUNK_BYTES].tobytes()
+
+
+class ASGICacheMiddleware(_ResponseCache):
+    """
+    ASGI middleware answering repeated GET/HEAD requests from the cache.
+
+    See _ResponseCache for the arguments. Cached bodies are sent as
+    memoryview slices of the cached buffer, CHUNK_BYTES at a time.
+    """
+
+    def __init__(self, app: Callable, cache: PersistentLRUTTLCache, **kwargs: Any) -> None:
+        super().__init__(cache, **kwargs)
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        method = scope.get("method", "")
+        if scope.get("type") != "http" or method not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+        request_headers: dict[str, str] = {}
+        for name, value in scope.get("headers", ()):
+            request_headers[name.decode('latin-1').lower()] = value.decode('latin-1')
+        header = request_headers.get
+        skip_lookup, skip_store = self.bypass(header)
+        if skip_lookup and skip_store:
+            self.bypassed += 1
+            await self.app(scope, receive, send)
+            return
+
+        host = header("host")
+        if host is None:
+            server = scope.get("server") or ("", None)
+            host = "%s:%s" % (server[0], server[1])
+        key = self.key(
+            scope.get("scheme", "http"), host, scope.get("root_path", ""), scope.get("path", ""),
+            scope.get("query_string", b"").decode('latin-1'), header
+        )
+        head = method == "HEAD"
+        if not skip_lookup:
+            response = self.lookup(key)
+            if response is not None:
+                await self._reply(response, header, send, head=head, cached=True)
+                return
+        if head or skip_store:
+            await self.app(scope, receive, send)
+            return
+        await self._fill(key, scope, receive, send, header)
+
+    async def _reply(
+        self,
+        response: CachedResponse,
+        header: Callable[[str], str | None],
+        send: Callable,
+        *,
+        head: bool,
+        cached: bool
+    ) -> None:
+        not_modified = etag_matches(header("if-none-match"), response.etag)
+        if not_modified:
+            self.not_modified += 1
+        await send({
+            "type": "http.response.start",
+            "status": 304 if not_modified else response.status,
+            "headers": self.reply_headers(response, not_modified, cached=cached, encode=_latin1),
+        })
+        body = b"" if not_modified or head else response.body
+        for start in range(0, max(len(body), 1), CHUNK_BYTES):
+            await send({
+                "type": "http.response.body",
+                "body": body[start:start + CHUNK_BYTES],
+                "more_body": start + CHUNK_BYTES < len(body),
+            })
+
+    async def _fill(
+        self,
+        key: str,
+        scope: dict,
+        receive: Callable,
+        send: Callable,
+        header: Callable[[str], str | None]
+    ) -> None:
+        """Run the app; buffer and store the response if it is cacheable."""
+        start: dict | None = None
+        buffer: list[bytes] | None = None
+        size = 0
+        ttl = None
+
+        async def capture(message: dict) -> None:
+            nonlocal start, buffer, size, ttl
+            kind = message["type"]
+            if kind == "http.response.start":
+                headers = [(_text(n), _text(v)) for n, v in message.get("headers", ())]
+                ttl = self.ttl(message["status"], headers)
+                if ttl is None:
+                    await send(message)
+                else:
+                    start, buffer = message, []
+                return
+            if kind != "http.response.body" or buffer is None:
+                await send(message)
+                return
+            body = message.get("body", b"")
+            buffer.append(body)
+            size += len(body)
+            if size > self.max_body_bytes:
+                await send(start)
+                await send({
+                    "type": "http.response.body",
+                    "body": b"".join(buffer),
+                    "more_body": message.get("more_body", False),
+                })
+                buffer = None
+            elif not message.get("more_body", False):
+                response = self.store(
+                    key, start["status"], list(start.get("headers", ())),
+                    b"".join(buffer), ttl, encode=_latin1
+                )
+                buffer = None
+                await self._reply(response, header, send, head=False, cached=False)
+
+        await self.app(scope, receive, capture)
+
+
+# =============================================================================
+# BENCHMARK
+# =============================================================================
+
+def demo_app(work_seconds: float, body_bytes: int) -> Callable:
+    """WSGI app that sleeps work_seconds, then returns a cacheable JSON body."""
+    def app(environ: dict, start_response: Callable) -> list[bytes]:
+        time.sleep(work_seconds)
+        body = json.dumps({
+            "path": environ.get("PATH_INFO"),
+            "data": "x" * body_bytes,
+        }).encode()
+        start_response("200 OK", [
+            ("Content-Type", "application/json"),
+            ("Cache-Control", "public, max-age=60"),
+        ])
+        return [body]
+    return app
+
+
+def run_benchmark(
+    *,
+    requests: int = 2000,
+    concurrency: int = 8,
+    paths: int = 50,
+    work_ms: float = 5.0,
+    body_bytes: int = 4096,
+    seed: int = 1
+) -> list[dict]:
+    """
+    Load-test the demo app over local HTTP, without and with the middleware.
+
+    A threaded wsgiref server runs in this process; ``concurrency`` client
+    threads issue ``requests`` GETs over ``paths`` URLs (Zipf-like: path i
+    is drawn with weight 1/(i+1)).
+
+    Returns:
+        One record per mode with throughput and latency percentiles
+    """
+    import http.client
+    import socketserver
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+    from cache_bench import percentile
+
+    class Server(socketserver.ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        request_queue_size = 1024  # The default 5 drops SYNs under load
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(paths)]
+    urls = [f"/item/{i}" for i in rng.choices(range(paths), weights, k=requests)]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("uncached", "cached"):
+            app = demo_app(work_ms / 1000, body_bytes)
+            middleware = None
+            if mode == "cached":
+                cache = PersistentLRUTTLCache(
+                    10_000, f"{tmp}/http.bin", codec=PickleCodec(), load_on_init=False
+                )
+                app = middleware = WSGICacheMiddleware(app, cache)
+            server = make_server("127.0.0.1", 0, app, server_class=Server,
+                                 handler_class=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            port = server.server_address[1]
+
+            def fetch(url: str) -> float:
+                started = time.perf_counter()
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+                conn.request("GET", url)
+                conn.getresponse().read()
+                conn.close()
+                return time.perf_counter() - started
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                latencies = sorted(pool.map(fetch, urls))
+            elapsed = time.perf_counter() - started
+            server.shutdown()
+            server.server_close()
+            results.append({
+                "record": "http_bench",
+                "mode": mode,
+                "requests": requests,
+                "concurrency": concurrency,
+                "rps": requests / elapsed,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "hit_ratio": middleware.hits / requests if middleware else 0.0,
+            })
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--bench", action="store_true", help="run the local load test")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--paths", type=int, default=50)
+    parser.add_argument("--work-ms", type=float, default=5.0, help="app time per request")
+    parser.add_argument("--body-bytes", type=int, default=4096)
+    parser.add_argument("--test", action="store_true", help="run the self-tests")
+    args = parser.parse_args(argv)
+
+    if args.test:
+        return 0 if run_tests() else 1
+    if not args.bench:
+        parser.print_help()
+        return 2
+    for record in run_benchmark(
+        requests=args.requests, concurrency=args.concurrency, paths=args.paths,
+        work_ms=args.work_ms, body_bytes=args.body_bytes,
+    ):
+        print(json.dumps(record))
+    return 0
+
+
+# =============================================================================
+# TEST SUITE
+# =============================================================================
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+from wsgiref.util import setup_testing_defaults
+
+from cache_v3 import MockClock
+
+
+class _MiddlewareTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.bin')
+        self.cache = PersistentLRUTTLCache(
+            100, self.path, now_fn=self.clock, codec=PickleCodec(buffer_threshold=64)
+        )
+        self.calls = 0
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def response_headers(self, path: str) -> list[tuple[str, str]]:
+        if path == "/private":
+            return [("Cache-Control", "private, max-age=60")]
+        if path == "/cookie":
+            return [("Cache-Control", "max-age=60"), ("Set-Cookie", "a=b")]
+        if path == "/vary-star":
+            return [("Cache-Control", "max-age=60"), ("Vary", "*")]
+        if path == "/default":
+            return []
+        return [("Cache-Control", "public, max-age=30"), ("Vary", "Accept-Encoding")]
+
+
+class TestPolicy(_MiddlewareTestCase):
+
+    def test_helpers(self):
+        self.assertEqual(
+            parse_cache_control('Public, max-age=60, s-maxage="10"'),
+            {"public": None, "max-age": "60", "s-maxage": "10"},
+        )
+        self.assertTrue(etag_matches('"a", W/"b"', '"b"'))
+        self.assertTrue(etag_matches("*", '"x"'))
+        self.assertFalse(etag_matches('"a"', '"b"'))
+        self.assertFalse(etag_matches(None, '"b"'))
+
+    def test_ttl(self):
+        policy = _ResponseCache(self.cache, vary=("Accept-Encoding",), default_ttl=5)
+        self.assertEqual(policy.ttl(200, [("Cache-Control", "max-age=60, s-maxage=10")]), 10)
+        self.assertEqual(policy.ttl(200, []), 5)
+        self.assertIsNone(policy.ttl(404, [("Cache-Control", "max-age=60")]))
+        self.assertIsNone(policy.ttl(200, [("Cache-Control", "max-age=0")]))
+        self.assertIsNone(policy.ttl(200, [("cache-control", "no-store")]))
+        self.assertIsNone(policy.ttl(200, [("Vary", "Cookie")]))
+        self.assertEqual(policy.ttl(200, [("Vary", "accept-encoding")]), 5)
+        with self.assertRaises(ValueError):
+            _ResponseCache(PersistentLRUTTLCache(10, self.path))
+
+    def test_packed_body_is_a_view(self):
+        response = CachedResponse("200 OK", [("A", "b")], '"e"', 1.0, b"x" * 1000)
+        self.cache.set("r", response.pack())
+        restored = CachedResponse.unpack(self.cache.get("r"))
+        self.assertIsInstance(restored.body, memoryview)
+        self.assertEqual(bytes(restored.body), b"x" * 1000)
+        self.assertEqual((restored.status, restored.headers), ("200 OK", [("A", "b")]))
+
+
+class TestWSGIMiddleware(_MiddlewareTestCase):
+
+    def app(self, environ, start_response):
+        self.calls += 1
+        path = environ["PATH_INFO"]
+        start_response("200 OK", [("Content-Type", "text/plain")] + self.response_headers(path))
+        body = f"{path} {environ.get('HTTP_ACCEPT_ENCODING')} {self.calls}".encode()
+        return [body, b"." * (500 if path == "/big" else 10)]
+
+    def request(self, middleware, path="/page", method="GET", **headers):
+        environ = {"PATH_INFO": path, "REQUEST_METHOD": method}
+        environ.update({"HTTP_" + k.upper(): v for k, v in headers.items()})
+        setup_testing_defaults(environ)
+        captured = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            captured["status"] = status
+            captured["headers"] = dict(response_headers)
+            return lambda data: None
+
+        body = b"".join(middleware(environ, start_response))
+        return captured["status"], captured["headers"], body
+
+    def test_hit_miss_and_conditional(self):
+        mw = WSGICacheMiddleware(self.app, self.cache, vary=("accept-encoding",), now_fn=self.clock)
+        status, headers, body = self.request(mw, accept_encoding="gzip")
+        self.assertEqual((status, headers["X-Cache"]), ("200 OK", "MISS"))
+        self.assertEqual(headers["Content-Length"], str(len(body)))
+        etag = headers["ETag"]
+
+        self.clock.advance(7)
+        status, headers, again = self.request(mw, accept_encoding="gzip")
+        self.assertEqual((again, headers["X-Cache"], headers["Age"]), (body, "HIT", "7"))
+        self.assertEqual(self.calls, 1)
+
+        status, headers, empty = self.request(mw, accept_encoding="gzip", if_none_match=etag)
+        self.assertEqual((status, empty), ("304 Not Modified", b""))
+        self.assertNotIn("Content-Type", headers)
+        self.assertEqual(headers["ETag"], etag)
+
+        self.request(mw, accept_encoding="br")  # Another variant
+        status, headers, empty = self.request(mw, method="HEAD", accept_encoding="gzip")
+        self.assertEqual((self.calls, empty, headers["X-Cache"]), (2, b"", "HIT"))
+
+        self.clock.advance(30)  # max-age=30
+        self.request(mw, accept_encoding="gzip")
+        self.assertEqual(self.calls, 3)
+        self.assertEqual((mw.hits, mw.stores, mw.not_modified), (3, 3, 1))
+
+    def test_uncacheable_and_bypass(self):
+        mw = WSGICacheMiddleware(self.app, self.cache, vary=("accept-encoding",),
+                                 max_body_bytes=200)
+        for path in ("/private", "/cookie", "/vary-star", "/default", "/big"):
+            for _ in range(2):
+                status, headers, body = self.request(mw, path)
+                self.assertNotIn("X-Cache", headers)
+        self.assertEqual(self.calls, 10)
+        self.assertEqual(len(body), len(b"/big None 10") + 500)
+
+        self.request(mw)
+        self.request(mw, authorization="Bearer x")
+        self.request(mw, cache_control="no-cache")  # Refreshes the entry
+        self.assertEqual(self.calls, 13)
+        self.assertEqual(self.request(mw)[2], b"/page None 13" + b"." * 10)
+        self.request(mw, method="POST")
+        self.assertEqual(mw.bypassed, 2)
+
+    def test_key_includes_host_and_prefix(self):
+        mw = WSGICacheMiddleware(self.app, self.cache, vary=("accept-encoding",))
+        self.request(mw, host="tenant-a.example")
+        _, headers, _ = self.request(mw, host="tenant-b.example")
+        self.assertEqual((headers["X-Cache"], self.calls), ("MISS", 2))
+        self.assertEqual(self.request(mw, host="TENANT-B.example")[1]["X-Cache"], "HIT")
+
+        environ = {"PATH_INFO": "/page", "SCRIPT_NAME": "/other-app", "HTTP_HOST": "tenant-a.example"}
+        setup_testing_defaults(environ)
+        list(mw(environ, lambda *a: None))
+        self.assertEqual(self.calls, 3)
+
+    def test_error_restart_is_not_cached(self):
+        def app(environ, start_response):
+            self.calls += 1
+            start_response("200 OK", [("Cache-Control", "max-age=60")])
+            try:
+                raise RuntimeError("render failed")
+            except RuntimeError:
+                start_response("500 Internal Server Error", [], sys.exc_info())
+            return [b"error page"]
+
+        mw = WSGICacheMiddleware(app, self.cache)
+        environ = {"PATH_INFO": "/page"}
+        setup_testing_defaults(environ)
+        statuses = []
+        body = b"".join(mw(environ, lambda status, *a: statuses.append(status)))
+        self.assertEqual((statuses, body), (["500 Internal Server Error"], b"error page"))
+        self.request(mw)
+        self.assertEqual((self.calls, mw.stores), (2, 0))
+
+    def test_large_body_streams_in_chunks(self):
+        def app(environ, start_response):
+            start_response("200 OK", [("Cache-Control", "max-age=60")])
+            return [b"y" * (CHUNK_BYTES + 10)]
+
+        mw = WSGICacheMiddleware(app, self.cache)
+        self.request(mw)
+        environ = {"PATH_INFO": "/page"}
+        setup_testing_defaults(environ)
+        chunks = list(mw(environ, lambda *a: None))
+        self.assertEqual([len(c) for c in chunks], [CHUNK_BYTES, 10])
+        self.assertTrue(all(type(c) is bytes for c in chunks))
+
+
+class TestASGIMiddleware(_MiddlewareTestCase):
+
+    async def app(self, scope, receive, send):
+        self.calls += 1
+        path = scope["path"]
+        headers = [(k.encode(), v.encode()) for k, v in self.response_headers(path)]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": path.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b"!" * (500 if path == "/big" else 100)})
+
+    def request(self, middleware, path="/page", method="GET", headers=(), root_path=""):
+        scope = {
+            "type": "http", "method": method, "path": path, "query_string": b"q=1",
+            "root_path": root_path, "server": ("127.0.0.1", 8000),
+            "headers": [(k.encode(), v.encode()) for k, v in headers],
+        }
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(middleware(scope, receive, send))
+        start = sent[0]
+        body = b"".join(bytes(m.get("body", b"")) for m in sent[1:])
+        return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}, body, sent
+
+    def test_hit_miss_and_conditional(self):
+        mw = ASGICacheMiddleware(self.app, self.cache, vary=("accept-encoding",), now_fn=self.clock)
+        status, headers, body, _ = self.request(mw)
+        self.assertEqual((status, headers["X-Cache"], body), (200, "MISS", b"/page" + b"!" * 100))
+        etag = headers["ETag"]
+
+        status, headers, again, sent = self.request(mw)
+        self.assertEqual((again, headers["X-Cache"], self.calls), (body, "HIT", 1))
+        self.assertIsInstance(sent[1]["body"], memoryview)  # Zero-copy slice
+
+        status, headers, empty, _ = self.request(mw, headers=[("If-None-Match", etag)])
+        self.assertEqual((status, empty), (304, b""))
+        status, _, empty, _ = self.request(mw, method="HEAD")
+        self.assertEqual((status, empty), (200, b""))
+
+        self.request(mw, headers=[("Accept-Encoding", "gzip")])
+        self.assertEqual(self.calls, 2)
+
+    def test_key_includes_host_and_root_path(self):
+        mw = ASGICacheMiddleware(self.app, self.cache, vary=("accept-encoding",))
+        self.request(mw, headers=[("Host", "tenant-a.example")])
+        self.assertEqual(self.request(mw, headers=[("Host", "tenant-b.example")])[1]["X-Cache"], "MISS")
+        self.assertEqual(self.request(mw, headers=[("Host", "tenant-b.example")])[1]["X-Cache"], "HIT")
+        self.assertEqual(self.request(mw, root_path="/mounted")[1]["X-Cache"], "MISS")
+        self.assertEqual(self.calls, 3)
+
+    def test_uncacheable_and_large(self):
+        mw = ASGICacheMiddleware(self.app, self.cache, max_body_bytes=200)
+        for path in ("/private", "/cookie", "/big"):
+            for _ in range(2):
+                status, headers, body, _ = self.request(mw, path)
+                self.assertNotIn("X-Cache", headers)
+        self.assertEqual(self.calls, 6)
+        self.assertEqual(body, b"/big" + b"!" * 500)
+        self.request(mw, headers=[("Authorization", "x")])
+        self.assertEqual(mw.bypassed, 1)
+
+
+class TestBenchmark(TestCase):
+
+    def test_cached_run_hits(self):
+        uncached, cached = run_benchmark(requests=60, concurrency=4, paths=5, work_ms=1.0)
+        self.assertEqual((uncached["mode"], cached["mode"]), ("uncached", "cached"))
+        self.assertGreater(cached["hit_ratio"], 0.5)
+        self.assertGreater(uncached["rps"], 0)
+
+
+def run_tests():
+    """Run all tests."""
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(loader.loadTestsFromTestCase(TestPolicy))
+    suite.addTests(loader.loadTestsFromTestCase(TestWSGIMiddleware))
+    suite.addTests(loader.loadTestsFromTestCase(TestASGIMiddleware))
+    suite.addTests(loader.loadTestsFromTestCase(TestBenchmark))
+
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+
+    return result.wasSuccessful()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,639 @@
+"""
+Cache Invalidation Bus: cross-process invalidation over a UNIX socket.
+
+Every worker keeps its own PersistentLRUTTLCache and an InvalidationPeer.
+A write or delete in one worker is broadcast through an InvalidationHub,
+and every other worker drops its now-stale copy, so TTLs no longer have
+to be short just to bound staleness.
+
+Messages (length-prefixed pickle frames, as in cache_replication.py):
+    peer -> hub   ("hello", peer_id, epoch | None, last_seq)
+                  ("publish", [keys], clear)
+                  ("replay", after_seq, before_seq)
+    hub -> peer   ("welcome", epoch, seq)
+                  ("batch", seq, origin_peer_id, [keys], clear)
+                  ("reset", seq)           missed batches are gone
+                  ("tick", seq)            heartbeat when idle
+
+Design Decisions:
+- Batching: a peer collects invalidations for flush_interval seconds (or
+  until max_batch keys) and publishes them as one message; repeated keys
+  are coalesced, and a pending clear subsumes all keys. While the hub is
+  unreachable keys keep collecting; past max_pending they are dropped in
+  favour of a clear, so an outage costs other peers their caches rather
+  than this peer unbounded memory
+- Sequencing: the hub numbers each batch; peers track the last number
+  seen, so missed batches show up as a gap (or, via the idle tick, as a
+  trailing gap)
+- Gap recovery: the hub keeps the last `history` batches; a peer that
+  sees a gap asks for a replay, and if the batches are gone (or the hub
+  restarted with a new epoch) it clears its cache. Invalidations only
+  delete, so applying replayed batches late or out of order is safe
+- Backpressure: the hub never blocks on a slow peer; when a peer's send
+  buffer exceeds max_buffer, batches to it are dropped and it recovers
+  through the gap path
+- Sources: with a MutationJournal on the cache, every set/delete/clear
+  made through the cache API is published automatically; invalidate()
+  publishes explicitly. Remote invalidations are applied without being
+  re-published
+
+Usage:
+    hub = InvalidationHub("/run/cache-bus.sock")       # in one process
+    peer = InvalidationPeer(cache, "/run/cache-bus.sock")  # in each worker
+    await hub.start(); peer.start()
+
+License: MIT
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import pickle
+import sys
+from collections import deque
+from typing import Any, Iterable
+
+from cache_replication import encode_frame, read_frame
+from cache_v3 import PersistentLRUTTLCache
+
+
+class InvalidationHub:
+    """Sequences published invalidation batches and fans them out to peers."""
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        history: int = 1024,
+        heartbeat: float = 1.0,
+        max_buffer: int = 1 << 20
+    ) -> None:
+        """
+        Args:
+            path: UNIX socket path
+            history: Batches kept for replaying to peers that missed them
+            heartbeat: Idle seconds between ticks
+            max_buffer: Unsent bytes per peer above which batches to that
+                peer are dropped (it then asks for a replay)
+        """
+        if history < 1:
+            raise ValueError(f"history must be >= 1, got {history}")
+        self.path = path
+        self.heartbeat = heartbeat
+        self.max_buffer = max_buffer
+        self.epoch = os.urandom(8).hex()
+        self.seq = 0
+        self._history: deque[tuple] = deque(maxlen=history)
+        self._peers: dict[str, asyncio.StreamWriter] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._server: asyncio.AbstractServer | None = None
+        self._ticker: asyncio.Task | None = None
+        self.batches = 0
+        self.dropped = 0
+        self.replays = 0
+        self.resets = 0
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+        self._ticker = asyncio.create_task(self._tick())
+
+    async def stop(self) -> None:
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        if self._server is not None:
+            self._server.close()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> InvalidationHub:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.stop()
+
+    @property
+    def peers(self) -> int:
+        return len(self._peers)
+
+    def _send(self, writer: asyncio.StreamWriter, message: tuple) -> bool:
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            return False
+        writer.write(encode_frame(message))
+        return True
+
+    async def _tick(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            tick = ("tick", self.seq)
+            for writer in self._peers.values():
+                self._send(writer, tick)
+
+    def _publish(self, origin: str, keys: list, clear: bool) -> None:
+        self.seq += 1
+        batch = ("batch", self.seq, origin, keys, clear)
+        self._history.append(batch)
+        self.batches += 1
+        frame = encode_frame(batch)
+        for writer in self._peers.values():
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.dropped += 1
+            else:
+                writer.write(frame)
+
+    def _replay(self, writer: asyncio.StreamWriter, after: int, before: int) -> None:
+        """Resend batches after < seq < before, or a reset if any are gone."""
+        if after + 1 >= before:
+            return
+        history = self._history
+        if not history or history[0][1] > after + 1:
+            self.resets += 1
+            self._send(writer, ("reset", before - 1))
+            return
+        self.replays += 1
+        for batch in history:
+            if after < batch[1] < before:
+                writer.write(encode_frame(batch))
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._tasks.add(asyncio.current_task())
+        peer_id = None
+        try:
+            async with asyncio.timeout(self.heartbeat * 10):
+                hello = await read_frame(reader)
+            _, peer_id, epoch, last = hello
+            writer.write(encode_frame(("welcome", self.epoch, self.seq)))
+            if epoch == self.epoch:
+                self._replay(writer, last, self.seq + 1)
+            elif epoch is not None:
+                # Restarted hub: nothing it could replay is known
+                self.resets += 1
+            self._peers[peer_id] = writer
+            while True:
+                message = await read_frame(reader)
+                if message[0] == "publish":
+                    _, keys, clear = message
+                    self._publish(peer_id, keys, clear)
+                elif message[0] == "replay":
+                    _, after, before = message
+                    self._replay(writer, after, before)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, TimeoutError,
+                pickle.UnpicklingError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # stop()
+        finally:
+            if self._peers.get(peer_id) is writer:
+                del self._peers[peer_id]
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+
+class InvalidationPeer:
+    """
+    Connects one cache to an InvalidationHub.
+
+    Local invalidations are batched and published; remote ones are
+    applied with cache.delete()/clear(). All cache access happens on the
+    event loop running this peer.
+    """
+
+    def __init__(
+        self,
+        cache: PersistentLRUTTLCache,
+        path: str,
+        *,
+        flush_interval: float = 0.005,
+        max_batch: int = 512,
+        max_pending: int | None = None,
+        reconnect_delay: float = 0.5,
+        timeout: float = 5.0
+    ) -> None:
+        """
+        Args:
+            cache: The local cache
+            path: The hub's UNIX socket path
+            flush_interval: Seconds to collect invalidations into a batch
+            max_batch: Keys that trigger an immediate publish
+            max_pending: Unpublished keys above which a clear is published
+                instead (default 64 * max_batch)
+            reconnect_delay: Seconds to wait before reconnecting
+            timeout: Seconds of hub silence before reconnecting
+        """
+        self.cache = cache
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = 64 * max_batch if max_pending is None else max_pending
+        self.reconnect_delay = reconnect_delay
+        self.timeout = timeout
+        # Stable across reconnects, so replayed own batches are recognised
+        self.peer_id = os.urandom(8).hex()
+        self.epoch: str | None = None
+        self.seq = 0
+        self._pending: dict[Any, None] = {}
+        self._pending_clear = False
+        self._applying = False
+        self._writer: asyncio.StreamWriter | None = None
+        self._task: asyncio.Task | None = None
+        self._flusher: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self.published = 0
+        self.applied = 0
+        self.gaps = 0
+        self.resets = 0
+        self.overflows = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            journal = self.cache.journal
+            if journal is not None:
+                journal.listeners.append(self._on_mutation)
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """Publish anything pending (if connected) and disconnect."""
+        self._flush()
+        for task in (self._flusher, self._task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._flusher = None
+        journal = self.cache.journal
+        if journal is not None and self._on_mutation in journal.listeners:
+            journal.listeners.remove(self._on_mutation)
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    def invalidate(self, keys: Iterable[Any]) -> None:
+        """Delete keys locally and publish them to every other peer."""
+        self._applying = True
+        try:
+            for key in keys:
+                self.cache.delete(key)
+                self._add_pending(key)
+        finally:
+            self._applying = False
+        self._schedule()
+
+    def invalidate_all(self) -> None:
+        """Clear the local cache and every other peer's."""
+        self._applying = True
+        try:
+            self.cache.clear()
+        finally:
+            self._applying = False
+        self._pending.clear()
+        self._pending_clear = True
+        self._schedule()
+
+    def _add_pending(self, key: Any) -> None:
+        if self._pending_clear:
+            return  # Subsumed
+        self._pending[key] = None
+        if len(self._pending) > self.max_pending:
+            # Hub unreachable for too long: publish a clear instead
+            self._pending.clear()
+            self._pending_clear = True
+            self.overflows += 1
+
+    def _on_mutation(self, entry: tuple) -> None:
+        if self._applying:
+            return
+        op = entry[1]
+        if op in ("set", "delete"):
+            self._add_pending(entry[2])
+        elif op == "clear":
+            self._pending_clear = True
+        else:
+            return
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            if len(self._pending) < self.max_batch and not self._pending_clear:
+                # Let more invalidations coalesce into this batch
+                await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            self._flush()
+            if self._writer is not None:
+                try:
+                    await self._writer.drain()
+                except ConnectionError:
+                    pass
+
+    def _flush(self) -> None:
+        """Publish pending invalidations (kept for later when disconnected)."""
+        writer = self._writer
+        if writer is None or not (self._pending or self._pending_clear):
+            return
+        if self._pending_clear:
+            keys: list = []
+        else:
+            keys = list(self._pending)
+        for i in range(0, max(len(keys), 1), self.max_batch):
+            writer.write(encode_frame(
+                ("publish", keys[i:i + self.max_batch], self._pending_clear)
+            ))
+            self.published += 1
+        self._pending.clear()
+        self._pending_clear = False
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._follow()
+            except (OSError, asyncio.IncompleteReadError, pickle.UnpicklingError, ValueError):
+                pass
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _follow(self) -> None:
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        try:
+            writer.write(encode_frame(("hello", self.peer_id, self.epoch, self.seq)))
+            async with asyncio.timeout(self.timeout):
+                welcome = await read_frame(reader)
+            _, epoch, seq = welcome
+            if self.epoch is not None and epoch != self.epoch:
+                # New hub: whatever was missed cannot be replayed
+                self._reset(seq)
+            elif self.epoch is None:
+                self.seq = seq
+            self.epoch = epoch
+            self._writer = writer
+            self._flush()  # Invalidations made while disconnected
+            while True:
+                async with asyncio.timeout(self.timeout):
+                    message = await read_frame(reader)
+                self._handle(message)
+        finally:
+            self._writer = None
+            writer.close()
+
+    def _handle(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == "batch":
+            _, seq, origin, keys, clear = message
+            if seq > self.seq + 1:
+                self._gap(seq)
+            if seq > self.seq:
+                self.seq = seq
+            if origin != self.peer_id:
+                self._apply(keys, clear)
+        elif kind == "tick":
+            if message[1] > self.seq:
+                self._gap(message[1] + 1)
+                self.seq = message[1]
+        elif kind == "reset":
+            self._reset(message[1])
+
+    def _gap(self, seq: int) -> None:
+        """Batches self.seq+1 .. seq-1 were missed; ask for them again."""
+        self.gaps += 1
+        if self._writer is not None:
+            self._writer.write(encode_frame(("replay", self.seq, seq)))
+
+    def _reset(self, seq: int) -> None:
+        self.resets += 1
+        self._apply([], True)
+        self.seq = max(self.seq, seq)
+
+    def _apply(self, keys: list, clear: bool) -> None:
+        self._applying = True
+        try:
+            if clear:
+                self.cache.clear()
+            else:
+                for key in keys:
+                    self.cache.delete(key)
+        finally:
+            self._applying = False
+        self.applied += 1
+
+
+# =============================================================================
+# TEST SUITE
+# =============================================================================
+
+import tempfile
+import unittest
+from unittest import TestCase
+
+from cache_v3 import MutationJournal
+
+
+async def _until(predicate, timeout: float = 5.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.005)
+
+
+class TestInvalidationBus(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "bus.sock")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _cache(self, name: str, journal: bool = True) -> PersistentLRUTTLCache:
+        return PersistentLRUTTLCache(
+            100, os.path.join(self.dir, name),
+            journal=MutationJournal() if journal else None
+        )
+
+    def run_async(self, coro_fn):
+        asyncio.run(asyncio.wait_for(coro_fn(), 30))
+
+    async def _peers(self, n: int, seed: Iterable = (), **kwargs) -> list[InvalidationPeer]:
+        """Start n peers, each with ``seed`` keys set before it publishes."""
+        peers = []
+        for i in range(n):
+            peer = InvalidationPeer(self._cache(f"c{i}.json"), self.path, **kwargs)
+            for key in seed:
+                peer.cache.set(key, 1)
+            peer.start()
+            peers.append(peer)
+        await _until(lambda: all(p.connected for p in peers))
+        return peers
+
+    def test_mutations_propagate_coalesced(self):
+        async def run():
+            async with InvalidationHub(self.path) as hub:
+                a, b, c = await self._peers(3, seed=("x", "y", "z", "keep"), flush_interval=0.02)
+                for _ in range(100):
+                    for key in ("x", "y", "z"):
+                        a.cache.set(key, 2)
+                await _until(lambda: "x" not in b.cache and "x" not in c.cache)
+                self.assertEqual(hub.batches, 1)  # 300 writes, one batch
+                for peer in (b, c):
+                    self.assertEqual(peer.cache.get("keep"), 1)
+                    self.assertNotIn("z", peer.cache)
+                self.assertEqual(a.cache.get("x"), 2)  # Own batch not applied
+
+                a.invalidate(["keep"])
+                await _until(lambda: "keep" not in b.cache and "keep" not in c.cache)
+                b.cache.clear()
+                await _until(lambda: len(a.cache) == 0 and len(c.cache) == 0)
+                for peer in (a, b, c):
+                    await peer.stop()
+        self.run_async(run)
+
+    def test_reconnect_replays_missed_batches(self):
+        async def run():
+            async with InvalidationHub(self.path, history=4) as hub:
+                a, b = await self._peers(2, reconnect_delay=0.01)
+                b.cache.set("k1", 1)
+                b.cache.set("k2", 1)
+                await _until(lambda: a.seq == 1 and b.seq == 1)
+                await b.stop()
+                a.invalidate(["k1"])
+                await _until(lambda: hub.batches == 2)
+                b.start()
+                await _until(lambda: "k1" not in b.cache)
+                self.assertEqual(b.cache.get("k2"), 1)
+                self.assertEqual((hub.replays, b.resets), (1, 0))
+
+                # Missed more batches than the hub keeps: clear everything
+                await b.stop()
+                for i in range(10):
+                    a.invalidate([f"other{i}"])
+                    await asyncio.sleep(0.01)
+                b.start()
+                await _until(lambda: b.resets == 1)
+                self.assertEqual(len(b.cache), 0)
+                for peer in (a, b):
+                    await peer.stop()
+        self.run_async(run)
+
+    def test_deletes_of_unheld_keys_and_load(self):
+        async def run():
+            async with InvalidationHub(self.path):
+                a, b = await self._peers(2)
+                b.cache.set("k", 1)
+                a.cache.delete("k")  # Never cached by a: still published
+                await _until(lambda: "k" not in b.cache)
+
+                b.cache.set("kept", 1)
+                await asyncio.sleep(0.02)
+                a.cache.set("local", 1)
+                a.cache.flush()
+                a.cache.load()  # Replaces a's own entries only
+                await asyncio.sleep(0.05)
+                self.assertEqual(b.cache.get("kept"), 1)
+                self.assertEqual(a.cache.get("local"), 1)
+                for peer in (a, b):
+                    await peer.stop()
+        self.run_async(run)
+
+    def test_pending_bounded_while_hub_unreachable(self):
+        async def run():
+            async with InvalidationHub(self.path) as hub:
+                (b,) = await self._peers(1, seed=("k",))
+                a = InvalidationPeer(
+                    self._cache("a.json"), self.path + ".down",
+                    max_batch=4, max_pending=8, reconnect_delay=0.01
+                )
+                a.start()
+                for i in range(8):
+                    a.cache.set(i, i)
+                self.assertEqual(len(a._pending), 8)
+                a.cache.set(8, 8)
+                self.assertEqual((a._pending, a._pending_clear, a.overflows), ({}, True, 1))
+                a.cache.set(9, 9)  # Subsumed by the clear
+                self.assertEqual(a._pending, {})
+
+                a.path = self.path  # Hub reachable again
+                await _until(lambda: len(b.cache) == 0)
+                self.assertEqual(hub.batches, 1)
+                self.assertEqual(len(a.cache), 10)  # Own clear not applied
+                for peer in (a, b):
+                    await peer.stop()
+        self.run_async(run)
+
+    def test_gap_and_trailing_gap_detection(self):
+        async def run():
+            async with InvalidationHub(self.path, heartbeat=0.02) as hub:
+                a, b = await self._peers(2, reconnect_delay=0.01)
+                b.cache.set("k", 1)
+                await _until(lambda: a.seq == hub.seq)
+                # Drop the next batch to b, as the hub does for a slow peer
+                b_writer = hub._peers[b.peer_id]
+                hub._peers.pop(b.peer_id)
+                a.invalidate(["k"])
+                await _until(lambda: hub.batches == 2)
+                hub._peers[b.peer_id] = b_writer
+                await _until(lambda: "k" not in b.cache)  # via tick + replay
+                self.assertEqual(b.gaps, 1)
+                for peer in (a, b):
+                    await peer.stop()
+        self.run_async(run)
+
+    def test_hub_restart_resets_peers(self):
+        async def run():
+            async with InvalidationHub(self.path):
+                (a,) = await self._peers(1, reconnect_delay=0.01)
+                a.cache.set("k", 1)
+            async with InvalidationHub(self.path):
+                await _until(lambda: a.resets == 1)
+                self.assertEqual(len(a.cache), 0)
+                await a.stop()
+        self.run_async(run)
+
+    def test_explicit_invalidation_without_journal(self):
+        async def run():
+            async with InvalidationHub(self.path):
+                a = InvalidationPeer(self._cache("a.json", journal=False), self.path)
+                b = InvalidationPeer(self._cache("b.json", journal=False), self.path)
+                a.start()
+                b.start()
+                await _until(lambda: a.connected and b.connected)
+                b.cache.set("k", 1)
+                a.cache.set("k", 1)  # Not journaled: nothing is published
+                await asyncio.sleep(0.02)
+                self.assertEqual(b.cache.get("k"), 1)
+                a.invalidate_all()
+                await _until(lambda: len(b.cache) == 0)
+                for peer in (a, b):
+                    await peer.stop()
+        self.run_async(run)
+
+
+def run_tests():
+    """Run all tests."""
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(loader.loadTestsFromTestCase(TestInvalidationBus))
+
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+
+    return result.wasSuccessful()
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
@@ -0,0 +1,594 @@
+"""
+Cache Replication: warm standby caches fed by a primary's mutation journal.
+
+A ReplicationPrimary serves a PersistentLRUTTLCache created with a
+MutationJournal. A CacheReplica connects (UNIX socket or TCP), receives a
+snapshot of every live entry, then follows the stream of set/delete/
+evict/clear mutations, so a failover lands on a fully warm cache holding
+the primary's keys.
+
+Wire format: 4-byte big-endian length + pickle (protocol 5) of a tuple.
+Pickle is only safe between trusted processes; bind to a local socket.
+    replica -> primary   ("hello", epoch | None, last_applied_seq)
+    primary -> replica   ("snapshot", epoch, seq)
+                         ("entries", [(key, value, expires_at), ...])  x N
+                         ("snapshot_end", seq)
+                         ("set", seq, key, value, expires_at)
+                         ("delete", seq, key)
+                         ("evict", seq, key)             before its set
+                         ("clear", seq)
+                         ("ping", seq)                   when idle
+
+Lag and reconnect semantics:
+- The primary never waits for replicas: set() only appends to the
+  bounded journal. Each replica has its own sender, throttled by
+  StreamWriter.drain() (TCP backpressure).
+- A reconnecting replica sends the primary's epoch and its last applied
+  sequence number. If the journal still holds everything after it, the
+  stream resumes there (partial resync); otherwise, or if the epoch
+  differs (primary restarted or failed over), it gets a full snapshot.
+- A replica that lags by more than the journal's capacity gets a full
+  snapshot on the same connection.
+- load() on the primary logs "reset", which also forces a snapshot.
+- A sequence gap or more than ``timeout`` seconds of silence (the
+  primary pings every ``heartbeat`` seconds) makes the replica drop the
+  connection and reconnect.
+- During a full snapshot the replica's cache is cleared and refilled
+  (``synced`` is False until it ends); reads can see a partial cache.
+- Expiry times are absolute (primary clock), so clocks should agree.
+  Evictions are streamed ahead of the set that caused them, so a replica
+  with the primary's max_size drops the same keys. Hits are not (they
+  would cost every get() and flood the journal), so a replica's LRU order
+  is its snapshot's plus the writes since; after a failover the first
+  evictions may pick different keys than the old primary would have.
+
+Failover: stop the replica and serve its cache (with a journal of its own
+and a new ReplicationPrimary); remaining replicas see a new epoch and
+resynchronise from it.
+
+License: MIT
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+import pickle
+import sys
+from typing import Any
+
+from cache_v3 import MutationJournal, PersistentLRUTTLCache
+
+
+Address = str | tuple[str, int]
+
+_HEADER = 4
+MAX_FRAME_BYTES = 1 << 30
+
+
+class ReplicationError(Exception):
+    """Protocol violation, e.g. a gap in the mutation sequence."""
+    pass
+
+
+class _FramePickler(pickle.Pickler):
+    # Cached values may be memoryviews (PickleCodec), which cannot be pickled
+    dispatch_table = {memoryview: lambda m: (bytes, (m.tobytes(),))}
+
+
+def encode_frame(message: tuple) -> bytes:
+    buf = io.BytesIO()
+    buf.write(b"\0" * _HEADER)
+    _FramePickler(buf, protocol=5).dump(message)
+    frame = buf.getbuffer()
+    frame[:_HEADER] = (len(frame) - _HEADER).to_bytes(_HEADER, 'big')
+    return bytes(frame)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple:
+    size = int.from_bytes(await reader.readexactly(_HEADER), 'big')
+    if size > MAX_FRAME_BYTES:
+        raise ReplicationError(f"frame of {size} bytes exceeds limit")
+    return pickle.loads(await reader.readexactly(size))
+
+
+async def _open(address: Address):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+
+class ReplicationPrimary:
+    """
+    Streams a journaled cache to any number of replicas.
+
+    All access to the cache happens on the event loop that runs this
+    server, like CacheServer; the two can share one loop and one cache.
+    """
+
+    def __init__(
+        self,
+        cache: PersistentLRUTTLCache,
+        address: Address,
+        *,
+        heartbeat: float = 1.0,
+        snapshot_batch: int = 1000
+    ) -> None:
+        """
+        Args:
+            cache: Cache created with journal=MutationJournal(...)
+            address: UNIX socket path, or (host, port) for TCP (port 0
+                picks a free port; see .address after start())
+            heartbeat: Idle seconds between pings
+            snapshot_batch: Entries per snapshot frame
+
+        Raises:
+            ValueError: If the cache has no journal
+        """
+        if cache.journal is None:
+            raise ValueError("replication needs a cache created with journal=MutationJournal()")
+        self.cache = cache
+        self.journal: MutationJournal = cache.journal
+        self.address = address
+        self.heartbeat = heartbeat
+        self.snapshot_batch = snapshot_batch
+        self.epoch = os.urandom(8).hex()
+        self._server: asyncio.AbstractServer | None = None
+        self._clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self._wakeup = asyncio.Event()
+        # Replica peer name -> last sequence number sent to it
+        self.replicas: dict[str, int] = {}
+        self.snapshots = 0
+        self.partial_resyncs = 0
+
+    async def start(self) -> None:
+        self.journal.listeners.append(self._on_append)
+        if isinstance(self.address, str):
+            self._server = await asyncio.start_unix_server(self._serve, self.address)
+        else:
+            self._server = await asyncio.start_server(self._serve, *self.address)
+            self.address = self._server.sockets[0].getsockname()[:2]
+
+    async def stop(self) -> None:
+        if self._on_append in self.journal.listeners:
+            self.journal.listeners.remove(self._on_append)
+        if self._server is not None:
+            self._server.close()
+            for task in self._clients:
+                task.cancel()
+            await asyncio.gather(*self._clients, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> ReplicationPrimary:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.stop()
+
+    def lag(self) -> dict[str, int]:
+        """Mutations not yet sent, per connected replica."""
+        return {peer: self.journal.seq - sent for peer, sent in self.replicas.items()}
+
+    def _on_append(self, entry: tuple) -> None:
+        # Wake every sender waiting for new entries; a sender that finds
+        # nothing left swaps in a fresh Event, so appends stay allocation-free
+        self._wakeup.set()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._clients[asyncio.current_task()] = writer
+        peer = f"replica-{id(writer):x}"
+        try:
+            async with asyncio.timeout(self.heartbeat * 10):
+                hello = await read_frame(reader)
+            if not (isinstance(hello, tuple) and len(hello) == 3 and hello[0] == "hello"):
+                raise ReplicationError(f"bad hello {hello!r}")
+            _, epoch, seq = hello
+            pos = seq if epoch == self.epoch else None
+            if pos is not None and self.journal.since(pos) is not None:
+                self.partial_resyncs += 1
+            await self._stream(peer, pos, writer)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError,
+                ReplicationError, pickle.UnpicklingError) as e:
+            if not isinstance(e, (asyncio.IncompleteReadError, ConnectionError)):
+                print(f"cache_replication: dropping replica: {e!r}", file=sys.stderr)
+        except asyncio.CancelledError:
+            pass  # stop()
+        finally:
+            self.replicas.pop(peer, None)
+            self._clients.pop(asyncio.current_task(), None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _stream(self, peer: str, pos: int | None, writer: asyncio.StreamWriter) -> None:
+        journal = self.journal
+        while True:
+            entries = journal.since(pos) if pos is not None else None
+            if entries is None:
+                # New replica, other epoch, lagged past the journal or reset
+                pos = await self._send_snapshot(writer)
+                self.replicas[peer] = pos
+                continue
+            if not entries:
+                wakeup = self._wakeup
+                if wakeup.is_set():
+                    # Already consumed: wait for the next append
+                    wakeup = self._wakeup = asyncio.Event()
+                try:
+                    async with asyncio.timeout(self.heartbeat):
+                        await wakeup.wait()
+                except TimeoutError:
+                    writer.write(encode_frame(("ping", pos)))
+                    await writer.drain()
+                continue
+            for seq, op, key, value, expires_at in entries:
+                if op == "reset":
+                    pos = None
+                    break
+                if op == "set":
+                    message = ("set", seq, key, value, expires_at)
+                elif op in ("delete", "evict"):
+                    message = (op, seq, key)
+                else:
+                    message = ("clear", seq)
+                writer.write(encode_frame(message))
+                pos = seq
+            if pos is not None:
+                self.replicas[peer] = pos
+            await writer.drain()
+
+    async def _send_snapshot(self, writer: asyncio.StreamWriter) -> int:
+        """Send every live entry; returns the sequence number it reflects."""
+        # Taken without awaiting, so it is exactly the state at journal.seq;
+        # later mutations are streamed from the journal afterwards
+        seq = self.journal.seq
+        now = self.cache._now()
+        items = [
+            (k, v, exp) for k, v, exp in self.cache._decoded_items()
+            if exp is None or exp > now
+        ]
+        writer.write(encode_frame(("snapshot", self.epoch, seq)))
+        batch = self.snapshot_batch
+        for i in range(0, len(items), batch):
+            writer.write(encode_frame(("entries", items[i:i + batch])))
+            await writer.drain()
+        writer.write(encode_frame(("snapshot_end", seq)))
+        await writer.drain()
+        self.snapshots += 1
+        return seq
+
+
+class CacheReplica:
+    """
+    Keeps a local cache in sync with a ReplicationPrimary.
+
+    run() connects, applies the snapshot and the mutation stream, and
+    reconnects after any failure (resuming from the last applied sequence
+    number when the primary still can).
+    """
+
+    def __init__(
+        self,
+        cache: PersistentLRUTTLCache,
+        address: Address,
+        *,
+        reconnect_delay: float = 0.5,
+        timeout: float = 5.0
+    ) -> None:
+        """
+        Args:
+            cache: Local cache to fill (same max_size as the primary)
+            address: The primary's address
+            reconnect_delay: Seconds to wait before reconnecting
+            timeout: Seconds of silence before the primary is presumed dead
+        """
+        self.cache = cache
+        self.address = address
+        self.reconnect_delay = reconnect_delay
+        self.timeout = timeout
+        self.epoch: str | None = None
+        self.seq = 0
+        self.primary_seq = 0
+        self.synced = False
+        self.full_syncs = 0
+        self.connects = 0
+        self.disconnects = 0
+        self._task: asyncio.Task | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._synced_event = asyncio.Event()
+
+    @property
+    def lag(self) -> int:
+        """Mutations the primary reported that are not yet applied."""
+        return max(0, self.primary_seq - self.seq)
+
+    def start(self) -> None:
+        """Run in the background on the current event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def wait_synced(self, timeout: float | None = None) -> None:
+        """Wait until a snapshot has been applied on the current connection."""
+        await asyncio.wait_for(self._synced_event.wait(), timeout)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._follow()
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                    ReplicationError, pickle.UnpicklingError):
+                pass
+            self.disconnects += 1
+            self.synced = False
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _follow(self) -> None:
+        reader, writer = await _open(self.address)
+        self._writer = writer
+        self.connects += 1
+        try:
+            writer.write(encode_frame(("hello", self.epoch, self.seq)))
+            await writer.drain()
+            # Resuming from the journal: no snapshot will come
+            self._synced_event.clear()
+            while True:
+                async with asyncio.timeout(self.timeout):
+                    message = await read_frame(reader)
+                self._apply(message)
+        finally:
+            self._writer = None
+            writer.close()
+
+    def _apply(self, message: tuple) -> None:
+        op = message[0]
+        cache = self.cache
+        if op in ("set", "delete", "evict", "clear"):
+            seq = message[1]
+            if seq != self.seq + 1:
+                raise ReplicationError(f"expected seq {self.seq + 1}, got {seq}")
+            if op == "set":
+                _, _, key, value, expires_at = message
+                self._set(key, value, expires_at)
+            elif op in ("delete", "evict"):
+                cache.delete(message[2])
+            else:
+                cache.clear()
+            self.seq = self.primary_seq = seq
+            self._mark_synced()
+        elif op == "entries":
+            for key, value, expires_at in message[1]:
+                self._set(key, value, expires_at)
+        elif op == "snapshot":
+            _, self.epoch, _ = message
+            self.synced = False
+            cache.clear()
+        elif op == "snapshot_end":
+            self.seq = self.primary_seq = message[1]
+            self.full_syncs += 1
+            self._mark_synced()
+        elif op == "ping":
+            self.primary_seq = message[1]
+            self._mark_synced()
+        else:
+            raise ReplicationError(f"unknown message {op!r}")
+
+    def _mark_synced(self) -> None:
+        if self.epoch is not None and not self.synced:
+            self.synced = True
+            self._synced_event.set()
+
+    def _set(self, key: Any, value: Any, expires_at: float | None) -> None:
+        if expires_at is None:
+            self.cache.set(key, value)
+            return
+        ttl = expires_at - self.cache._now()
+        if ttl > 0:
+            self.cache.set(key, value, ttl)
+
+
+# =============================================================================
+# TEST SUITE
+# =============================================================================
+
+import tempfile
+import unittest
+from unittest import TestCase
+
+from cache_v3 import MockClock, PickleCodec
+
+
+async def _until(predicate, timeout: float = 5.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.005)
+
+
+class TestReplication(TestCase):
+
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.dir, "primary.sock")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _cache(self, name: str, journal: MutationJournal | None = None, **kwargs):
+        return PersistentLRUTTLCache(
+            1000, os.path.join(self.dir, name), now_fn=self.clock,
+            journal=journal, **kwargs
+        )
+
+    def run_async(self, coro_fn):
+        asyncio.run(asyncio.wait_for(coro_fn(), 30))
+
+    def test_snapshot_then_stream(self):
+        async def run():
+            primary_cache = self._cache("p.json", MutationJournal())
+            primary_cache.set("old", {"v": 1})
+            primary_cache.set("ttl", 1, ttl_seconds=50)
+            primary_cache.set("gone", 1, ttl_seconds=1)
+            self.clock.advance(2)
+            replica_cache = self._cache("r.json")
+            async with ReplicationPrimary(primary_cache, self.address, heartbeat=0.05) as primary:
+                replica = CacheReplica(replica_cache, self.address)
+                replica.start()
+                await replica.wait_synced(5)
+                self.assertEqual(replica_cache.get("old"), {"v": 1})
+                self.assertNotIn("gone", replica_cache)
+                self.assertEqual(
+                    replica_cache._cache["ttl"][1], primary_cache._cache["ttl"][1]
+                )
+
+                primary_cache.set("new", [1, 2])
+                primary_cache.delete("old")
+                await _until(lambda: replica.seq == primary.journal.seq)
+                self.assertEqual(replica_cache.get("new"), [1, 2])
+                self.assertNotIn("old", replica_cache)
+                primary_cache.clear()
+                await _until(lambda: len(replica_cache) == 0)
+                self.assertEqual(replica.full_syncs, 1)
+                self.assertEqual(primary.lag(), {next(iter(primary.replicas)): 0})
+                await replica.stop()
+        self.run_async(run)
+
+    def test_failover_keeps_evicted_and_deleted_keys_in_step(self):
+        async def run():
+            journal = MutationJournal()
+            primary_cache = PersistentLRUTTLCache(
+                3, os.path.join(self.dir, "p.json"), now_fn=self.clock, journal=journal
+            )
+            replica_cache = PersistentLRUTTLCache(
+                3, os.path.join(self.dir, "r.json"), now_fn=self.clock
+            )
+            for key in ("a", "b", "c"):
+                primary_cache.set(key, key)
+            async with ReplicationPrimary(primary_cache, self.address, heartbeat=0.05) as primary:
+                replica = CacheReplica(replica_cache, self.address)
+                replica.start()
+                await replica.wait_synced(5)
+
+                seq = journal.seq
+                for _ in range(1000):
+                    primary_cache.get("a")  # Hits are not journaled
+                self.assertEqual(journal.seq, seq)
+                primary_cache.set("d", "d")  # Evicts "b": the replica's LRU is "a"
+                primary_cache.delete("never-cached")
+                primary_cache.set("e", "e")  # Evicts "c"
+                await _until(lambda: replica.seq == journal.seq)
+                await replica.stop()
+
+            # Failover: the replica holds exactly the primary's keys
+            self.assertEqual(set(replica_cache._cache), {"a", "d", "e"})
+            self.assertEqual(set(replica_cache._cache), set(primary_cache._cache))
+        self.run_async(run)
+
+    def test_reconnect_resumes_or_resyncs(self):
+        async def run():
+            journal = MutationJournal(capacity=10)
+            primary_cache = self._cache("p.json", journal)
+            replica_cache = self._cache("r.json")
+            async with ReplicationPrimary(primary_cache, self.address, heartbeat=0.05) as primary:
+                replica = CacheReplica(replica_cache, self.address, reconnect_delay=0.01)
+                replica.start()
+                await replica.wait_synced(5)
+
+                # Short outage: resumes from the journal, no new snapshot
+                await replica.stop()
+                for i in range(5):
+                    primary_cache.set(f"a{i}", i)
+                replica.start()
+                await _until(lambda: replica.seq == journal.seq)
+                self.assertEqual(replica.full_syncs, 1)
+                self.assertEqual(primary.partial_resyncs, 1)
+                self.assertEqual(replica_cache.get("a4"), 4)
+
+                # Outage longer than the journal: full snapshot
+                await replica.stop()
+                for i in range(30):
+                    primary_cache.set(f"b{i}", i)
+                replica.start()
+                await _until(lambda: replica.seq == journal.seq)
+                self.assertEqual(replica.full_syncs, 2)
+                self.assertEqual(len(replica_cache), len(primary_cache))
+
+                # load() on the primary forces a snapshot too
+                primary_cache.flush()
+                primary_cache.load()
+                await _until(lambda: replica.full_syncs == 3)
+                await replica.stop()
+        self.run_async(run)
+
+    def test_new_primary_epoch_forces_snapshot(self):
+        async def run():
+            replica_cache = self._cache("r.json")
+            replica = CacheReplica(replica_cache, self.address, reconnect_delay=0.01)
+            first = self._cache("p1.json", MutationJournal())
+            first.set("k", "first")
+            async with ReplicationPrimary(first, self.address):
+                replica.start()
+                await replica.wait_synced(5)
+            second = self._cache("p2.json", MutationJournal())
+            second.set("k", "second")
+            async with ReplicationPrimary(second, self.address):
+                await _until(lambda: replica.full_syncs == 2)
+                self.assertEqual(replica_cache.get("k"), "second")
+            await replica.stop()
+        self.run_async(run)
+
+    def test_binary_values_and_tcp(self):
+        async def run():
+            primary_cache = self._cache("p.bin", MutationJournal(), codec=PickleCodec())
+            primary_cache.set("blob", b"x" * 100_000)  # Stored out-of-band
+            replica_cache = self._cache("r.bin", codec=PickleCodec())
+            async with ReplicationPrimary(primary_cache, ("127.0.0.1", 0)) as primary:
+                replica = CacheReplica(replica_cache, primary.address)
+                replica.start()
+                await replica.wait_synced(5)
+                self.assertEqual(bytes(replica_cache.get("blob")), b"x" * 100_000)
+                await replica.stop()
+        self.run_async(run)
+
+    def test_gap_detection(self):
+        replica = CacheReplica(self._cache("r.json"), self.address)
+        replica._apply(("snapshot", "e", 5))
+        replica._apply(("snapshot_end", 5))
+        replica._apply(("set", 6, "k", 1, None))
+        with self.assertRaises(ReplicationError):
+            replica._apply(("delete", 8, "k"))
+        with self.assertRaises(ValueError):
+            ReplicationPrimary(self._cache("p.json"), self.address)
+
+
+def run_tests():
+    """Run all tests."""
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(loader.loadTestsFromTestCase(TestReplication))
+
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+
+    return result.wasSuccessful()
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
@@ -0,0 +1,1238 @@
+"""
+Cache Server: PersistentLRUTTLCache over the memcached text protocol.
+
+Runs one cache as a shared network service (asyncio TCP) and provides a
+pooled, pipelining client, so many hosts can share a cache instead of each
+process keeping its own.
+
+Supported protocol subset (memcached text protocol):
+    get <key>*\\r\\n                -> VALUE <key> <flags> <bytes>\\r\\n<data>\\r\\n ... END\\r\\n
+    gets <key>*\\r\\n               -> VALUE <key> <flags> <bytes> <cas unique>\\r\\n ...
+    set <key> <flags> <exptime> <bytes> [noreply]\\r\\n<data>\\r\\n
+                                    -> STORED\\r\\n
+    cas <key> <flags> <exptime> <bytes> <cas unique> [noreply]\\r\\n<data>\\r\\n
+                                    -> STORED\\r\\n | EXISTS\\r\\n | NOT_FOUND\\r\\n
+    incr|decr <key> <delta> [noreply]\\r\\n
+                                    -> <new value>\\r\\n | NOT_FOUND\\r\\n
+    delete <key> [noreply]\\r\\n    -> DELETED\\r\\n | NOT_FOUND\\r\\n
+    version\\r\\n                   -> VERSION <v>\\r\\n
+    quit\\r\\n                      -> connection closed
+
+    exptime: 0 = no expiry, <= 30 days = seconds from now, larger values
+    are absolute unix times, negative = already expired (as memcached).
+    gets/cas need a cache created with versioned=True; cas unique is the
+    entry version. incr/decr treat values as unsigned decimal numbers.
+    Errors: ERROR (unknown command), CLIENT_ERROR <msg>, SERVER_ERROR <msg>.
+    noreply suppresses every reply to the command, errors included (a
+    client that sent noreply has no request waiting for one).
+
+Design Decisions:
+- Concurrency: a single event loop owns the cache, so the non-thread-safe
+  cache needs no locks; each command runs to completion between awaits
+- Pipelining: a connection's commands are parsed and answered in order as
+  they arrive; clients may send many commands before reading any reply
+- Backpressure: replies go through StreamWriter.drain(), so a client that
+  stops reading stops being read from (the TCP window closes), and lines
+  and values are size-limited so one client cannot exhaust memory
+- Values: stored as bytes (or (flags, bytes) for non-zero flags) with
+  PickleCodec, so large values stay out-of-band and are written without
+  copies; the server refuses a cache whose codec cannot store bytes
+- Atomic updates: cas, incr and decr each run as one cache call on the
+  event loop, so clients get lock-free counters and optimistic
+  read-modify-write (gets, compute, cas, retry on EXISTS)
+- Persistence: flush() every flush_interval seconds when something
+  changed, and once more on stop()
+- Client: CacheClient keeps up to pool_size connections and spreads
+  requests across them; each connection pipelines, matching replies to
+  requests in FIFO order
+- Sharding: ShardedCacheClient places keys on a HashRing (consistent
+  hashing, vnodes points per node), so adding or removing one of N nodes
+  moves only ~1/N of the keys; multi-gets fan out to nodes in parallel
+
+Usage:
+    python cache_server.py --port 11211 --path cache.bin --max-size 100000
+    python cache_server.py --test
+
+License: MIT
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import math
+import re
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Any, Iterable
+
+from cache_v3 import PersistentLRUTTLCache, PickleCodec
+
+
+VERSION = "cache_v3-1.0"
+
+# memcached treats relative exptimes above this as absolute unix times
+RELATIVE_EXPTIME_MAX = 60 * 60 * 24 * 30
+MAX_KEY_BYTES = 250
+# Whitespace and control characters, which keys may not contain
+_BAD_KEY_BYTES = re.compile(rb"[\x00-\x20\x7f]")
+# Keys per get line sent by CacheClient (keeps lines under max_line_bytes)
+GET_BATCH_KEYS = 100
+
+
+class CacheClientError(Exception):
+    """Server answered ERROR, CLIENT_ERROR or SERVER_ERROR."""
+    pass
+
+
+def exptime_to_ttl(exptime: int, now: float | None = None) -> float | None:
+    """
+    Convert a memcached exptime to a TTL for PersistentLRUTTLCache.set().
+
+    Returns:
+        None for no expiry; a value <= 0 means already expired
+    """
+    if exptime == 0:
+        return None
+    if exptime < 0:
+        return -1.0
+    if exptime > RELATIVE_EXPTIME_MAX:
+        return exptime - (time.time() if now is None else now)
+    return float(exptime)
+
+
+def ttl_to_exptime(ttl_seconds: float | None, now: float | None = None) -> int:
+    """Inverse of exptime_to_ttl() (rounding the TTL up to whole seconds)."""
+    if ttl_seconds is None:
+        return 0
+    if ttl_seconds <= 0:
+        return -1
+    ttl = math.ceil(ttl_seconds)
+    if ttl > RELATIVE_EXPTIME_MAX:
+        return int((time.time() if now is None else now) + ttl)
+    return ttl
+
+
+def _check_key(key: bytes) -> str:
+    """Decode a key: 1-250 bytes of UTF-8, no whitespace or control characters."""
+    if not key or len(key) > MAX_KEY_BYTES or _BAD_KEY_BYTES.search(key):
+        raise ValueError(f"bad key {key[:MAX_KEY_BYTES]!r}")
+    return key.decode('utf-8')
+
+
+def _key_bytes(key: str) -> bytes:
+    """Encode and validate a key on the client, before anything is sent."""
+    data = key.encode('utf-8')
+    _check_key(data)
+    return data
+
+
+class CacheServer:
+    """
+    asyncio TCP server exposing one PersistentLRUTTLCache.
+
+    Use as ``async with CacheServer(cache) as server:`` or call start() and
+    stop(). All cache access happens on the server's event loop.
+    """
+
+    def __init__(
+        self,
+        cache: PersistentLRUTTLCache,
+        host: str = "127.0.0.1",
+        port: int = 11211,
+        *,
+        flush_interval: float | None = 30.0,
+        max_value_bytes: int = 1 << 20,
+        max_line_bytes: int = 1 << 16
+    ) -> None:
+        """
+        Args:
+            cache: The cache to serve; its codec must be a PickleCodec
+            host: Interface to bind
+            port: TCP port (0 picks a free port; see .port after start())
+            flush_interval: Seconds between flushes of changed data, or None
+                to flush only on stop()
+            max_value_bytes: Largest value accepted by set
+            max_line_bytes: Longest command line accepted
+
+        Raises:
+            ValueError: If the cache cannot store bytes values
+        """
+        if not isinstance(cache.codec, PickleCodec):
+            raise ValueError("CacheServer needs a cache created with codec=PickleCodec()")
+        if flush_interval is not None and flush_interval <= 0:
+            raise ValueError(f"flush_interval must be > 0, got {flush_interval}")
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+        self.max_value_bytes = max_value_bytes
+        self.max_line_bytes = max_line_bytes
+        self._server: asyncio.AbstractServer | None = None
+        # Connection handler task -> its writer, so stop() can close them
+        self._clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self._flusher: asyncio.Task | None = None
+        self._dirty = False
+        self.connections = 0
+        self.commands = 0
+        self.flushes = 0
+
+    async def start(self) -> None:
+        """Bind and start accepting connections."""
+        self._server = await asyncio.start_server(
+            self._serve, self.host, self.port,
+            limit=max(self.max_line_bytes, 1 << 16)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.flush_interval is not None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """Stop accepting connections, close them and flush once more."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._server is not None:
+            self._server.close()
+            for writer in self._clients.values():
+                writer.close()
+            await asyncio.gather(*self._clients, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+        self.flush()
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def __aenter__(self) -> CacheServer:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.stop()
+
+    def flush(self) -> None:
+        """Persist the cache if anything changed since the last flush."""
+        if self._dirty:
+            self._dirty = False
+            self.cache.flush()
+            self.flushes += 1
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                self._dirty = True
+                print(f"cache_server: flush failed: {e}", file=sys.stderr)
+
+    async def _serve(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        self._clients[asyncio.current_task()] = writer
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b"\r\n")
+                except asyncio.LimitOverrunError:
+                    line = b""
+                if not line or len(line) > self.max_line_bytes:
+                    # Cannot resynchronise inside an oversized line
+                    writer.write(b"CLIENT_ERROR line too long\r\n")
+                    break
+                self.commands += 1
+                if not await self._dispatch(line[:-2].split(), reader, writer):
+                    break
+                # Returns at once below the high-water mark; otherwise stops
+                # reading this client until it consumes its replies
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            self._clients.pop(asyncio.current_task(), None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _dispatch(
+        self,
+        parts: list[bytes],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter
+    ) -> bool:
+        """Handle one command; False closes the connection."""
+        if not parts:
+            writer.write(b"ERROR\r\n")
+            return True
+        cmd = parts[0]
+        if cmd == b"get":
+            self._get(parts[1:], writer)
+        elif cmd == b"gets":
+            self._get(parts[1:], writer, with_cas=True)
+        elif cmd == b"set":
+            await self._set(parts[1:], reader, writer)
+        elif cmd == b"cas":
+            await self._set(parts[1:], reader, writer, cas=True)
+        elif cmd in (b"incr", b"decr"):
+            self._incr(parts[1:], writer, -1 if cmd == b"decr" else 1)
+        elif cmd == b"delete":
+            self._delete(parts[1:], writer)
+        elif cmd == b"version":
+            writer.write(b"VERSION %s\r\n" % VERSION.encode())
+        elif cmd == b"quit":
+            return False
+        else:
+            writer.write(b"ERROR\r\n")
+        return True
+
+    def _get(
+        self,
+        keys: list[bytes],
+        writer: asyncio.StreamWriter,
+        *,
+        with_cas: bool = False
+    ) -> None:
+        if not keys:
+            writer.write(b"ERROR\r\n")
+            return
+        cache = self.cache
+        if with_cas and not cache.versioned:
+            writer.write(b"SERVER_ERROR cache is not versioned\r\n")
+            return
+        # All keys are checked first: an error after some VALUE lines
+        # would leave the reply without its END
+        try:
+            decoded = [_check_key(raw) for raw in keys]
+        except ValueError:
+            writer.write(b"CLIENT_ERROR bad key\r\n")
+            return
+        for raw, key in zip(keys, decoded):
+            found = cache.gets(key) if with_cas else cache.get(key)
+            if found is None:
+                continue
+            value, version = found if with_cas else (found, None)
+            flags, data = value if isinstance(value, tuple) else (0, value)
+            if with_cas:
+                writer.write(b"VALUE %s %d %d %d\r\n" % (raw, flags, len(data), version))
+            else:
+                writer.write(b"VALUE %s %d %d\r\n" % (raw, flags, len(data)))
+            writer.write(data)
+            writer.write(b"\r\n")
+        writer.write(b"END\r\n")
+
+    async def _set(
+        self,
+        args: list[bytes],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        *,
+        cas: bool = False
+    ) -> None:
+        nargs = 5 if cas else 4
+        noreply = len(args) == nargs + 1 and args[nargs] == b"noreply"
+        try:
+            if len(args) != nargs and not noreply:
+                raise ValueError
+            flags, exptime, size = int(args[1]), int(args[2]), int(args[3])
+            version = int(args[4]) if cas else 0
+            if not 0 <= flags < 1 << 32 or size < 0:
+                raise ValueError
+        except ValueError:
+            if not noreply:
+                writer.write(b"CLIENT_ERROR bad command line format\r\n")
+            return
+
+        if size > self.max_value_bytes:
+            await self._skip(reader, size + 2)
+            if not noreply:
+                writer.write(b"SERVER_ERROR object too large for cache\r\n")
+            return
+        data = await reader.readexactly(size + 2)
+        if data[-2:] != b"\r\n":
+            if not noreply:
+                writer.write(b"CLIENT_ERROR bad data chunk\r\n")
+            return
+        try:
+            key = _check_key(args[0])
+        except ValueError:
+            if not noreply:
+                writer.write(b"CLIENT_ERROR bad key\r\n")
+            return
+
+        value = data[:-2]
+        if flags:
+            value = (flags, value)
+        cache = self.cache
+        if not cas:
+            cache.set(key, value, exptime_to_ttl(exptime))
+            reply = b"STORED\r\n"
+        elif not cache.versioned:
+            reply = b"SERVER_ERROR cache is not versioned\r\n"
+        elif cache.cas(key, value, version, exptime_to_ttl(exptime)):
+            reply = b"STORED\r\n"
+        else:
+            reply = b"EXISTS\r\n" if key in cache else b"NOT_FOUND\r\n"
+        self._dirty = self._dirty or reply == b"STORED\r\n"
+        if not noreply:
+            writer.write(reply)
+    
+    def _incr(self, args: list[bytes], writer: asyncio.StreamWriter, sign: int) -> None:
+        noreply = len(args) == 3 and args[2] == b"noreply"
+        if len(args) != 2 and not noreply:
+            writer.write(b"CLIENT_ERROR bad command line format\r\n")
+            return
+        if not args[1].isdigit() or int(args[1]) >= 1 << 64:
+            if not noreply:
+                writer.write(b"CLIENT_ERROR invalid numeric delta argument\r\n")
+            return
+        try:
+            value = self.cache.incr(_check_key(args[0]), sign * int(args[1]))
+        except ValueError:
+            if not noreply:
+                writer.write(b"CLIENT_ERROR bad key\r\n")
+            return
+        except TypeError:
+            if not noreply:
+                writer.write(b"CLIENT_ERROR cannot increment or decrement non-numeric value\r\n")
+            return
+        self._dirty = self._dirty or value is not None
+        if not noreply:
+            writer.write(b"NOT_FOUND\r\n" if value is None else b"%d\r\n" % value)
+
+    def _delete(self, args: list[bytes], writer: asyncio.StreamWriter) -> None:
+        noreply = len(args) == 2 and args[1] == b"noreply"
+        if len(args) != 1 and not noreply:
+            writer.write(b"CLIENT_ERROR bad command line format\r\n")
+            return
+        try:
+            deleted = self.cache.delete(_check_key(args[0]))
+        except ValueError:
+            if not noreply:
+                writer.write(b"CLIENT_ERROR bad key\r\n")
+            return
+        self._dirty = self._dirty or deleted
+        if not noreply:
+            writer.write(b"DELETED\r\n" if deleted else b"NOT_FOUND\r\n")
+
+    async def _skip(self, reader: asyncio.StreamReader, n: int) -> None:
+        """Discard n bytes without buffering them all."""
+        while n:
+            chunk = await reader.read(min(n, 1 << 16))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", n)
+            n -= len(chunk)
+
+
+class _Connection:
+    """One pipelined client connection; replies resolve futures in FIFO order."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._pending: deque[tuple[asyncio.Future, str]] = deque()
+        self.closed = False
+        self._task = asyncio.create_task(self._read_replies())
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def request(self, payload: bytes | Iterable[bytes], kind: str | None) -> Any:
+        """
+        Send one command; kind selects the reply parser ("get", "gets" or
+        "line"), None for noreply commands.
+        """
+        if self.closed:
+            raise ConnectionError("connection closed")
+        fut = None
+        if kind is not None:
+            fut = asyncio.get_running_loop().create_future()
+            self._pending.append((fut, kind))
+        if isinstance(payload, bytes):
+            self._writer.write(payload)
+        else:
+            self._writer.writelines(payload)
+        await self._writer.drain()
+        return await fut if fut is not None else None
+
+    async def _read_replies(self) -> None:
+        reader = self._reader
+        try:
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                fut, kind = self._pending.popleft()
+                if line.startswith((b"ERROR", b"CLIENT_ERROR", b"SERVER_ERROR")):
+                    result: Any = CacheClientError(line[:-2].decode(errors="replace"))
+                elif kind in ("get", "gets"):
+                    result = {}
+                    while line.startswith(b"VALUE "):
+                        fields = line.split()
+                        data = await reader.readexactly(int(fields[3]) + 2)
+                        result[fields[1].decode('utf-8')] = (
+                            (data[:-2], int(fields[4])) if kind == "gets" else data[:-2]
+                        )
+                        line = await reader.readuntil(b"\r\n")
+                    if line != b"END\r\n":
+                        raise CacheClientError(f"unexpected reply {line!r}")
+                else:
+                    result = line[:-2]
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+        except (asyncio.IncompleteReadError, ConnectionError, CacheClientError,
+                IndexError, ValueError) as e:
+            self._fail(e)
+        except asyncio.CancelledError:
+            self._fail(ConnectionError("connection closed"))
+            raise
+
+    def _fail(self, cause: BaseException) -> None:
+        self.closed = True
+        while self._pending:
+            fut, _ = self._pending.popleft()
+            if not fut.done():
+                err = ConnectionError(f"connection lost: {cause!r}")
+                err.__cause__ = cause
+                fut.set_exception(err)
+        self._writer.close()
+
+    async def close(self) -> None:
+        self.closed = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class CacheClient:
+    """
+    Pooled, pipelining asyncio client for CacheServer (or memcached).
+
+    Up to pool_size connections are opened on demand and reused; each
+    request goes to the least-busy connection, and concurrent requests on
+    one connection are pipelined rather than waiting for each reply.
+    Broken connections are dropped and replaced on the next request.
+    Keys are validated before sending (ValueError), so a bad key never
+    earns a server error that a noreply request would leave unmatched.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 11211, *, pool_size: int = 4) -> None:
+        if pool_size < 1:
+            raise ValueError(f"pool_size must be >= 1, got {pool_size}")
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self._conns: list[_Connection] = []
+        self._opening = 0
+        self.connects = 0
+
+    async def _connection(self) -> _Connection:
+        while True:
+            self._conns = [c for c in self._conns if not c.closed]
+            full = len(self._conns) + self._opening >= self.pool_size
+            idle = min(self._conns, key=lambda c: c.in_flight, default=None)
+            if idle is not None and (idle.in_flight == 0 or full):
+                return idle
+            if not full:
+                break
+            # Every slot is still connecting; wait rather than exceed the pool
+            await asyncio.sleep(0)
+        self._opening += 1
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        finally:
+            self._opening -= 1
+        conn = _Connection(reader, writer)
+        self._conns.append(conn)
+        self.connects += 1
+        return conn
+
+    async def get(self, key: str) -> bytes | None:
+        """Value for key, or None on a miss."""
+        return (await self.get_many([key])).get(key)
+
+    async def get_many(self, keys: Iterable[str]) -> dict[str, bytes]:
+        """
+        Values for the keys that hit. Keys go out GET_BATCH_KEYS per get
+        line, all batches pipelined, so this costs one round trip.
+        """
+        encoded = [_key_bytes(key) for key in keys]
+        result: dict[str, bytes] = {}
+        pending = []
+        for i in range(0, len(encoded), GET_BATCH_KEYS):
+            line = b"get " + b" ".join(encoded[i:i + GET_BATCH_KEYS]) + b"\r\n"
+            conn = await self._connection()
+            pending.append(conn.request(line, "get"))
+        for part in await asyncio.gather(*pending):
+            result.update(part)
+        return result
+
+    async def set(
+        self,
+        key: str,
+        value: bytes,
+        ttl_seconds: float | None = None,
+        *,
+        noreply: bool = False
+    ) -> bool:
+        """Store value; with noreply the request is sent without waiting."""
+        header = b"set %s 0 %d %d%s\r\n" % (
+            _key_bytes(key), ttl_to_exptime(ttl_seconds), len(value),
+            b" noreply" if noreply else b"",
+        )
+        conn = await self._connection()
+        reply = await conn.request((header, value, b"\r\n"), None if noreply else "line")
+        return noreply or reply == b"STORED"
+
+    async def gets(self, key: str) -> tuple[bytes, int] | None:
+        """(value, cas unique) for a later cas(), or None on a miss."""
+        conn = await self._connection()
+        found = await conn.request(b"gets %s\r\n" % _key_bytes(key), "gets")
+        return found.get(key)
+
+    async def cas(
+        self,
+        key: str,
+        value: bytes,
+        version: int,
+        ttl_seconds: float | None = None
+    ) -> bool:
+        """Store value only if the key still has ``version`` (from gets())."""
+        header = b"cas %s 0 %d %d %d\r\n" % (
+            _key_bytes(key), ttl_to_exptime(ttl_seconds), len(value), version
+        )
+        conn = await self._connection()
+        return await conn.request((header, value, b"\r\n"), "line") == b"STORED"
+
+    async def incr(self, key: str, delta: int = 1) -> int | None:
+        """New value, or None if the key is missing."""
+        return await self._incr(b"incr", key, delta)
+
+    async def decr(self, key: str, delta: int = 1) -> int | None:
+        """New value (not below 0), or None if the key is missing."""
+        return await self._incr(b"decr", key, delta)
+
+    async def _incr(self, cmd: bytes, key: str, delta: int) -> int | None:
+        conn = await self._connection()
+        reply = await conn.request(b"%s %s %d\r\n" % (cmd, _key_bytes(key), delta), "line")
+        return None if reply == b"NOT_FOUND" else int(reply)
+
+    async def delete(self, key: str) -> bool:
+        """True if the key existed."""
+        conn = await self._connection()
+        return await conn.request(b"delete %s\r\n" % _key_bytes(key), "line") == b"DELETED"
+
+    async def version(self) -> str:
+        conn = await self._connection()
+        return (await conn.request(b"version\r\n", "line")).decode().split(" ", 1)[1]
+
+    async def close(self) -> None:
+        conns, self._conns = self._conns, []
+        for conn in conns:
+            await conn.close()
+
+    async def __aenter__(self) -> CacheClient:
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+
+class HashRing:
+    """
+    Consistent-hash ring with virtual nodes.
+
+    Each node is placed at ``vnodes`` pseudo-random points (64-bit blake2b
+    of "<node>#<i>"); a key belongs to the first point at or after its own
+    hash, wrapping around. More vnodes give a more even split.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), *, vnodes: int = 160) -> None:
+        if vnodes < 1:
+            raise ValueError(f"vnodes must be >= 1, got {vnodes}")
+        self.vnodes = vnodes
+        self._points: list[int] = []
+        self._owners: list[str] = []
+        self._nodes: set[str] = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(data: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(data.encode('utf-8'), digest_size=8).digest(), 'big'
+        )
+
+    def add(self, node: str) -> None:
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.vnodes):
+            point = self._hash(f"{node}#{i}")
+            at = bisect_right(self._points, point)
+            self._points.insert(at, point)
+            self._owners.insert(at, node)
+
+    def remove(self, node: str) -> None:
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != node]
+        self._points = [p for p, _ in keep]
+        self._owners = [o for _, o in keep]
+
+    @property
+    def nodes(self) -> list[str]:
+        return sorted(self._nodes)
+
+    def node_for(self, key: str) -> str:
+        """
+        Raises:
+            LookupError: If the ring is empty
+        """
+        if not self._points:
+            raise LookupError("hash ring has no nodes")
+        at = bisect_left(self._points, self._hash(key))
+        return self._owners[at if at < len(self._points) else 0]
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+
+class ShardedCacheClient:
+    """
+    Client for several CacheServer nodes, keyed by a HashRing.
+
+    Nodes are "host:port" strings, each with its own pooled CacheClient.
+    get_many() groups keys by node and queries the nodes concurrently.
+    Removing a node closes its client; its keys become misses elsewhere.
+    """
+
+    def __init__(
+        self,
+        nodes: Iterable[str],
+        *,
+        vnodes: int = 160,
+        pool_size: int = 4
+    ) -> None:
+        self.pool_size = pool_size
+        self.ring = HashRing(vnodes=vnodes)
+        self._clients: dict[str, CacheClient] = {}
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node: str) -> None:
+        if node in self._clients:
+            return
+        host, _, port = node.rpartition(":")
+        self._clients[node] = CacheClient(host, int(port), pool_size=self.pool_size)
+        self.ring.add(node)
+
+    async def remove_node(self, node: str) -> None:
+        client = self._clients.pop(node, None)
+        if client is not None:
+            self.ring.remove(node)
+            await client.close()
+
+    def client_for(self, key: str) -> CacheClient:
+        return self._clients[self.ring.node_for(key)]
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client_for(key).get(key)
+
+    async def get_many(self, keys: Iterable[str]) -> dict[str, bytes]:
+        by_node: dict[str, list[str]] = {}
+        for key in keys:
+            by_node.setdefault(self.ring.node_for(key), []).append(key)
+        parts = await asyncio.gather(*(
+            self._clients[node].get_many(node_keys)
+            for node, node_keys in by_node.items()
+        ))
+        result: dict[str, bytes] = {}
+        for part in parts:
+            result.update(part)
+        return result
+
+    async def set(
+        self,
+        key: str,
+        value: bytes,
+        ttl_seconds: float | None = None,
+        *,
+        noreply: bool = False
+    ) -> bool:
+        return await self.client_for(key).set(key, value, ttl_seconds, noreply=noreply)
+
+    async def gets(self, key: str) -> tuple[bytes, int] | None:
+        return await self.client_for(key).gets(key)
+
+    async def cas(
+        self,
+        key: str,
+        value: bytes,
+        version: int,
+        ttl_seconds: float | None = None
+    ) -> bool:
+        return await self.client_for(key).cas(key, value, version, ttl_seconds)
+
+    async def incr(self, key: str, delta: int = 1) -> int | None:
+        return await self.client_for(key).incr(key, delta)
+
+    async def decr(self, key: str, delta: int = 1) -> int | None:
+        return await self.client_for(key).decr(key, delta)
+
+    async def delete(self, key: str) -> bool:
+        return await self.client_for(key).delete(key)
+
+    async def close(self) -> None:
+        for client in self._clients.values():
+            await client.close()
+
+    async def __aenter__(self) -> ShardedCacheClient:
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11211)
+    parser.add_argument("--path", default="cache_server.bin", help="persistence file")
+    parser.add_argument("--max-size", type=int, default=100_000)
+    parser.add_argument("--flush-interval", type=float, default=30.0)
+    parser.add_argument("--test", action="store_true", help="run the self-tests")
+    args = parser.parse_args(argv)
+
+    if args.test:
+        return 0 if run_tests() else 1
+
+    cache = PersistentLRUTTLCache(
+        args.max_size, args.path, codec=PickleCodec(), versioned=True
+    )
+    server = CacheServer(cache, args.host, args.port, flush_interval=args.flush_interval)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+# =============================================================================
+# TEST SUITE
+# =============================================================================
+
+import os
+import tempfile
+import unittest
+from unittest import TestCase
+
+from cache_v3 import MockClock
+
+
+class _ServerTestCase(TestCase):
+    """Runs each test coroutine against a fresh server on a free port."""
+
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.bin')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _cache(self, max_size: int = 1000) -> PersistentLRUTTLCache:
+        return PersistentLRUTTLCache(
+            max_size, self.path, now_fn=self.clock, codec=PickleCodec(), versioned=True
+        )
+
+    def run_with_server(self, test, **kwargs):
+        async def runner():
+            kwargs.setdefault("flush_interval", None)
+            server = CacheServer(self._cache(), port=0, **kwargs)
+            async with server:
+                await test(server)
+            return server
+        return asyncio.run(runner())
+
+    async def raw(self, server: CacheServer, payload: bytes, replies: int) -> list[bytes]:
+        """Send payload in one write and read ``replies`` lines back."""
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        writer.write(payload)
+        await writer.drain()
+        lines = [await reader.readuntil(b"\r\n") for _ in range(replies)]
+        writer.close()
+        await writer.wait_closed()
+        return lines
+
+
+class TestProtocol(_ServerTestCase):
+
+    def test_ttl_conversion(self):
+        self.assertIsNone(exptime_to_ttl(0))
+        self.assertEqual(exptime_to_ttl(60), 60.0)
+        self.assertLessEqual(exptime_to_ttl(-5), 0)
+        self.assertAlmostEqual(exptime_to_ttl(2_000_000_000, now=1_999_999_000), 1000.0)
+        self.assertEqual(ttl_to_exptime(1.2), 2)
+        self.assertEqual(ttl_to_exptime(None), 0)
+        self.assertEqual(ttl_to_exptime(RELATIVE_EXPTIME_MAX + 1, now=10), RELATIVE_EXPTIME_MAX + 11)
+
+    def test_pipelined_raw_commands(self):
+        async def test(server):
+            lines = await self.raw(server, (
+                b"set a 5 0 3\r\nabc\r\n"
+                b"set b 0 0 0 noreply\r\n\r\n"
+                b"get a b missing\r\n"
+                b"delete a\r\n"
+                b"delete a\r\n"
+                b"bogus\r\n"
+            ), 9)
+            self.assertEqual(lines, [
+                b"STORED\r\n",
+                b"VALUE a 5 3\r\n", b"abc\r\n", b"VALUE b 0 0\r\n", b"\r\n", b"END\r\n",
+                b"DELETED\r\n", b"NOT_FOUND\r\n", b"ERROR\r\n",
+            ])
+        self.run_with_server(test)
+
+    def test_errors_keep_connection_usable(self):
+        async def test(server):
+            lines = await self.raw(server, (
+                b"set k x 0 1\r\n"
+                b"set k 0 0 1\r\nab\r\n"
+                b"set k 0 0 20\r\n" + b"x" * 20 + b"\r\n"
+                b"set " + b"k" * 300 + b" 0 0 1\r\nx\r\n"
+                b"version\r\n"
+            ), 5)
+            self.assertEqual(lines[0], b"CLIENT_ERROR bad command line format\r\n")
+            self.assertEqual(lines[1], b"CLIENT_ERROR bad data chunk\r\n")
+            self.assertEqual(lines[2], b"SERVER_ERROR object too large for cache\r\n")
+            self.assertEqual(lines[3], b"CLIENT_ERROR bad key\r\n")
+            self.assertTrue(lines[4].startswith(b"VERSION "))
+            # A bad key anywhere in a multi-get fails it before any VALUE
+            lines = await self.raw(server, (
+                b"set a 0 0 1\r\nx\r\n"
+                b"get a " + b"k" * 300 + b"\r\n"
+                b"version\r\n"
+            ), 3)
+            self.assertEqual(lines[1], b"CLIENT_ERROR bad key\r\n")
+            self.assertTrue(lines[2].startswith(b"VERSION "))
+            # noreply silences errors too: only "version" is answered
+            lines = await self.raw(server, (
+                b"set " + b"k" * 300 + b" 0 0 1 noreply\r\nx\r\n"
+                b"set k 0 0 20 noreply\r\n" + b"x" * 20 + b"\r\n"
+                b"incr a x noreply\r\n"
+                b"delete " + b"k" * 300 + b" noreply\r\n"
+                b"version\r\n"
+            ), 1)
+            self.assertTrue(lines[0].startswith(b"VERSION "))
+            lines = await self.raw(server, b"get " + b"k " * 40_000 + b"\r\n", 1)
+            self.assertEqual(lines[0], b"CLIENT_ERROR line too long\r\n")
+        self.run_with_server(test, max_value_bytes=10)
+
+    def test_cas_and_counters(self):
+        async def test(server):
+            lines = await self.raw(server, (
+                b"set c 0 0 2\r\n10\r\n"
+                b"incr c 5\r\n"
+                b"decr c 100\r\n"
+                b"incr missing 1\r\n"
+                b"incr c x\r\n"
+                b"set t 0 0 1\r\nx\r\n"
+                b"incr t 1\r\n"
+                b"gets t\r\n"
+            ), 10)
+            self.assertEqual(lines[:7], [
+                b"STORED\r\n", b"15\r\n", b"0\r\n", b"NOT_FOUND\r\n",
+                b"CLIENT_ERROR invalid numeric delta argument\r\n", b"STORED\r\n",
+                b"CLIENT_ERROR cannot increment or decrement non-numeric value\r\n",
+            ])
+            version = int(lines[7].split()[4])
+            lines = await self.raw(server, (
+                b"cas t 0 0 1 %d\r\ny\r\n"
+                b"cas t 0 0 1 %d\r\nz\r\n"
+                b"cas gone 0 0 1 1\r\nz\r\n"
+                b"get t\r\n" % (version, version)
+            ), 6)
+            self.assertEqual(lines, [
+                b"STORED\r\n", b"EXISTS\r\n", b"NOT_FOUND\r\n",
+                b"VALUE t 0 1\r\n", b"y\r\n", b"END\r\n",
+            ])
+        self.run_with_server(test)
+
+    def test_cas_needs_versioned_cache(self):
+        async def test(server):
+            lines = await self.raw(server, b"gets k\r\ncas k 0 0 1 1\r\nx\r\nversion\r\n", 3)
+            self.assertEqual(lines[:2], [b"SERVER_ERROR cache is not versioned\r\n"] * 2)
+            self.assertTrue(lines[2].startswith(b"VERSION "))
+
+        async def runner():
+            cache = PersistentLRUTTLCache(10, self.path, codec=PickleCodec())
+            async with CacheServer(cache, port=0, flush_interval=None) as server:
+                await test(server)
+        asyncio.run(runner())
+
+    def test_rejects_json_cache(self):
+        cache = PersistentLRUTTLCache(10, self.path)
+        with self.assertRaises(ValueError):
+            CacheServer(cache)
+
+
+class TestClient(_ServerTestCase):
+
+    def test_basic_operations_and_ttl(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port, pool_size=2) as client:
+                self.assertTrue(await client.set("k", b"v" * 5000))
+                self.assertEqual(await client.get("k"), b"v" * 5000)
+                self.assertIsNone(await client.get("missing"))
+                self.assertTrue(await client.set("t", b"1", ttl_seconds=10))
+                self.clock.advance(11)
+                self.assertIsNone(await client.get("t"))
+                self.assertTrue(await client.delete("k"))
+                self.assertFalse(await client.delete("k"))
+                self.assertEqual(await client.version(), VERSION)
+        self.run_with_server(test)
+
+    def test_concurrent_requests_pipeline_over_pool(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port, pool_size=2) as client:
+                stored = await asyncio.gather(*(
+                    client.set(f"k{i}", str(i).encode()) for i in range(200)
+                ))
+                self.assertTrue(all(stored))
+                values = await asyncio.gather(*(client.get(f"k{i}") for i in range(200)))
+                self.assertEqual(values, [str(i).encode() for i in range(200)])
+                many = await client.get_many(f"k{i}" for i in range(0, 200, 7))
+                self.assertEqual(len(many), 29)
+                self.assertLessEqual(client.connects, 2)
+                self.assertLessEqual(server.connections, 2)
+        self.run_with_server(test)
+
+    def test_noreply_is_ordered_on_one_connection(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port, pool_size=1) as client:
+                for i in range(100):
+                    await client.set(f"k{i}", b"x", noreply=True)
+                self.assertEqual(len(await client.get_many(f"k{i}" for i in range(100))), 100)
+        self.run_with_server(test)
+
+    def test_bad_keys_rejected_before_sending(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port, pool_size=1) as client:
+                for key in ("k" * 251, "a b", "tab\t", "nl\n", "", "\x7f"):
+                    with self.assertRaises(ValueError):
+                        await client.set(key, b"x", noreply=True)
+                    with self.assertRaises(ValueError):
+                        await client.get_many(["ok", key])
+                    with self.assertRaises(ValueError):
+                        await client.delete(key)
+                    with self.assertRaises(ValueError):
+                        await client.incr(key)
+                self.assertEqual(server.commands, 0)
+                # Nothing unmatched is left on the connection
+                self.assertTrue(await client.set("k" * 250, b"x"))
+                self.assertEqual(await client.get("k" * 250), b"x")
+        self.run_with_server(test)
+
+    def test_concurrent_counters_and_cas(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port, pool_size=4) as client:
+                await client.set("hits", b"0")
+                await asyncio.gather(*(client.incr("hits") for _ in range(200)))
+                self.assertEqual(await client.get("hits"), b"200")
+                self.assertIsNone(await client.decr("missing"))
+
+                await client.set("list", b"")
+                retries = 0
+
+                async def append(item: bytes) -> None:
+                    nonlocal retries
+                    while True:
+                        value, version = await client.gets("list")
+                        await asyncio.sleep(0)  # Let other writers interleave
+                        if await client.cas("list", value + item, version):
+                            return
+                        retries += 1
+
+                await asyncio.gather(*(append(b"%d," % i) for i in range(20)))
+                items = (await client.get("list")).decode().rstrip(",").split(",")
+                self.assertEqual(sorted(map(int, items)), list(range(20)))
+                self.assertGreater(retries, 0)
+        self.run_with_server(test)
+
+    def test_client_error_and_reconnect(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port, pool_size=1) as client:
+                self.assertTrue(await client.set("k", b"x"))
+                with self.assertRaises(CacheClientError):
+                    await client.incr("k")
+                self.assertTrue(await client.set("k", b"x"))
+                client._conns[0]._writer.close()  # Simulate a dropped connection
+                await asyncio.sleep(0.05)
+                self.assertEqual(await client.get("k"), b"x")
+                self.assertEqual(client.connects, 2)
+        self.run_with_server(test)
+
+    def test_flushes_periodically_and_on_stop(self):
+        async def test(server):
+            async with CacheClient(server.host, server.port) as client:
+                await client.set("k", b"persisted")
+                for _ in range(100):
+                    if server.flushes:
+                        break
+                    await asyncio.sleep(0.01)
+            self.assertEqual(server.flushes, 1)
+        self.run_with_server(test, flush_interval=0.01)
+        self.assertEqual(bytes(self._cache().get("k")), b"persisted")
+
+        async def delete(server):
+            async with CacheClient(server.host, server.port) as client:
+                await client.delete("k")
+        server = self.run_with_server(delete)
+        self.assertEqual(server.flushes, 1)  # The final flush on stop()
+        self.assertIsNone(self._cache().get("k"))
+
+
+def _serve_in_process(path: str, conn) -> None:
+    """Child process body: run a server on a free port and report the port."""
+    async def serve():
+        cache = PersistentLRUTTLCache(100_000, path, codec=PickleCodec())
+        server = CacheServer(cache, port=0, flush_interval=None)
+        await server.start()
+        conn.send(server.port)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+class TestHashRing(TestCase):
+
+    def test_balance_and_minimal_movement(self):
+        keys = [f"user:{i}" for i in range(20_000)]
+        ring = HashRing([f"10.0.0.{i}:11211" for i in range(4)])
+        before = {k: ring.node_for(k) for k in keys}
+        counts: dict[str, int] = {}
+        for node in before.values():
+            counts[node] = counts.get(node, 0) + 1
+        mean = len(keys) / 4
+        self.assertTrue(all(abs(c - mean) / mean < 0.2 for c in counts.values()), counts)
+
+        ring.add("10.0.0.4:11211")
+        moved = [k for k in keys if ring.node_for(k) != before[k]]
+        self.assertTrue(all(ring.node_for(k) == "10.0.0.4:11211" for k in moved))
+        self.assertLess(len(moved) / len(keys), 0.3)  # ~1/5 expected
+
+        ring.remove("10.0.0.4:11211")
+        self.assertEqual({k: ring.node_for(k) for k in keys}, before)
+
+    def test_empty_ring(self):
+        with self.assertRaises(LookupError):
+            HashRing().node_for("k")
+        with self.assertRaises(ValueError):
+            HashRing(vnodes=0)
+
+
+class TestShardedClient(TestCase):
+    """Three server processes on localhost behind one ShardedCacheClient."""
+
+    def setUp(self):
+        import multiprocessing
+        ctx = multiprocessing.get_context("spawn")
+        self.dir = tempfile.mkdtemp()
+        self.procs = []
+        self.nodes = []
+        for i in range(3):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(
+                target=_serve_in_process,
+                args=(os.path.join(self.dir, f"node{i}.bin"), child),
+                daemon=True,
+            )
+            proc.start()
+            self.procs.append(proc)
+            if not parent.poll(30):
+                self.fail("server process did not start")
+            self.nodes.append(f"127.0.0.1:{parent.recv()}")
+
+    def tearDown(self):
+        import shutil
+        for proc in self.procs:
+            proc.terminate()
+            proc.join(5)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_balanced_load_and_fan_out(self):
+        keys = [f"k{i}" for i in range(3000)]
+
+        async def run():
+            async with ShardedCacheClient(self.nodes, pool_size=2) as client:
+                await asyncio.gather(*(client.set(k, k.encode()) for k in keys))
+                self.assertEqual(await client.get_many(keys), {k: k.encode() for k in keys})
+                self.assertEqual(await client.get("k7"), b"k7")
+
+                # Each node holds exactly the keys the ring gives it
+                per_node = []
+                for node in self.nodes:
+                    host, _, port = node.rpartition(":")
+                    async with CacheClient(host, int(port)) as direct:
+                        held = await direct.get_many(keys)
+                    self.assertEqual(
+                        set(held), {k for k in keys if client.ring.node_for(k) == node}
+                    )
+                    per_node.append(len(held))
+                # Ports (hence ring points) vary per run; 160 vnodes keep the
+                # spread around 8%, so 30% leaves a wide margin
+                self.assertTrue(all(700 < n < 1300 for n in per_node), per_node)
+
+                await client.remove_node(self.nodes[0])
+                self.assertEqual(len(client.ring), 2)
+                hits = await client.get_many(keys)
+                self.assertEqual(len(hits), per_node[1] + per_node[2])
+
+        asyncio.run(run())
+
+
+def run_tests():
+    """Run all tests."""
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(loader.loadTestsFromTestCase(TestProtocol))
+    suite.addTests(loader.loadTestsFromTestCase(TestClient))
+    suite.addTests(loader.loadTestsFromTestCase(TestHashRing))
+    suite.addTests(loader.loadTestsFromTestCase(TestShardedClient))
+
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+
+    return result.wasSuccessful()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
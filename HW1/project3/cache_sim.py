@@ -0,0 +1,430 @@
+"""
+Cache Simulator: offline trace replay for sizing PersistentLRUTTLCache.
+
+Streams a captured access trace through one or more cache configurations
+and reports hit ratio, byte hit ratio, evictions and expirations for each,
+so max_size and TTLs can be chosen from real traffic.
+
+Trace format (CSV, one request per line, '#' starts a comment):
+    timestamp,op,key[,size[,ttl]]
+
+    timestamp: epoch seconds (float), non-decreasing
+    op:        get | set | delete
+    key:       cache key (string; surrounding spaces are stripped; quote
+               it CSV-style, "a,b", if it contains a comma)
+    size:      object size in bytes (default 1); used for byte hit ratio
+    ttl:       TTL in seconds for 'set' (empty = config default)
+
+Files ending in .gz are decompressed on the fly.
+
+Design Decisions:
+- Streaming: the trace is read line by line and never materialised
+- Time: each cache gets a CoarseClock whose ``now`` is set to the trace
+  timestamp before every request, so hours of traffic replay in seconds
+  with exact TTL semantics
+- Read-through: by default a 'get' miss inserts the object (with the
+  config's default TTL), modelling a look-aside cache in front of a backend
+- Parallelism: each configuration replays the trace in its own process
+- Counters: evictions/expirations come from the cache's own CacheStats
+
+Usage:
+    python cache_sim.py trace.csv --sizes 1000 10000 100000 --ttls none 60 300
+    python cache_sim.py trace.csv.gz --sizes 50000 --processes 8 --output sim.jsonl
+
+License: MIT
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Iterator, TextIO
+
+from cache_v3 import CacheStats, CoarseClock, PersistentLRUTTLCache
+
+
+OPS = ("get", "set", "delete")
+
+
+@dataclass(frozen=True)
+class SimConfig:
+    """
+    One cache configuration to evaluate.
+
+    Attributes:
+        max_size: Cache capacity in entries
+        ttl_seconds: Default TTL for inserts without an explicit trace TTL
+        read_through: Insert on 'get' miss (look-aside cache behaviour)
+        name: Label for reports (default derived from the other fields)
+    """
+    max_size: int
+    ttl_seconds: float | None = None
+    read_through: bool = True
+    name: str = ""
+
+    @property
+    def label(self) -> str:
+        if self.name:
+            return self.name
+        ttl = "none" if self.ttl_seconds is None else f"{self.ttl_seconds:g}s"
+        return f"size={self.max_size},ttl={ttl}"
+
+
+@dataclass
+class TraceRecord:
+    """One parsed trace line."""
+    timestamp: float
+    op: str
+    key: str
+    size: int = 1
+    ttl: float | None = None
+
+
+def _open_trace(path: str) -> TextIO:
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def parse_line(line: str) -> TraceRecord | None:
+    """
+    Parse one trace line.
+
+    Returns:
+        TraceRecord, or None for blank/comment/malformed lines
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    # csv only when needed: quoted fields are rare and csv is slower
+    fields = line.split(',') if '"' not in line else next(csv.reader([line]))
+    key = fields[2].strip() if 3 <= len(fields) <= 5 else ""
+    if not key:
+        return None
+    try:
+        timestamp = float(fields[0])
+        op = fields[1].strip().lower()
+        if op not in OPS:
+            return None
+        size = int(fields[3]) if len(fields) > 3 and fields[3] else 1
+        ttl = float(fields[4]) if len(fields) > 4 and fields[4] else None
+    except ValueError:
+        return None
+    return TraceRecord(timestamp, op, key, size, ttl)
+
+
+def iter_trace(path: str, skipped: list[int] | None = None) -> Iterator[TraceRecord]:
+    """
+    Stream parsed records from a trace file.
+
+    Args:
+        path: Trace path (.gz supported)
+        skipped: Optional one-element list incremented per malformed line
+    """
+    with _open_trace(path) as f:
+        for line in f:
+            record = parse_line(line)
+            if record is None:
+                if skipped is not None and line.strip() and not line.lstrip().startswith('#'):
+                    skipped[0] += 1
+                continue
+            yield record
+
+
+def simulate(trace_path: str, config: SimConfig) -> dict:
+    """
+    Replay a trace against one configuration.
+
+    Returns:
+        Result dict with hit/byte-hit ratios, evictions and expirations
+    """
+    clock = CoarseClock(source=lambda: 0.0)
+    stats = CacheStats(sample_every=1 << 30)  # Counters only, no timing
+    skipped = [0]
+
+    requests = hits = 0
+    bytes_requested = bytes_hit = 0
+    sets = deletes = 0
+    first_ts: float | None = None
+    last_ts = 0.0
+    started = time.perf_counter()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=config.max_size,
+            persist_path=os.path.join(tmp, "sim.json"),
+            coarse_clock=clock,
+            stats=stats,
+        )
+        default_ttl = config.ttl_seconds
+        read_through = config.read_through
+
+        for rec in iter_trace(trace_path, skipped):
+            clock.now = rec.timestamp
+            if first_ts is None:
+                first_ts = rec.timestamp
+            last_ts = rec.timestamp
+
+            if rec.op == "get":
+                requests += 1
+                bytes_requested += rec.size
+                # Cached value is the object size, for byte accounting
+                if cache.get(rec.key) is not None:
+                    hits += 1
+                    bytes_hit += rec.size
+                elif read_through:
+                    cache.set(rec.key, rec.size, default_ttl)
+            elif rec.op == "set":
+                sets += 1
+                ttl = rec.ttl if rec.ttl is not None else default_ttl
+                cache.set(rec.key, rec.size, ttl)
+            else:
+                deletes += 1
+                cache.delete(rec.key)
+
+    return {
+        "config": config.label,
+        **asdict(config),
+        "requests": requests,
+        "hits": hits,
+        "hit_ratio": hits / requests if requests else 0.0,
+        "bytes_requested": bytes_requested,
+        "bytes_hit": bytes_hit,
+        "byte_hit_ratio": bytes_hit / bytes_requested if bytes_requested else 0.0,
+        "sets": sets,
+        "deletes": deletes,
+        "evictions": stats.evictions,
+        "expirations": stats.expired_on_read + stats.expired_pruned,
+        "admission_rejects": stats.admission_rejects,
+        "skipped_lines": skipped[0],
+        "trace_seconds": (last_ts - first_ts) if first_ts is not None else 0.0,
+        "wall_seconds": time.perf_counter() - started,
+    }
+
+
+def _simulate_args(args: tuple[str, SimConfig]) -> dict:
+    return simulate(*args)
+
+
+def simulate_many(
+    trace_path: str,
+    configs: list[SimConfig],
+    processes: int | None = None
+) -> list[dict]:
+    """
+    Replay a trace against several configurations in parallel processes.
+
+    Each worker streams the trace independently; results keep config order.
+
+    Args:
+        trace_path: Trace file
+        configs: Configurations to evaluate
+        processes: Worker count (default: min(len(configs), cpu_count));
+            1 runs everything in this process
+    """
+    if processes is None:
+        processes = min(len(configs), os.cpu_count() or 1)
+    if processes <= 1 or len(configs) <= 1:
+        return [simulate(trace_path, c) for c in configs]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_simulate_args, [(trace_path, c) for c in configs]))
+
+
+def _parse_ttl(text: str) -> float | None:
+    """'none' or 'inf' means no TTL; anything else must be seconds > 0."""
+    try:
+        ttl = float(text)
+    except ValueError:
+        ttl = None
+        if text.lower() != "none":
+            raise argparse.ArgumentTypeError(f"invalid TTL: {text!r}")
+    if ttl is None or ttl == float("inf"):
+        return None
+    if not ttl > 0:  # Also rejects NaN
+        raise argparse.ArgumentTypeError(f"TTL must be > 0 seconds, got {text!r}")
+    return ttl
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("trace", nargs="?", help="trace file (CSV, optionally .gz)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--ttls", type=_parse_ttl, nargs="+", default=[None],
+                        help="default TTLs in seconds, > 0 ('none' or 'inf' for no TTL)")
+    parser.add_argument("--no-read-through", action="store_true",
+                        help="only 'set' records insert entries")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output", help="write JSON Lines here instead of stdout")
+    parser.add_argument("--test", action="store_true", help="run the self-tests")
+    args = parser.parse_args(argv)
+
+    if args.test:
+        return 0 if run_tests() else 1
+    if not args.trace:
+        parser.error("trace is required")
+
+    configs = [
+        SimConfig(max_size=size, ttl_seconds=ttl, read_through=not args.no_read_through)
+        for size in args.sizes
+        for ttl in args.ttls
+    ]
+    results = simulate_many(args.trace, configs, args.processes)
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+# =============================================================================
+# TEST SUITE
+# =============================================================================
+
+import unittest
+from unittest import TestCase
+
+
+def _write_trace(lines: list[str], suffix: str = ".csv") -> str:
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    data = ("\n".join(lines) + "\n").encode('utf-8')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(gzip.compress(data) if suffix.endswith(".gz") else data)
+    return path
+
+
+class TestTraceParsing(TestCase):
+    """Trace lines are parsed leniently and streamed."""
+
+    def test_parse_fields(self):
+        rec = parse_line("12.5,SET,user:1,300,60")
+        self.assertEqual(rec, TraceRecord(12.5, "set", "user:1", 300, 60.0))
+        self.assertEqual(parse_line("1,get,k"), TraceRecord(1.0, "get", "k", 1, None))
+        self.assertEqual(parse_line("1, get , k ,2"), TraceRecord(1.0, "get", "k", 2, None))
+        self.assertEqual(
+            parse_line('1,set,"a,b",10,5'), TraceRecord(1.0, "set", "a,b", 10, 5.0)
+        )
+        # An unquoted comma leaves too many or non-numeric fields
+        self.assertIsNone(parse_line("1,set,a,b,10,5"))
+        self.assertIsNone(parse_line("1,get,a,b"))
+        self.assertIsNone(parse_line("1,get, "))
+
+    def test_skips_comments_and_malformed(self):
+        path = _write_trace(["# header", "", "1,get,a", "bad line", "2,frob,a", "x,get,a"])
+        try:
+            skipped = [0]
+            records = list(iter_trace(path, skipped))
+            self.assertEqual(len(records), 1)
+            self.assertEqual(skipped[0], 3)
+        finally:
+            os.unlink(path)
+
+    def test_parse_ttl(self):
+        for text in ("none", "NONE", "inf", "Infinity"):
+            self.assertIsNone(_parse_ttl(text))
+        self.assertEqual(_parse_ttl("60"), 60.0)
+        self.assertEqual(_parse_ttl("0.5"), 0.5)
+        for text in ("0", "-5", "nan", "-inf", "soon"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                _parse_ttl(text)
+
+    def test_gzip_trace(self):
+        path = _write_trace(["1,get,a", "2,get,a"], suffix=".csv.gz")
+        try:
+            self.assertEqual(len(list(iter_trace(path))), 2)
+        finally:
+            os.unlink(path)
+
+
+class TestSimulation(TestCase):
+    """Replay drives the cache through trace time."""
+
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except (AttributeError, OSError):
+            pass
+
+    def test_hit_ratio_and_evictions(self):
+        """Read-through LRU of size 2 over a cyclic pattern of 3 keys."""
+        self.path = _write_trace([f"{i},get,{'abc'[i % 3]},10" for i in range(9)])
+        small = simulate(self.path, SimConfig(max_size=2))
+        large = simulate(self.path, SimConfig(max_size=3))
+
+        self.assertEqual(small["hits"], 0)  # LRU thrashes on a cycle > size
+        self.assertEqual(small["evictions"], 7)
+        self.assertEqual(large["hits"], 6)
+        self.assertAlmostEqual(large["hit_ratio"], 6 / 9)
+        self.assertEqual(large["evictions"], 0)
+
+    def test_ttl_uses_trace_time(self):
+        """TTL expiry should follow trace timestamps, not wall time."""
+        self.path = _write_trace([
+            "0,set,a,1,30",
+            "10,get,a",       # Hit
+            "3600,get,a",     # Expired an hour later
+        ])
+        result = simulate(self.path, SimConfig(max_size=10, read_through=False))
+        self.assertEqual(result["hits"], 1)
+        self.assertEqual(result["expirations"], 1)
+        self.assertEqual(result["trace_seconds"], 3600.0)
+
+    def test_default_ttl_applies_to_read_through(self):
+        self.path = _write_trace(["0,get,a", "5,get,a", "20,get,a"])
+        result = simulate(self.path, SimConfig(max_size=10, ttl_seconds=10.0))
+        self.assertEqual(result["hits"], 1)
+
+    def test_byte_hit_ratio(self):
+        """Byte hit ratio should weight requests by object size."""
+        self.path = _write_trace([
+            "0,set,big,900", "0,set,small,100",
+            "1,get,big,900", "2,get,missing,100",
+        ])
+        result = simulate(self.path, SimConfig(max_size=10, read_through=False))
+        self.assertAlmostEqual(result["hit_ratio"], 0.5)
+        self.assertAlmostEqual(result["byte_hit_ratio"], 0.9)
+
+    def test_delete(self):
+        self.path = _write_trace(["0,set,a", "1,delete,a", "2,get,a"])
+        result = simulate(self.path, SimConfig(max_size=10, read_through=False))
+        self.assertEqual(result["deletes"], 1)
+        self.assertEqual(result["hits"], 0)
+
+    def test_parallel_matches_sequential(self):
+        """Process-parallel replay should equal in-process replay."""
+        self.path = _write_trace([f"{i},get,k{(i * 7) % 13}" for i in range(200)])
+        configs = [SimConfig(max_size=s) for s in (2, 5, 13)]
+        strip = lambda rs: [{k: v for k, v in r.items() if k != "wall_seconds"} for r in rs]
+        self.assertEqual(
+            strip(simulate_many(self.path, configs, processes=2)),
+            strip(simulate_many(self.path, configs, processes=1)),
+        )
+
+
+def run_tests():
+    """Run all tests."""
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+
+    suite.addTests(loader.loadTestsFromTestCase(TestTraceParsing))
+    suite.addTests(loader.loadTestsFromTestCase(TestSimulation))
+
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+
+    return result.wasSuccessful()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
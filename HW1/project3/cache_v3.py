@@ -9,10 +9,40 @@ A FAANG-grade in-process cache with:
 - Deterministic testing via time injection
 
 Design Decisions:
-- Data Structure: OrderedDict[K, tuple[V, float | None]] for O(1) LRU operations
-- Persistence: Atomic write via temp file + os.replace()
-- Time: Injectable now_fn for deterministic testing
-- Serialization: JSON with explicit validation and clear error messages
+- Data Structure: OrderedDict[K, tuple[V, float | None]] for O(1) LRU operations,
+  or CompactLRUStore (slot-indexed parallel arrays) to cut per-entry memory
+- Values: optional SlabArena keeps JSON-encoded values in size-classed
+  bytearray slabs, so the GC sees one int handle per entry
+- Compression: optional ValueCompressor (zlib/bz2/lzma) packs encoded values
+  above a size threshold, in memory and in the persistence file
+- Large values: optional BlobStore keeps them in reference-counted,
+  content-addressed files; snapshots hold only the digest
+- Invalidation: optional TagIndex (tag -> keys, sorted str keys) makes
+  invalidate_tag()/invalidate_prefix() proportional to the matches
+- Negative caching: optional NegativeCache keeps "known absent" keys with
+  their own TTL and capacity; lookup() returns MISS vs. NEGATIVE
+- Replication: optional MutationJournal logs set/delete/clear with sequence
+  numbers for snapshot-then-stream replicas (cache_replication.py)
+- Namespaces: NamespacedCache shares one budget and one snapshot between
+  sub-caches with min/max quotas, weighted-fair eviction and O(1) clear
+- Persistence: Atomic write via temp file + os.replace(); or an optional
+  SqliteBackend (WAL) that upserts only changed rows on flush(); or an
+  optional ShardedSnapshot that encodes/decodes shard files in a process pool
+- Time: Injectable now_fn for deterministic testing; optional CoarseClock
+  so hot-path TTL checks read a cached attribute instead of calling a clock
+- Serialization: JSON with explicit validation and clear error messages;
+  pluggable codecs, incl. pickle protocol 5 with out-of-band buffers
+- Observability: inline counters plus sampled latency histograms (CacheStats)
+- Sizing: optional SHARDS reuse-distance sampler (ShardsMRC) estimates hit
+  ratios at other sizes in constant memory
+- Hot keys: optional HeavyHitters (Space-Saving) reports the top-K keys
+  with approximate counts and rates in fixed memory
+- Warm start: optional AccessRecorder samples get() keys into a decaying
+  top-N log; Prefetcher loads them through a rate-limited thread pool
+- Versions: optional per-entry version stamps for gets()/cas(); incr()/
+  decr() update counters in place, keeping TTL and tags
+- Capacity: optional MemoryAutoSizer follows RSS vs. cgroup limit, shrinking
+  in bounded eviction batches and growing back slowly
 
 Author: Claude (Anthropic)
 License: MIT
@@ -20,11 +50,30 @@ License: MIT
 
 from __future__ import annotations
 
+import base64
+import bz2
+import fnmatch
+import gc
+import hashlib
+import heapq
+import itertools
 import json
+import lzma
+import math
 import os
+import pickle
+import random
+import sqlite3
 import tempfile
-from collections import OrderedDict
-from typing import TypeVar, Generic, Callable, Any
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context
+from typing import TypeVar, Generic, Callable, Any, Iterable, Iterator
 from pathlib import Path
 
 K = TypeVar('K')
@@ -36,464 +85,5996 @@ class SerializationError(Exception):
     pass
 
 
-class PersistentLRUTTLCache(Generic[K, V]):
+class CoarseClock:
     """
-    Thread-unsafe LRU cache with TTL and file persistence.
-    
-    Type Parameters:
-        K: Key type (must be JSON-serializable and hashable)
-        V: Value type (must be JSON-serializable)
-    
-    Attributes:
-        max_size: Maximum number of entries before eviction
-        persist_path: Path to JSON persistence file
+    Cached wall clock for hot-path TTL checks.
     
-    Behavior on corrupted/missing file:
-        - Missing file: starts with empty cache, no error
-        - Corrupted JSON: starts with empty cache, no error
-        - Invalid schema: starts with empty cache, no error
-        All cases are logged to stderr if you add logging; currently silent for cleaner output.
+    The current time lives in the plain attribute ``now``. It is refreshed
+    either by a daemon ticker thread every ``resolution`` seconds
+    (start()/stop(), or use as a context manager) or explicitly via tick(),
+    e.g. once per request batch. Reads may lag the source by up to one
+    refresh, so TTL expiry becomes correspondingly coarse.
     
-    Thread Safety:
-        This implementation is NOT thread-safe. Callers must provide external
-        synchronization (e.g., threading.Lock) for concurrent access.
+    The clock is callable, so it can be used anywhere a now_fn is expected.
     """
     
-    __slots__ = ('_max_size', '_persist_path', '_now_fn', '_cache')
+    __slots__ = ('now', '_source', '_resolution', '_stop_event', '_thread')
     
     def __init__(
         self,
-        max_size: int,
-        persist_path: str,
+        resolution: float = 0.001,
         *,
-        now_fn: Callable[[], float] | None = None
+        source: Callable[[], float] | None = None
     ) -> None:
         """
-        Initialize the cache.
+        Initialize the clock (ticker not started).
         
         Args:
-            max_size: Maximum entries (must be >= 1)
-            persist_path: Path to persistence file
-            now_fn: Optional time function for testing (default: time.time)
+            resolution: Ticker refresh interval in seconds (must be > 0)
+            source: Underlying time function (default: time.time)
         
         Raises:
-            ValueError: If max_size < 1
+            ValueError: If resolution <= 0
         """
-        if max_size < 1:
-            raise ValueError(f"max_size must be >= 1, got {max_size}")
+        if resolution <= 0:
+            raise ValueError(f"resolution must be > 0, got {resolution}")
         
-        self._max_size = max_size
-        self._persist_path = Path(persist_path)
-        self._now_fn = now_fn if now_fn is not None else self._default_now
-        self._cache: OrderedDict[K, tuple[V, float | None]] = OrderedDict()
+        self._resolution = resolution
+        self._source = source if source is not None else time.time
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.now: float = self._source()
+    
+    def __call__(self) -> float:
+        return self.now
+    
+    @property
+    def resolution(self) -> float:
+        return self._resolution
+    
+    def tick(self) -> float:
+        """Refresh ``now`` from the source clock and return it."""
+        self.now = self._source()
+        return self.now
+    
+    def start(self) -> None:
+        """Start the background ticker thread (no-op if already running)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="CoarseClock", daemon=True
+        )
+        self._thread.start()
+    
+    def stop(self) -> None:
+        """Stop the ticker thread and wait for it to exit."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._resolution):
+            self.now = self._source()
+    
+    def __enter__(self) -> CoarseClock:
+        self.start()
+        return self
+    
+    def __exit__(self, *exc: object) -> None:
+        self.stop()
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram (seconds) with Prometheus-style bounds.
+    
+    Buckets are cumulative only on export; internally each observation
+    increments exactly one bucket, so observe() is a short linear scan.
+    """
+    
+    DEFAULT_BOUNDS: tuple[float, ...] = (
+        1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+        1e-3, 2.5e-3, 5e-3, 1e-2, 0.1, 1.0,
+    )
+    
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    
+    def __init__(self, bounds: tuple[float, ...] | None = None) -> None:
+        self.bounds = bounds if bounds is not None else self.DEFAULT_BOUNDS
+        # One slot per bound plus the +Inf overflow bucket
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, seconds: float) -> None:
+        """Record one latency observation."""
+        i = 0
+        bounds = self.bounds
+        n = len(bounds)
+        while i < n and seconds > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+    
+    def quantile(self, q: float) -> float:
+        """
+        Approximate quantile (upper bound of the bucket containing q).
         
-        self.load()
+        Returns 0.0 if empty and +inf if q falls in the overflow bucket.
+        """
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for i, c in enumerate(self.counts):
+            running += c
+            if running >= target:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+    
+    def snapshot(self) -> dict:
+        return {
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class CacheStats:
+    """
+    Low-overhead operation counters for PersistentLRUTTLCache.
     
-    @staticmethod
-    def _default_now() -> float:
-        """Default time function using time.time()."""
-        import time
-        return time.time()
+    Counters are plain int/float attributes incremented inline by the cache.
+    get()/set() latency is sampled: only one call in ``sample_every`` is
+    timed, so histogram counts are sample counts, not operation counts.
     
-    def get(self, key: K) -> V | None:
+    Counters:
+        hits, misses: get() outcomes (expired reads count as misses too)
+        expired_on_read: get() calls that found and removed an expired entry
+        expired_pruned: expired entries removed by set()'s prune pass
+        evictions: live entries removed to respect max_size
+        admission_rejects: set() calls not admitted (e.g. TTL <= 0)
+        flushes, flush_seconds, bytes_written: flush() activity
+    """
+    
+    __slots__ = (
+        'hits', 'misses', 'expired_on_read', 'expired_pruned', 'evictions',
+        'admission_rejects', 'flushes', 'flush_seconds', 'bytes_written',
+        'get_latency', 'set_latency', '_sample_every', '_get_countdown',
+        '_set_countdown',
+    )
+    
+    def __init__(self, sample_every: int = 64) -> None:
         """
-        Retrieve a value by key.
+        Args:
+            sample_every: Time one in N get()/set() calls (must be >= 1)
         
-        Semantics:
-            - Returns None if key not found
-            - Returns None and removes entry if expired
-            - Moves entry to MRU position on successful access
+        Raises:
+            ValueError: If sample_every < 1
+        """
+        if sample_every < 1:
+            raise ValueError(f"sample_every must be >= 1, got {sample_every}")
+        self._sample_every = sample_every
+        self.reset()
+    
+    def reset(self) -> None:
+        """Zero all counters and histograms."""
+        self.hits = 0
+        self.misses = 0
+        self.expired_on_read = 0
+        self.expired_pruned = 0
+        self.evictions = 0
+        self.admission_rejects = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.bytes_written = 0
+        self.get_latency = LatencyHistogram()
+        self.set_latency = LatencyHistogram()
+        self._get_countdown = self._sample_every
+        self._set_countdown = self._sample_every
+    
+    def sample_get(self) -> float:
+        """Return a start timestamp if this get() is sampled, else 0.0."""
+        self._get_countdown -= 1
+        if self._get_countdown > 0:
+            return 0.0
+        self._get_countdown = self._sample_every
+        return time.perf_counter()
+    
+    def sample_set(self) -> float:
+        """Return a start timestamp if this set() is sampled, else 0.0."""
+        self._set_countdown -= 1
+        if self._set_countdown > 0:
+            return 0.0
+        self._set_countdown = self._sample_every
+        return time.perf_counter()
+    
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def snapshot(self) -> dict:
+        """Return a point-in-time copy of all counters and histograms."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+            "expired_on_read": self.expired_on_read,
+            "expired_pruned": self.expired_pruned,
+            "evictions": self.evictions,
+            "admission_rejects": self.admission_rejects,
+            "flushes": self.flushes,
+            "flush_seconds": self.flush_seconds,
+            "bytes_written": self.bytes_written,
+            "get_latency": self.get_latency.snapshot(),
+            "set_latency": self.set_latency.snapshot(),
+        }
+    
+    def to_prometheus(self, prefix: str = "lru_ttl_cache") -> str:
+        """
+        Render the current counters in Prometheus text exposition format.
         
         Args:
-            key: The key to look up
+            prefix: Metric name prefix
         
         Returns:
-            The value if found and not expired, None otherwise
+            Exposition text, newline-terminated
         """
-        if key not in self._cache:
-            return None
-        
-        value, expires_at = self._cache[key]
+        lines: list[str] = []
+        counters = (
+            ("hits_total", self.hits, "Cache hits"),
+            ("misses_total", self.misses, "Cache misses"),
+            ("expired_on_read_total", self.expired_on_read,
+             "Expired entries found by get()"),
+            ("expired_pruned_total", self.expired_pruned,
+             "Expired entries pruned by set()"),
+            ("evictions_total", self.evictions, "LRU evictions"),
+            ("admission_rejects_total", self.admission_rejects,
+             "Writes not admitted"),
+            ("flushes_total", self.flushes, "Completed flushes"),
+            ("flush_seconds_total", self.flush_seconds,
+             "Time spent in flush()"),
+            ("flush_bytes_written_total", self.bytes_written,
+             "Bytes written by flush()"),
+        )
+        for name, value, help_text in counters:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            lines.append(f"{prefix}_{name} {value}")
         
-        # Check expiration
-        if expires_at is not None and self._now_fn() >= expires_at:
-            del self._cache[key]
-            return None
+        for op, hist in (("get", self.get_latency), ("set", self.set_latency)):
+            name = f"{prefix}_{op}_latency_seconds"
+            lines.append(f"# HELP {name} Sampled {op}() latency")
+            lines.append(f"# TYPE {name} histogram")
+            running = 0
+            for bound, count in zip(hist.bounds, hist.counts):
+                running += count
+                lines.append(f'{name}_bucket{{le="{bound:g}"}} {running}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {hist.count}')
+            lines.append(f"{name}_sum {hist.sum}")
+            lines.append(f"{name}_count {hist.count}")
         
-        # Move to MRU (most recently used)
-        self._cache.move_to_end(key)
-        return value
+        return "\n".join(lines) + "\n"
+
+
+_M64 = (1 << 64) - 1
+
+
+def _mix64(x: int) -> int:
+    """64-bit finalizer (MurmurHash3 fmix64) to spread hash() bits."""
+    x &= _M64
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & _M64
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & _M64
+    x ^= x >> 33
+    return x
+
+
+class ShardsMRC:
+    """
+    Online miss-ratio curve estimator (fixed-size SHARDS).
+    
+    Keys are spatially sampled by hash: a key is tracked iff
+    ``hash(key) mod P < T``, so every reference to a sampled key is seen and
+    its LRU reuse (stack) distance among sampled keys can be computed
+    exactly, then scaled by 1/R where R = T/P is the sampling rate.
+    
+    Memory is constant: at most ``max_samples`` keys are tracked. When that
+    bound is exceeded the key with the largest hash is dropped and T is
+    lowered to its hash, and the histogram is rescaled by R_new/R_old.
+    Reuse distances go into a fixed number of log-spaced bins (exact for
+    distances < 16, 8 bins per power of two above).
+    
+    The estimate models pure LRU capacity; TTL expiry is ignored.
+    """
+    
+    _P = 1 << 24
+    _EXACT_BINS = 16
+    _SUB_BINS = 8
+    _N_BINS = _EXACT_BINS + 60 * _SUB_BINS
     
-    def set(self, key: K, value: V, ttl_seconds: float | None = None) -> None:
+    __slots__ = (
+        '_threshold', '_max_samples', '_last', '_heap', '_tree',
+        '_tick', '_live', '_hist', '_cold', '_refs', '_expected',
+    )
+    
+    def __init__(self, sample_rate: float = 0.01, max_samples: int = 8192) -> None:
         """
-        Store a value with optional TTL.
-        
-        Semantics:
-            - Validates JSON serializability before modifying cache
-            - Removes existing entry (if any) before re-inserting
-            - Prunes all expired entries before eviction check
-            - Evicts LRU entries until size < max_size
-            - New entry always goes to MRU position
-        
         Args:
-            key: Cache key (must be JSON-serializable and hashable)
-            value: Value to store (must be JSON-serializable)
-            ttl_seconds: Time-to-live in seconds, None for no expiration
+            sample_rate: Initial spatial sampling rate R in (0, 1]
+            max_samples: Maximum number of tracked keys (memory bound)
         
         Raises:
-            SerializationError: If key or value cannot be JSON-serialized
+            ValueError: If sample_rate not in (0, 1] or max_samples < 1
         """
-        # Validate serializability BEFORE any mutation
-        self._validate_serializable(key, "key")
-        self._validate_serializable(value, "value")
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+        if max_samples < 1:
+            raise ValueError(f"max_samples must be >= 1, got {max_samples}")
         
-        # Calculate expiration
-        expires_at: float | None = None
-        if ttl_seconds is not None:
-            if ttl_seconds <= 0:
-                # Zero or negative TTL means already expired; don't insert
-                # But do remove existing entry if present
-                self._cache.pop(key, None)
-                return
-            expires_at = self._now_fn() + ttl_seconds
+        self._threshold = max(1, int(sample_rate * self._P))
+        self._max_samples = max_samples
+        self._last: dict[Any, int] = {}     # key -> last access tick
+        self._heap: list[tuple[int, Any]] = []  # (-hash, key) max-heap
+        # Fenwick tree over access ticks; a tick holds 1 while it is some
+        # tracked key's most recent access
+        self._tree = [0] * (2 * max_samples + 2)
+        self._tick = 0
+        self._live = 0
+        self._hist = [0.0] * self._N_BINS
+        self._cold = 0.0
+        self._refs = 0.0
+        self._expected = 0.0
+    
+    @property
+    def sample_rate(self) -> float:
+        return self._threshold / self._P
+    
+    def record(self, key: Any) -> None:
+        """Observe one reference to ``key``."""
+        self._expected += self._threshold
+        h = _mix64(hash(key)) % self._P
+        if h >= self._threshold:
+            return
         
-        # Remove existing entry to reset LRU position
-        self._cache.pop(key, None)
+        self._refs += 1.0
+        if self._tick + 1 >= len(self._tree):
+            self._compact()
+        last = self._last.get(key)
+        if last is None:
+            self._cold += 1.0
+            heapq.heappush(self._heap, (-h, key))
+            self._live += 1
+        else:
+            distance = self._live - self._prefix(last)
+            self._fenwick_add(last, -1)
+            self._hist[self._bin(distance * self._P / self._threshold)] += 1.0
         
-        # Aggressively prune expired entries before eviction
-        self._prune_expired()
+        self._tick += 1
+        self._last[key] = self._tick
+        self._fenwick_add(self._tick, 1)
         
-        # Evict LRU entries until we have space
-        while len(self._cache) >= self._max_size:
-            # popitem(last=False) removes the oldest (LRU) entry
-            self._cache.popitem(last=False)
+        if self._live > self._max_samples:
+            self._lower_threshold()
+    
+    def hit_ratio(self, cache_size: float) -> float:
+        """Estimated LRU hit ratio for a cache of ``cache_size`` entries."""
+        if self._refs <= 0:
+            return 0.0
+        # SHARDS_adj: credit the gap between expected and actual sampled
+        # references to distance 0, correcting for hot keys that happened
+        # to fall in or out of the sample
+        expected = self._expected / self._P
+        hits = expected - self._refs
+        for i, count in enumerate(self._hist):
+            if not count:
+                continue
+            lower, width = self._bin_bounds(i)
+            if lower + width <= cache_size:
+                hits += count
+            elif lower < cache_size:
+                hits += count * (cache_size - lower) / width
+        return min(1.0, max(0.0, hits / expected))
+    
+    def miss_ratio(self, cache_size: float) -> float:
+        """Estimated LRU miss ratio for a cache of ``cache_size`` entries."""
+        return 1.0 - self.hit_ratio(cache_size)
+    
+    def curve(self, sizes: list[int]) -> list[tuple[int, float]]:
+        """Return ``(size, miss_ratio)`` points for the given cache sizes."""
+        return [(size, self.miss_ratio(size)) for size in sizes]
+    
+    def _bin(self, distance: float) -> int:
+        if distance < self._EXACT_BINS:
+            return int(distance)
+        mantissa, exp = math.frexp(distance)  # distance = mantissa * 2**exp
+        sub = int((mantissa * 2.0 - 1.0) * self._SUB_BINS)
+        index = self._EXACT_BINS + (exp - 5) * self._SUB_BINS + sub
+        return min(index, self._N_BINS - 1)
+    
+    def _bin_bounds(self, index: int) -> tuple[float, float]:
+        """Return (lower bound, width) of a histogram bin."""
+        if index < self._EXACT_BINS:
+            return float(index), 1.0
+        octave, sub = divmod(index - self._EXACT_BINS, self._SUB_BINS)
+        base = float(self._EXACT_BINS << octave)
+        width = base / self._SUB_BINS
+        return base + sub * width, width
+    
+    def _fenwick_add(self, i: int, delta: int) -> None:
+        tree = self._tree
+        n = len(tree)
+        while i < n:
+            tree[i] += delta
+            i += i & -i
+    
+    def _prefix(self, i: int) -> int:
+        tree = self._tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+    
+    def _compact(self) -> None:
+        """Renumber live ticks to 1..live so the tree never grows."""
+        order = sorted(self._last.items(), key=lambda kv: kv[1])
+        self._tree = [0] * len(self._tree)
+        for new_tick, (key, _) in enumerate(order, start=1):
+            self._last[key] = new_tick
+            self._fenwick_add(new_tick, 1)
+        self._tick = len(order)
+    
+    def _lower_threshold(self) -> None:
+        """Drop the largest-hash key and lower T to its hash."""
+        old = self._threshold
+        neg_h, key = heapq.heappop(self._heap)
+        self._threshold = -neg_h
+        self._fenwick_add(self._last.pop(key), -1)
+        self._live -= 1
+        # Drop any other keys that share the (now excluded) hash
+        while self._heap and -self._heap[0][0] >= self._threshold:
+            _, other = heapq.heappop(self._heap)
+            self._fenwick_add(self._last.pop(other), -1)
+            self._live -= 1
         
-        # Insert at MRU position (end of OrderedDict)
-        self._cache[key] = (value, expires_at)
+        scale = self._threshold / old
+        self._hist = [c * scale for c in self._hist]
+        self._cold *= scale
+        self._refs *= scale
+        self._expected *= scale
+
+
+# Values at or above this are how cgroup v1 spells "no limit"
+_CGROUP_UNLIMITED = 1 << 60
+
+
+def read_process_rss(statm_path: str = "/proc/self/statm") -> int | None:
+    """
+    Resident set size of this process in bytes, from /proc/self/statm.
     
-    def delete(self, key: K) -> bool:
+    Returns:
+        RSS in bytes, or None if unavailable (non-Linux, unreadable)
+    """
+    try:
+        with open(statm_path, 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_cgroup_memory_limit(cgroup_root: str = "/sys/fs/cgroup") -> int | None:
+    """
+    Memory limit of this process's cgroup in bytes.
+    
+    Checks cgroup v2 (memory.max) then cgroup v1
+    (memory/memory.limit_in_bytes).
+    
+    Returns:
+        Limit in bytes, or None if unlimited or unavailable
+    """
+    candidates = (
+        os.path.join(cgroup_root, "memory.max"),
+        os.path.join(cgroup_root, "memory", "memory.limit_in_bytes"),
+    )
+    for path in candidates:
+        try:
+            with open(path, 'r') as f:
+                text = f.read().strip()
+        except OSError:
+            continue
+        if text == "max":
+            return None
+        try:
+            limit = int(text)
+        except ValueError:
+            continue
+        return None if limit >= _CGROUP_UNLIMITED else limit
+    return None
+
+
+class MemoryAutoSizer:
+    """
+    Adjusts a cache's max_size from process RSS and the cgroup memory limit.
+    
+    Every ``check_every`` set() calls the cache asks the sizer to adjust:
+        - headroom = (limit - rss) / limit
+        - headroom < low_headroom: shrink max_size by ``shrink_step`` of the
+          current size, evicting at most ``evict_batch`` LRU entries now;
+          further evictions happen on later checks. The next step is only
+          taken once RSS has fallen below its value at the last one:
+          CPython seldom returns freed memory to the OS, and cutting on
+          while RSS stays put would take the cache down to min_size
+        - headroom > high_headroom: grow max_size by ``grow_step`` of the
+          current size, up to ``ceiling`` (the constructor max_size)
+        - otherwise: hold (hysteresis band between the two watermarks)
+    
+    Shrinking by a bounded batch and growing slowly avoids eviction storms
+    and oscillation around the limit.
+    """
+    
+    __slots__ = (
+        'min_size', 'ceiling', 'low_headroom', 'high_headroom', 'shrink_step',
+        'grow_step', 'evict_batch', 'check_every', 'limit_bytes',
+        'shrinks', 'grows', 'last_headroom', '_rss_fn', '_limit_fn',
+        '_countdown', '_shrink_rss', '_shrink_target',
+    )
+    
+    def __init__(
+        self,
+        *,
+        min_size: int = 1,
+        low_headroom: float = 0.10,
+        high_headroom: float = 0.25,
+        shrink_step: float = 0.10,
+        grow_step: float = 0.02,
+        evict_batch: int = 1024,
+        check_every: int = 1000,
+        limit_bytes: int | None = None,
+        rss_fn: Callable[[], int | None] = read_process_rss,
+        limit_fn: Callable[[], int | None] = read_cgroup_memory_limit
+    ) -> None:
         """
-        Remove an entry by key.
-        
         Args:
-            key: The key to remove
+            min_size: Never shrink max_size below this
+            low_headroom: Shrink when free fraction of the limit drops below
+            high_headroom: Grow when free fraction of the limit exceeds
+            shrink_step: Fraction of max_size removed per shrinking check
+            grow_step: Fraction of max_size added per growing check
+            evict_batch: Maximum LRU evictions per check
+            check_every: set() calls between checks
+            limit_bytes: Explicit limit; overrides limit_fn when given
+            rss_fn: Returns current RSS in bytes (default: /proc)
+            limit_fn: Returns the memory limit in bytes (default: cgroup)
         
-        Returns:
-            True if key existed (regardless of expiration), False otherwise
+        Raises:
+            ValueError: If thresholds or steps are out of range
         """
-        if key in self._cache:
-            del self._cache[key]
-            return True
-        return False
+        if not 0 <= low_headroom < high_headroom < 1:
+            raise ValueError(
+                "need 0 <= low_headroom < high_headroom < 1, got "
+                f"{low_headroom}, {high_headroom}"
+            )
+        if not 0 < shrink_step < 1 or not 0 < grow_step < 1:
+            raise ValueError("shrink_step and grow_step must be in (0, 1)")
+        if min_size < 1 or evict_batch < 1 or check_every < 1:
+            raise ValueError("min_size, evict_batch and check_every must be >= 1")
+        
+        self.min_size = min_size
+        self.ceiling = 0  # Set from the cache's max_size on attach
+        self.low_headroom = low_headroom
+        self.high_headroom = high_headroom
+        self.shrink_step = shrink_step
+        self.grow_step = grow_step
+        self.evict_batch = evict_batch
+        self.check_every = check_every
+        self.limit_bytes = limit_bytes
+        self.shrinks = 0
+        self.grows = 0
+        self.last_headroom: float | None = None
+        self._rss_fn = rss_fn
+        self._limit_fn = limit_fn
+        self._countdown = check_every
+        # RSS before, and max_size aimed at by, the last shrink of the
+        # current pressure episode (None outside one)
+        self._shrink_rss: int | None = None
+        self._shrink_target: int | None = None
     
-    def clear(self) -> None:
-        """Remove all entries from the cache."""
-        self._cache.clear()
+    def headroom(self) -> float | None:
+        """Free fraction of the memory limit, or None if unknown."""
+        return self._measure()[0]
     
-    def __len__(self) -> int:
+    def _measure(self) -> tuple[float | None, int | None]:
+        """(headroom, rss); headroom is None if either is unknown."""
+        limit = self.limit_bytes if self.limit_bytes is not None else self._limit_fn()
+        rss = self._rss_fn()
+        if not limit or rss is None:
+            return None, rss
+        return (limit - rss) / limit, rss
+    
+    def due(self) -> bool:
+        """Count one set() and report whether a check is due."""
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self.check_every
+        return True
+    
+    def adjust(self, cache: PersistentLRUTTLCache) -> int:
         """
-        Return the count of non-expired entries.
+        Run one sizing check against ``cache``.
         
-        Note: This performs a full scan to ensure accuracy.
-        For raw count (including potentially expired), use len(cache._cache).
+        Returns:
+            The cache's max_size after the check
         """
-        now = self._now_fn()
-        return sum(
-            1 for _, (__, expires_at) in self._cache.items()
-            if expires_at is None or now < expires_at
-        )
+        headroom, rss = self._measure()
+        self.last_headroom = headroom
+        current = cache.max_size
+        if headroom is None:
+            return current
+        
+        if headroom >= self.low_headroom:
+            self._shrink_rss = self._shrink_target = None
+        if headroom < self.low_headroom and current > self.min_size:
+            target = self._shrink_target
+            if target is not None and current > target:
+                # Finish the last shrink's evictions, a batch per check
+                cache.resize(target, max_evictions=self.evict_batch)
+            elif self._shrink_rss is None or rss < self._shrink_rss:
+                step = max(1, int(current * self.shrink_step))
+                target = self._shrink_target = max(self.min_size, current - step)
+                self._shrink_rss = rss
+                cache.resize(target, max_evictions=self.evict_batch)
+                self.shrinks += 1
+        elif headroom > self.high_headroom and current < self.ceiling:
+            step = max(1, int(current * self.grow_step))
+            cache.resize(min(self.ceiling, current + step))
+            self.grows += 1
+        return cache.max_size
+
+
+class HeavyHitters:
+    """
+    Space-Saving top-K tracker for hot keys, in fixed memory.
     
-    def __contains__(self, key: K) -> bool:
-        """Check if key exists and is not expired (does NOT update LRU)."""
-        if key not in self._cache:
-            return False
-        _, expires_at = self._cache[key]
-        return expires_at is None or self._now_fn() < expires_at
+    At most ``capacity`` keys are monitored. A new key replaces the
+    monitored key with the smallest count c and starts at c + 1 with error
+    c, so counts are overestimates by at most ``error``, and any key seen
+    more than N / capacity times in N references is guaranteed to be
+    monitored.
     
-    def flush(self) -> None:
+    The minimum is found with a lazy min-heap: counts only grow, so a heap
+    entry whose count is stale is re-pushed with the current count when it
+    surfaces. Each monitored key has exactly one heap entry.
+    
+    Rates are count / seconds since the window started (creation or the
+    last reset()).
+    """
+    
+    __slots__ = ('_capacity', '_now_fn', '_counts', '_heap', '_started', 'total')
+    
+    def __init__(
+        self,
+        capacity: int = 64,
+        *,
+        now_fn: Callable[[], float] | None = None
+    ) -> None:
         """
-        Persist cache to file atomically.
+        Args:
+            capacity: Number of monitored keys (must be >= 1)
+            now_fn: Clock for rates (default: time.monotonic)
         
-        File format:
-            {
-                "version": 3,
-                "max_size": <int>,
-                "entries": [
-                    {"key": <K>, "value": <V>, "expires_at": <float|null>},
-                    ...  // ordered from LRU to MRU
-                ]
-            }
+        Raises:
+            ValueError: If capacity < 1
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity must be >= 1, got {capacity}")
+        self._capacity = capacity
+        self._now_fn = now_fn if now_fn is not None else time.monotonic
+        self.reset()
+    
+    def reset(self) -> None:
+        """Forget all keys and start a new rate window."""
+        # key -> [count, error]
+        self._counts: dict[Any, list[int]] = {}
+        self._heap: list[tuple[int, int, Any]] = []
+        self._started = self._now_fn()
+        self.total = 0
+    
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+    
+    def record(self, key: Any) -> None:
+        """Count one reference to ``key``."""
+        self.total += 1
+        counts = self._counts
+        slot = counts.get(key)
+        if slot is not None:
+            slot[0] += 1
+            return
+        heap = self._heap
+        if len(counts) < self._capacity:
+            counts[key] = [1, 0]
+            # id() breaks count ties so keys are never compared
+            heapq.heappush(heap, (1, id(key), key))
+            return
         
-        Atomic write:
-            Writes to a temp file in the same directory, then uses os.replace()
-            for atomic rename. This prevents corruption on crash.
+        while True:
+            count, _, victim = heap[0]
+            current = counts[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(heap, (current, id(victim), victim))
+        del counts[victim]
+        counts[key] = [count + 1, count]
+        heapq.heapreplace(heap, (count + 1, id(key), key))
+    
+    def top(self, n: int = 10) -> list[dict]:
+        """
+        The ``n`` hottest monitored keys, hottest first.
         
-        Raises:
-            OSError: If file cannot be written
+        Returns:
+            Dicts with key, count (upper bound), error (count - error is
+            a lower bound), share of all references and rate per second
         """
-        # Build ordered entry list (LRU to MRU order)
-        entries = [
-            {"key": k, "value": v, "expires_at": exp}
-            for k, (v, exp) in self._cache.items()
+        elapsed = max(self._now_fn() - self._started, 1e-9)
+        total = self.total or 1
+        best = heapq.nlargest(n, self._counts.items(), key=lambda kv: kv[1][0])
+        return [
+            {
+                "key": key,
+                "count": count,
+                "error": error,
+                "share": count / total,
+                "rate": count / elapsed,
+            }
+            for key, (count, error) in best
         ]
-        
-        data = {
-            "version": 3,
-            "max_size": self._max_size,
-            "entries": entries
+    
+    def estimate(self, key: Any) -> int:
+        """Upper-bound count for ``key`` (0 if not monitored)."""
+        slot = self._counts.get(key)
+        return slot[0] if slot is not None else 0
+    
+    def __len__(self) -> int:
+        return len(self._counts)
+    
+    def snapshot(self) -> dict:
+        return {
+            "capacity": self._capacity,
+            "monitored": len(self._counts),
+            "total": self.total,
+            "window_seconds": self._now_fn() - self._started,
         }
-        
-        # Atomic write: temp file + rename
-        # Create temp file in same directory to ensure same filesystem
-        dir_path = self._persist_path.parent
-        dir_path.mkdir(parents=True, exist_ok=True)
-        
-        fd, temp_path = tempfile.mkstemp(
-            suffix='.tmp',
-            prefix='.cache_',
-            dir=dir_path
+
+
+_MISSING = object()
+
+
+class AccessRecorder:
+    """
+    Sampled get() keys with recency-weighted counts, saved to a small file.
+    
+    Each get() is recorded with probability sample_rate, so a key's score
+    is proportional to its request rate. Scores decay with the given half
+    life (score = score * 0.5 ** (elapsed / half_life) + 1 per sample), so
+    ranking prefers keys that are both frequent and recent.
+    
+    At most 2 * capacity keys are tracked; reaching that drops all but the
+    capacity best. save() writes the capacity best as one JSON file,
+    hottest first:
+    
+        {"version": 1, "saved_at": <epoch>, "keys": [[<key>, <score>], ...]}
+    
+    and a new recorder on the same path starts from it, so history
+    carries across restarts. Pass it to the cache as recorder=; the cache
+    saves it on flush(). Scores use wall-clock time for that reason.
+    """
+    
+    __slots__ = ('_path', '_sample_rate', '_capacity', '_half_life', '_now_fn',
+                 '_rng', '_scores', 'sampled')
+    
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        sample_rate: float = 0.01,
+        capacity: int = 10_000,
+        half_life: float = 3600.0,
+        now_fn: Callable[[], float] | None = None,
+        rng: Callable[[], float] | None = None
+    ) -> None:
+        """
+        Args:
+            path: Log file (loaded now if present and valid)
+            sample_rate: Fraction of get() calls recorded, in (0, 1]
+            capacity: Keys kept in the log (must be >= 1)
+            half_life: Seconds for a score to halve (must be > 0)
+            now_fn: Wall clock (default: time.time)
+            rng: Uniform [0, 1) source (default: random.random)
+        
+        Raises:
+            ValueError: If an argument is out of range
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+        if capacity < 1:
+            raise ValueError(f"capacity must be >= 1, got {capacity}")
+        if half_life <= 0:
+            raise ValueError(f"half_life must be > 0, got {half_life}")
+        self._path = Path(path)
+        self._sample_rate = sample_rate
+        self._capacity = capacity
+        self._half_life = half_life
+        self._now_fn = now_fn if now_fn is not None else time.time
+        self._rng = rng if rng is not None else random.random
+        # key -> [score, time of score]
+        self._scores: dict[Any, list[float]] = {}
+        self.sampled = 0
+        self._load()
+    
+    def record(self, key: Any) -> None:
+        """Sample one get() of ``key``."""
+        if self._rng() >= self._sample_rate:
+            return
+        self.sampled += 1
+        now = self._now_fn()
+        slot = self._scores.get(key)
+        if slot is not None:
+            slot[0] = self._decayed(slot, now) + 1.0
+            slot[1] = now
+            return
+        self._scores[key] = [1.0, now]
+        if len(self._scores) >= 2 * self._capacity:
+            self._scores = dict(self._ranked(self._capacity, now))
+    
+    def _decayed(self, slot: list[float], now: float) -> float:
+        return slot[0] * 0.5 ** ((now - slot[1]) / self._half_life)
+    
+    def _ranked(self, n: int, now: float) -> list[tuple[Any, list[float]]]:
+        """The n best (key, [score, now]) pairs, scores decayed to now."""
+        best = heapq.nlargest(
+            n, ((key, self._decayed(slot, now)) for key, slot in self._scores.items()),
+            key=lambda kv: kv[1]
         )
+        return [(key, [score, now]) for key, score in best]
+    
+    def hottest(self, n: int | None = None) -> list[Any]:
+        """Up to ``n`` (default: capacity) keys, highest score first."""
+        n = self._capacity if n is None else n
+        return [key for key, _ in self._ranked(n, self._now_fn())]
+    
+    def save(self) -> int:
+        """
+        Write the log atomically.
         
+        Returns:
+            Bytes written
+        """
+        now = self._now_fn()
+        data = {
+            "version": 1,
+            "saved_at": now,
+            "keys": [[key, slot[0]] for key, slot in self._ranked(self._capacity, now)],
+        }
+        return write_atomically(self._path, lambda f: json.dump(data, f))
+    
+    def _load(self) -> None:
+        """Start from the saved log; a missing or invalid file is ignored."""
         try:
-            with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            os.replace(temp_path, self._persist_path)
-        except:
-            # Clean up temp file on error
-            try:
-                os.unlink(temp_path)
-            except OSError:
-                pass
-            raise
+            with open(self._path, 'rb') as f:
+                data = json.loads(f.read())
+            saved_at = float(data["saved_at"])
+            for key, score in data["keys"][:self._capacity]:
+                if isinstance(key, list):
+                    continue  # Unhashable: not a key this cache can hold
+                self._scores[key] = [float(score), saved_at]
+        except (OSError, ValueError, TypeError, KeyError):
+            self._scores.clear()
     
-    def load(self) -> None:
+    def __len__(self) -> int:
+        return len(self._scores)
+    
+    def snapshot(self) -> dict:
+        return {"tracked": len(self._scores), "sampled": self.sampled}
+
+
+class Prefetcher:
+    """
+    Warm a cache by loading keys (e.g. AccessRecorder.hottest()) in threads.
+    
+    The loader runs in a bounded thread pool; results are set() into the
+    cache by the calling thread, since the cache is not thread-safe.
+    Submissions are spaced to at most ``rate`` per second so a cold start
+    does not stampede the backing store, and stop at the ``timeout``
+    deadline (in-flight loads still finish). Keys already live in the
+    cache, e.g. restored by load(), are skipped.
+    """
+    
+    def __init__(
+        self,
+        loader: Callable[[Any], Any],
+        *,
+        workers: int = 8,
+        rate: float | None = None,
+        timeout: float | None = None,
+        ttl_seconds: float | None = None
+    ) -> None:
         """
-        Load cache from persistence file.
-        
-        Behavior:
-            - Missing file: starts empty (not an error)
-            - Corrupted JSON: starts empty (not an error)
-            - Invalid schema: starts empty (not an error)
-            - Expired entries: discarded during load
-            - Entries exceeding max_size: oldest (LRU) entries truncated
+        Args:
+            loader: Called with a key; returns its value, or None to skip it
+            workers: Loader threads (must be >= 1)
+            rate: Max loader calls started per second (None: unlimited)
+            timeout: Seconds after which no more loads are started
+            ttl_seconds: TTL for prefetched entries
         
-        LRU order is preserved from file (entries stored LRU to MRU).
+        Raises:
+            ValueError: If workers < 1 or rate/timeout is not positive
         """
-        self._cache.clear()
+        if workers < 1:
+            raise ValueError(f"workers must be >= 1, got {workers}")
+        if rate is not None and rate <= 0:
+            raise ValueError(f"rate must be > 0, got {rate}")
+        if timeout is not None and timeout <= 0:
+            raise ValueError(f"timeout must be > 0, got {timeout}")
+        self._loader = loader
+        self._workers = workers
+        self._rate = rate
+        self._timeout = timeout
+        self._ttl_seconds = ttl_seconds
+    
+    def run(self, cache: PersistentLRUTTLCache, keys: Iterable[Any]) -> dict:
+        """
+        Load ``keys`` into ``cache``, in order.
         
-        if not self._persist_path.exists():
-            return
+        Returns:
+            Counts of loaded, cached (already present), missing (loader
+            returned None), errors (loader raised), rejected (the cache
+            cannot serialize the value) and skipped (not started before
+            the deadline) keys, and the seconds taken
+        """
+        result = {"loaded": 0, "cached": 0, "missing": 0, "errors": 0,
+                  "rejected": 0, "skipped": 0, "seconds": 0.0}
+        started = time.monotonic()
+        deadline = started + self._timeout if self._timeout is not None else math.inf
+        interval = 1.0 / self._rate if self._rate is not None else 0.0
+        next_start = started
+        pending: dict = {}
         
-        try:
-            with open(self._persist_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Validate structure
-            if not isinstance(data, dict):
-                return
-            
-            entries = data.get("entries")
-            if not isinstance(entries, list):
-                return
-            
-            now = self._now_fn()
-            
-            for entry in entries:
-                if not isinstance(entry, dict):
+        def settle(done: Iterable) -> None:
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    value = future.result()
+                except Exception:
+                    result["errors"] += 1
                     continue
-                
-                # Extract fields with validation
-                if "key" not in entry or "value" not in entry:
+                if value is None:
+                    result["missing"] += 1
                     continue
-                
-                key = entry["key"]
-                value = entry["value"]
-                expires_at = entry.get("expires_at")
-                
-                # Skip expired entries
-                if expires_at is not None and now >= expires_at:
+                try:
+                    cache.set(key, value, ttl_seconds=self._ttl_seconds)
+                except SerializationError:
+                    result["rejected"] += 1
+                else:
+                    result["loaded"] += 1
+        
+        with ThreadPoolExecutor(max_workers=self._workers,
+                                thread_name_prefix="Prefetcher") as pool:
+            for key in keys:
+                if key in cache:
+                    result["cached"] += 1
                     continue
-                
-                # Respect max_size during load
-                if len(self._cache) >= self._max_size:
-                    # Remove LRU to make space (preserves MRU entries from file)
-                    self._cache.popitem(last=False)
-                
-                self._cache[key] = (value, expires_at)
-                
-        except (json.JSONDecodeError, OSError, TypeError, KeyError):
-            # Any error during load: start fresh
-            self._cache.clear()
+                # Bound the queue: at most two loads per worker outstanding
+                while len(pending) >= 2 * self._workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    settle(done)
+                now = time.monotonic()
+                # Never wait past the deadline for a load that cannot start
+                wake = min(next_start, deadline)
+                if wake > now:
+                    time.sleep(wake - now)
+                    now = wake
+                if now >= deadline:
+                    result["skipped"] += 1
+                    continue
+                next_start = max(next_start + interval, now)
+                pending[pool.submit(self._loader, key)] = key
+            settle(wait(pending).done)
+        result["seconds"] = time.monotonic() - started
+        return result
+
+
+class CompactLRUStore:
+    """
+    Memory-compact ordered entry store (drop-in for the cache's OrderedDict).
     
-    def _prune_expired(self) -> int:
+    Layout (all indexed by slot; slot 0 is the list sentinel):
+        _slots:   dict key -> slot (the only per-entry hash table)
+        _keys:    list of keys, _values: list of values
+        _prev, _next: array('i') doubly linked LRU list
+        _expires: array('d') absolute expiry; +inf encodes "no TTL"
+        _free:    array('i') stack of released slots for reuse
+    
+    This replaces an OrderedDict node, a (value, expires_at) tuple and a
+    boxed float per entry with ~16 bytes of unboxed array storage. Freed
+    slots are reused but arrays never shrink until clear().
+    
+    Implements the OrderedDict subset the cache uses; entries are exposed
+    as (value, expires_at) tuples built on access. Mutating the store while
+    iterating items() is not supported; scan() pages by slot instead and
+    tolerates any mutation between calls.
+    """
+    
+    __slots__ = ('_slots', '_keys', '_values', '_prev', '_next', '_expires', '_free')
+    
+    def __init__(self) -> None:
+        self.clear()
+    
+    def clear(self) -> None:
+        self._slots: dict[Any, int] = {}
+        self._keys: list[Any] = [None]
+        self._values: list[Any] = [None]
+        self._prev = array('i', [0])
+        self._next = array('i', [0])
+        self._expires = array('d', [0.0])
+        self._free = array('i')
+    
+    def __len__(self) -> int:
+        return len(self._slots)
+    
+    def __contains__(self, key: Any) -> bool:
+        return key in self._slots
+    
+    def __iter__(self) -> Iterator[Any]:
+        keys = self._keys
+        nxt = self._next
+        slot = nxt[0]
+        while slot:
+            yield keys[slot]
+            slot = nxt[slot]
+    
+    def _entry(self, slot: int) -> tuple[Any, float | None]:
+        exp = self._expires[slot]
+        return self._values[slot], (None if exp == math.inf else exp)
+    
+    def __getitem__(self, key: Any) -> tuple[Any, float | None]:
+        return self._entry(self._slots[key])
+    
+    def get(self, key: Any, default: Any = None) -> Any:
+        slot = self._slots.get(key)
+        if slot is None:
+            return default
+        return self._entry(slot)
+    
+    def __setitem__(self, key: Any, entry: tuple[Any, float | None]) -> None:
+        value, expires_at = entry
+        exp = math.inf if expires_at is None else expires_at
+        slot = self._slots.get(key)
+        if slot is not None:
+            # Like OrderedDict: updating an existing key keeps its position
+            self._values[slot] = value
+            self._expires[slot] = exp
+            return
+        
+        if self._free:
+            slot = self._free.pop()
+            self._keys[slot] = key
+            self._values[slot] = value
+            self._expires[slot] = exp
+        else:
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._values.append(value)
+            self._expires.append(exp)
+            self._prev.append(0)
+            self._next.append(0)
+        self._link_last(slot)
+        self._slots[key] = slot
+    
+    def __delitem__(self, key: Any) -> None:
+        self._release(self._slots.pop(key))
+    
+    def pop(self, key: Any, default: Any = _MISSING) -> Any:
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        entry = self._entry(slot)
+        self._release(slot)
+        return entry
+    
+    def popitem(self, last: bool = True) -> tuple[Any, tuple[Any, float | None]]:
+        if not self._slots:
+            raise KeyError('dictionary is empty')
+        slot = self._prev[0] if last else self._next[0]
+        key = self._keys[slot]
+        entry = self._entry(slot)
+        del self._slots[key]
+        self._release(slot)
+        return key, entry
+    
+    def move_to_end(self, key: Any, last: bool = True) -> None:
+        slot = self._slots[key]
+        self._unlink(slot)
+        if last:
+            self._link_last(slot)
+        else:
+            head = self._next[0]
+            self._prev[slot] = 0
+            self._next[slot] = head
+            self._prev[head] = slot
+            self._next[0] = slot
+    
+    def items(self) -> Iterator[tuple[Any, tuple[Any, float | None]]]:
+        """Yield (key, (value, expires_at)) from LRU to MRU."""
+        nxt = self._next
+        slot = nxt[0]
+        while slot:
+            yield self._keys[slot], self._entry(slot)
+            slot = nxt[slot]
+    
+    def scan(self, cursor: int, count: int) -> tuple[int, list[Any]]:
         """
-        Remove all expired entries.
+        Keys in slots [cursor, cursor + count), in slot order.
+        
+        Slots never move, so a key present for a whole scan is returned
+        exactly once, however the LRU list changes between calls.
         
         Returns:
-            Number of entries removed
+            (next cursor, 0 when done; keys)
         """
-        now = self._now_fn()
-        expired_keys = [
-            k for k, (_, expires_at) in self._cache.items()
-            if expires_at is not None and now >= expires_at
+        keys = self._keys
+        slots = self._slots
+        start = max(cursor, 1)
+        stop = min(start + count, len(keys))
+        # A free slot holds None; a live None key is told apart by its slot
+        found = [
+            key for slot, key in enumerate(keys[start:stop], start)
+            if slots.get(key) == slot
         ]
-        for key in expired_keys:
-            del self._cache[key]
-        return len(expired_keys)
+        return (stop if stop < len(keys) else 0), found
     
-    def _validate_serializable(self, obj: Any, name: str) -> None:
+    def _link_last(self, slot: int) -> None:
+        tail = self._prev[0]
+        self._next[tail] = slot
+        self._prev[slot] = tail
+        self._next[slot] = 0
+        self._prev[0] = slot
+    
+    def _unlink(self, slot: int) -> None:
+        prev = self._prev[slot]
+        nxt = self._next[slot]
+        self._next[prev] = nxt
+        self._prev[nxt] = prev
+    
+    def _release(self, slot: int) -> None:
+        self._unlink(slot)
+        self._keys[slot] = None
+        self._values[slot] = None  # Drop the reference now, not on reuse
+        self._free.append(slot)
+
+
+STORAGE_ENGINES = ("ordered", "compact")
+
+
+class SlabArena:
+    """
+    Encoded values packed into fixed-size bytearray slabs by size class.
+    
+    Chunk sizes grow geometrically from min_chunk (rounded up to 8 bytes)
+    to slab_size; a value goes in the smallest class that fits and data
+    larger than a slab is kept as a standalone bytes object. Each class
+    hands out chunks from its free list first, then from the end of its
+    last slab, adding a new slab when that is full.
+    
+    A handle is ``chunk_id << 8 | class_index``, so the cache holds one
+    small int per value instead of a graph of Python objects the cyclic GC
+    has to traverse. Slabs are only released by clear().
+    """
+    
+    _CLASS_BITS = 8
+    _CLASS_MASK = (1 << _CLASS_BITS) - 1
+    _OVERSIZE = _CLASS_MASK  # class index reserved for oversize values
+    
+    def __init__(
+        self,
+        *,
+        slab_size: int = 1 << 20,
+        min_chunk: int = 64,
+        growth: float = 1.25
+    ) -> None:
         """
-        Validate that an object can be JSON-serialized.
-        
         Args:
-            obj: Object to validate
-            name: Name for error message ("key" or "value")
+            slab_size: Bytes per slab, also the largest chunk size
+            min_chunk: Smallest chunk size in bytes
+            growth: Ratio between consecutive chunk sizes (> 1)
         
         Raises:
-            SerializationError: If object cannot be serialized
+            ValueError: If the sizes or growth factor are out of range
         """
-        try:
-            json.dumps(obj)
-        except (TypeError, ValueError) as e:
-            raise SerializationError(
-                f"{name} is not JSON-serializable: {type(obj).__name__} - {e}"
-            ) from e
+        if min_chunk < 8 or slab_size < min_chunk:
+            raise ValueError(
+                f"need 8 <= min_chunk <= slab_size, got {min_chunk}, {slab_size}"
+            )
+        if growth <= 1.0:
+            raise ValueError(f"growth must be > 1, got {growth}")
+        
+        sizes: list[int] = []
+        size = float(min_chunk)
+        while int(size) < slab_size:
+            chunk = (int(size) + 7) & ~7
+            if not sizes or chunk > sizes[-1]:
+                sizes.append(min(chunk, slab_size))
+            size *= growth
+        if not sizes or sizes[-1] < slab_size:
+            sizes.append(slab_size)
+        if len(sizes) >= self._OVERSIZE:
+            raise ValueError("too many size classes; raise growth or min_chunk")
+        
+        self.slab_size = slab_size
+        self.chunk_sizes: tuple[int, ...] = tuple(sizes)
+        self._per_slab = [slab_size // s for s in sizes]
+        self.clear()
     
-    def _debug_state(self) -> dict:
-        """
-        Return internal state for debugging/testing.
+    def clear(self) -> None:
+        """Free every value and release all slabs."""
+        n = len(self.chunk_sizes)
+        self._slabs: list[list[bytearray]] = [[] for _ in range(n)]
+        self._lengths = [array('I') for _ in range(n)]
+        self._free = [array('q') for _ in range(n)]
+        self._oversize: dict[int, bytes] = {}
+        self._next_oversize = 0
+        self._live = 0
+        self._used_bytes = 0
+    
+    def __len__(self) -> int:
+        """Number of live values."""
+        return self._live
+    
+    @property
+    def used_bytes(self) -> int:
+        """Bytes of encoded data currently stored."""
+        return self._used_bytes
+    
+    @property
+    def allocated_bytes(self) -> int:
+        """Bytes held in slabs and oversize blocks."""
+        slabs = sum(len(s) for s in self._slabs) * self.slab_size
+        return slabs + sum(len(b) for b in self._oversize.values())
+    
+    def put(self, data: bytes) -> int:
+        """Copy ``data`` into the arena and return its handle."""
+        n = len(data)
+        self._live += 1
+        self._used_bytes += n
         
-        Returns dict with:
-            - entries: list of (key, value, expires_at) in LRU->MRU order
-            - size: current entry count
-            - max_size: configured max size
-        """
+        cls = bisect_left(self.chunk_sizes, n)
+        if cls == len(self.chunk_sizes):
+            block = self._next_oversize
+            self._next_oversize += 1
+            self._oversize[block] = bytes(data)
+            return block << self._CLASS_BITS | self._OVERSIZE
+        
+        lengths = self._lengths[cls]
+        free = self._free[cls]
+        if free:
+            chunk = free.pop()
+            lengths[chunk] = n
+        else:
+            chunk = len(lengths)
+            lengths.append(n)
+            if chunk % self._per_slab[cls] == 0:
+                self._slabs[cls].append(bytearray(self.slab_size))
+        
+        slab, index = divmod(chunk, self._per_slab[cls])
+        start = index * self.chunk_sizes[cls]
+        self._slabs[cls][slab][start:start + n] = data
+        return chunk << self._CLASS_BITS | cls
+    
+    def get(self, handle: int) -> bytes | bytearray:
+        """Return a copy of the data stored under ``handle``."""
+        cls = handle & self._CLASS_MASK
+        chunk = handle >> self._CLASS_BITS
+        if cls == self._OVERSIZE:
+            return self._oversize[chunk]
+        slab, index = divmod(chunk, self._per_slab[cls])
+        start = index * self.chunk_sizes[cls]
+        return self._slabs[cls][slab][start:start + self._lengths[cls][chunk]]
+    
+    def free(self, handle: int) -> None:
+        """Return the chunk behind ``handle`` to its class free list."""
+        cls = handle & self._CLASS_MASK
+        chunk = handle >> self._CLASS_BITS
+        if cls == self._OVERSIZE:
+            n = len(self._oversize.pop(chunk))
+        else:
+            lengths = self._lengths[cls]
+            n = lengths[chunk]
+            lengths[chunk] = 0
+            self._free[cls].append(chunk)
+        self._live -= 1
+        self._used_bytes -= n
+    
+    def snapshot(self) -> dict:
+        """Occupancy summary, per size class with at least one slab."""
+        classes = [
+            {
+                "chunk_size": self.chunk_sizes[cls],
+                "slabs": len(slabs),
+                "chunks": len(self._lengths[cls]) - len(self._free[cls]),
+                "free_chunks": len(self._free[cls]),
+            }
+            for cls, slabs in enumerate(self._slabs) if slabs
+        ]
         return {
-            "entries": [
-                (k, v, exp) for k, (v, exp) in self._cache.items()
-            ],
-            "size": len(self._cache),
-            "max_size": self._max_size
+            "values": self._live,
+            "used_bytes": self._used_bytes,
+            "allocated_bytes": self.allocated_bytes,
+            "oversize_values": len(self._oversize),
+            "classes": classes,
         }
-    
-    def __repr__(self) -> str:
-        return (
-            f"PersistentLRUTTLCache("
-            f"max_size={self._max_size}, "
-            f"current_size={len(self)}, "
-            f"path={self._persist_path!r})"
-        )
 
 
-# =============================================================================
-# DETERMINISTIC TEST SUITE
-# =============================================================================
+# name -> (flag byte, compress(data, level), decompress(data), default level)
+_COMPRESSION_ALGORITHMS: dict[str, tuple[int, Callable, Callable, int]] = {
+    "zlib": (1, lambda d, lvl: zlib.compress(d, lvl), zlib.decompress, 6),
+    "bz2": (2, lambda d, lvl: bz2.compress(d, lvl), bz2.decompress, 9),
+    "lzma": (3, lambda d, lvl: lzma.compress(d, preset=lvl), lzma.decompress, 6),
+}
+_ALGORITHM_BY_FLAG = {spec[0]: name for name, spec in _COMPRESSION_ALGORITHMS.items()}
+# flag byte -> incremental decompressor factory (for streaming blobs)
+_STREAM_DECOMPRESSORS: dict[int, Callable[[], Any]] = {
+    1: zlib.decompressobj, 2: bz2.BZ2Decompressor, 3: lzma.LZMADecompressor,
+}
 
-import unittest
-from unittest import TestCase
+# First bytes of a binary (PickleCodec) persistence file
+_BINARY_MAGIC = b"LRUTTL-P5\n"
 
+# Raised by the stdlib decompressors on corrupt input
+_DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, OSError, ValueError, EOFError)
 
-class MockClock:
-    """Deterministic clock for testing."""
+
+def decompress_with(algorithm: str, payload: bytes) -> bytes:
+    """
+    Decompress ``payload`` with a named algorithm from _COMPRESSION_ALGORITHMS.
     
-    def __init__(self, start: float = 0.0):
-        self._time = start
+    Raises:
+        ValueError: If the algorithm is unknown
+    """
+    spec = _COMPRESSION_ALGORITHMS.get(algorithm)
+    if spec is None:
+        raise ValueError(f"unknown compression algorithm: {algorithm!r}")
+    return spec[2](payload)
+
+
+class ValueCompressor:
+    """
+    Per-entry compression of encoded values at or above a size threshold.
     
-    def __call__(self) -> float:
-        return self._time
+    pack() prefixes one flag byte: 0 for data stored as-is, otherwise the
+    algorithm's id. Data below the threshold, or that does not shrink, is
+    stored as-is so small values pay no decompression cost.
     
-    def advance(self, seconds: float) -> None:
-        self._time += seconds
+    Counters (CPU time from time.thread_time):
+        compressed, bytes_in, bytes_out: values compressed and their sizes
+        below_threshold, incompressible: values stored as-is
+        compress_seconds, decompressions, decompress_seconds
+    """
     
-    def set(self, time: float) -> None:
-        self._time = time
+    def __init__(
+        self,
+        algorithm: str = "zlib",
+        *,
+        level: int | None = None,
+        threshold: int = 1024
+    ) -> None:
+        """
+        Args:
+            algorithm: "zlib", "bz2" or "lzma"
+            level: Compression level (lzma preset); None for the default
+            threshold: Minimum encoded size in bytes to attempt compression
+        
+        Raises:
+            ValueError: If the algorithm is unknown or threshold < 0
+        """
+        if algorithm not in _COMPRESSION_ALGORITHMS:
+            raise ValueError(
+                f"algorithm must be one of {tuple(_COMPRESSION_ALGORITHMS)}, "
+                f"got {algorithm!r}"
+            )
+        if threshold < 0:
+            raise ValueError(f"threshold must be >= 0, got {threshold}")
+        
+        self.algorithm = algorithm
+        flag, self._compress, self._decompress, default = (
+            _COMPRESSION_ALGORITHMS[algorithm]
+        )
+        self._flag = bytes([flag])
+        self.level = default if level is None else level
+        self.threshold = threshold
+        self.reset()
+    
+    def reset(self) -> None:
+        """Zero all counters."""
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.below_threshold = 0
+        self.incompressible = 0
+        self.compress_seconds = 0.0
+        self.decompressions = 0
+        self.decompress_seconds = 0.0
+    
+    def pack(self, data: bytes) -> bytes:
+        """Return flag byte + (compressed or original) data."""
+        if len(data) < self.threshold:
+            self.below_threshold += 1
+            return b"\x00" + data
+        
+        started = time.thread_time()
+        payload = self._compress(data, self.level)
+        self.compress_seconds += time.thread_time() - started
+        if len(payload) >= len(data):
+            self.incompressible += 1
+            return b"\x00" + data
+        
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(payload)
+        return self._flag + payload
+    
+    def unpack(self, blob: bytes | bytearray) -> bytes | bytearray:
+        """Inverse of pack()."""
+        if not blob[0]:
+            return blob[1:]
+        started = time.thread_time()
+        data = self._decompress(blob[1:])
+        self.decompress_seconds += time.thread_time() - started
+        self.decompressions += 1
+        return data
+    
+    def adopt(self, algorithm: str, payload: bytes) -> bytes | None:
+        """
+        Wrap an already-compressed payload from persistence as a packed blob.
+        
+        Returns None if it was compressed with a different algorithm.
+        """
+        if algorithm != self.algorithm:
+            return None
+        return self._flag + payload
+    
+    @property
+    def ratio(self) -> float:
+        """Original / compressed bytes over compressed values (1.0 if none)."""
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+    
+    def snapshot(self) -> dict:
+        """Plain-dict copy of all counters, plus ratio and settings."""
+        return {
+            "algorithm": self.algorithm,
+            "level": self.level,
+            "threshold": self.threshold,
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": self.ratio,
+            "below_threshold": self.below_threshold,
+            "incompressible": self.incompressible,
+            "compress_seconds": self.compress_seconds,
+            "decompressions": self.decompressions,
+            "decompress_seconds": self.decompress_seconds,
+        }
 
 
-class TestTTLExpiry(TestCase):
-    """Test 1: TTL expiry removal."""
+class JsonCodec:
+    """Values as compact UTF-8 JSON, the persistence file's native encoding."""
     
-    def setUp(self):
-        self.clock = MockClock(1000.0)
-        self.path = tempfile.mktemp(suffix='.json')
-        self.cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
+    name = "json"
+    
+    def encode(self, value: Any) -> bytes:
+        """
+        Raises:
+            SerializationError: If value cannot be JSON-serialized
+        """
+        try:
+            return json.dumps(
+                value, separators=(',', ':'), ensure_ascii=False
+            ).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            raise SerializationError(
+                f"value is not JSON-serializable: {type(value).__name__} - {e}"
+            ) from e
+    
+    def decode(self, data: bytes | bytearray) -> Any:
+        return json.loads(data)
+
+
+class PickleCodec:
+    """
+    Pickle protocol 5 with out-of-band buffers.
+    
+    encode() produces a single in-band pickle (used with an arena or
+    compressor). encode_frames() returns (header, buffers): top-level
+    bytes-like values of at least buffer_threshold bytes, and objects that
+    export protocol-5 buffers such as NumPy arrays, keep their data out of
+    the pickle stream. Read-only buffers are referenced, writable ones
+    are copied once so later caller mutation cannot leak into the cache.
+    decode_frames() hands the stored buffers back, so a large bytes value
+    comes back as a read-only memoryview over the cached buffer.
+    
+    Unpickling runs arbitrary code: only load files this process wrote.
+    """
+    
+    name = "pickle"
+    
+    def __init__(self, *, buffer_threshold: int = 1024) -> None:
+        """
+        Args:
+            buffer_threshold: Minimum size of a top-level bytes-like value
+                to store out-of-band (smaller ones stay in the pickle)
+        """
+        self.buffer_threshold = buffer_threshold
+    
+    def encode(self, value: Any) -> bytes:
+        """
+        Raises:
+            SerializationError: If value cannot be pickled
+        """
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        try:
+            return pickle.dumps(value, protocol=5)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise SerializationError(
+                f"value is not picklable: {type(value).__name__} - {e}"
+            ) from e
+    
+    def decode(self, data: bytes | bytearray) -> Any:
+        return pickle.loads(data)
+    
+    def encode_frames(self, value: Any) -> tuple[bytes, tuple[memoryview, ...]]:
+        """
+        Pickle with out-of-band buffers.
+        
+        Raises:
+            SerializationError: If value cannot be pickled
+        """
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            view = memoryview(value)
+            if view.nbytes >= self.buffer_threshold and view.c_contiguous:
+                if isinstance(value, memoryview) and value.format != 'B':
+                    value = view.cast('B')
+                value = pickle.PickleBuffer(value)
+            elif isinstance(value, memoryview):
+                value = view.tobytes()
+        
+        pickled: list[pickle.PickleBuffer] = []
+        try:
+            header = pickle.dumps(value, protocol=5, buffer_callback=pickled.append)
+        except (pickle.PicklingError, TypeError, AttributeError, BufferError) as e:
+            raise SerializationError(
+                f"value is not picklable: {type(value).__name__} - {e}"
+            ) from e
+        
+        buffers = []
+        for buf in pickled:
+            raw = buf.raw()
+            buffers.append(raw if raw.readonly else memoryview(raw.tobytes()))
+        return header, tuple(buffers)
+    
+    def decode_frames(self, header: bytes, buffers: tuple[memoryview, ...]) -> Any:
+        return pickle.loads(header, buffers=buffers)
+
+
+class BlobRef:
+    """Reference to a value held in a BlobStore file."""
+    
+    __slots__ = ('digest', 'size')
+    
+    def __init__(self, digest: str, size: int) -> None:
+        self.digest = digest
+        self.size = size
+    
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, BlobRef) and self.digest == other.digest
+    
+    def __hash__(self) -> int:
+        return hash(self.digest)
+    
+    def __repr__(self) -> str:
+        return f"BlobRef({self.digest[:12]}..., size={self.size})"
+
+
+class BlobStore:
+    """
+    Content-addressed files for values at or above a size threshold.
+    
+    Each blob lives at ``<directory>/<sha256[:2]>/<sha256>`` and is written
+    once (atomically); equal values share one file. References are counted
+    in memory. A blob whose count drops to zero becomes an orphan and its
+    file is deleted by collect(), which the cache runs after flush() has
+    replaced the snapshot, so a snapshot on disk never points at a deleted
+    blob. sweep() removes files no live entry references (e.g. left by a
+    crash) and runs after load().
+    
+    The directory must belong to a single cache.
+    
+    Counters: blobs_written, bytes_written, blobs_deleted, reads
+    """
+    
+    def __init__(self, directory: str, *, threshold: int = 1 << 20) -> None:
+        """
+        Args:
+            directory: Blob directory (created if missing)
+            threshold: Minimum stored size in bytes for a value to go to a blob
+        
+        Raises:
+            ValueError: If threshold < 1
+        """
+        if threshold < 1:
+            raise ValueError(f"threshold must be >= 1, got {threshold}")
+        self.directory = Path(directory)
+        self.threshold = threshold
+        self._refs: dict[str, int] = {}
+        self._orphans: set[str] = set()
+        self.blobs_written = 0
+        self.bytes_written = 0
+        self.blobs_deleted = 0
+        self.reads = 0
+    
+    def path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+    
+    def __len__(self) -> int:
+        """Number of referenced blobs."""
+        return len(self._refs)
+    
+    def refcount(self, digest: str) -> int:
+        return self._refs.get(digest, 0)
+    
+    def put(self, data: bytes | bytearray) -> BlobRef:
+        """Store ``data`` (if not already present) and take a reference."""
+        digest = hashlib.sha256(data).hexdigest()
+        ref = BlobRef(digest, len(data))
+        if digest not in self._refs and not self.path(digest).exists():
+            self._write(digest, data)
+        self.retain(ref)
+        return ref
+    
+    def retain(self, ref: BlobRef) -> None:
+        self._refs[ref.digest] = self._refs.get(ref.digest, 0) + 1
+        self._orphans.discard(ref.digest)
+    
+    def release(self, ref: BlobRef) -> None:
+        count = self._refs[ref.digest] - 1
+        if count:
+            self._refs[ref.digest] = count
+        else:
+            del self._refs[ref.digest]
+            self._orphans.add(ref.digest)
+    
+    def release_all(self) -> None:
+        self._orphans.update(self._refs)
+        self._refs.clear()
+    
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).exists()
+    
+    def read(self, ref: BlobRef) -> bytes:
+        self.reads += 1
+        return self.path(ref.digest).read_bytes()
+    
+    def open(self, ref: BlobRef) -> Any:
+        """Open the blob for streaming reads (binary file object)."""
+        self.reads += 1
+        return open(self.path(ref.digest), 'rb')
+    
+    def collect(self) -> int:
+        """Delete files of orphaned blobs; returns the number deleted."""
+        deleted = 0
+        for digest in self._orphans:
+            if digest not in self._refs and self._unlink(self.path(digest)):
+                deleted += 1
+        self._orphans.clear()
+        return deleted
+    
+    def sweep(self, keep: set[str] | frozenset[str] = frozenset()) -> int:
+        """
+        Delete every file in the directory that no entry references.
+        
+        Digests in ``keep`` (still named by the snapshot on disk) become
+        orphans instead, to be deleted by the collect() after next flush.
+        """
+        deleted = 0
+        self._orphans.clear()
+        if not self.directory.is_dir():
+            return 0
+        for sub in self.directory.iterdir():
+            if not sub.is_dir():
+                continue
+            for path in sub.iterdir():
+                if path.name in self._refs:
+                    continue
+                if path.name in keep:
+                    self._orphans.add(path.name)
+                elif self._unlink(path):
+                    deleted += 1
+        return deleted
+    
+    def _write(self, digest: str, data: bytes | bytearray) -> None:
+        target = self.path(digest)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            suffix='.tmp', prefix='.blob_', dir=target.parent
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, target)
+        except:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        self.blobs_written += 1
+        self.bytes_written += len(data)
+    
+    def _unlink(self, path: Path) -> bool:
+        try:
+            path.unlink()
+        except OSError:
+            return False
+        self.blobs_deleted += 1
+        return True
+
+
+class _SortedKeys:
+    """
+    Sorted list of str keys split into sublists of at most 2 * LOAD items.
+    
+    Insert and delete cost O(log n + LOAD) instead of the O(n) memmove of
+    one flat list; range scans walk sublists in order.
+    """
+    
+    LOAD = 512
+    
+    def __init__(self) -> None:
+        self._lists: list[list[str]] = []
+        self._maxes: list[str] = []
+        self._len = 0
+    
+    def __len__(self) -> int:
+        return self._len
+    
+    def add(self, key: str) -> None:
+        lists, maxes = self._lists, self._maxes
+        self._len += 1
+        if not maxes:
+            lists.append([key])
+            maxes.append(key)
+            return
+        
+        i = bisect_left(maxes, key)
+        if i == len(maxes):
+            i -= 1
+            lst = lists[i]
+            lst.append(key)
+            maxes[i] = key
+        else:
+            lst = lists[i]
+            insort(lst, key)
+        
+        if len(lst) > 2 * self.LOAD:
+            half = self.LOAD
+            lists[i:i + 1] = [lst[:half], lst[half:]]
+            maxes[i:i + 1] = [lst[half - 1], lst[-1]]
+    
+    def discard(self, key: str) -> None:
+        lists, maxes = self._lists, self._maxes
+        i = bisect_left(maxes, key)
+        if i == len(maxes):
+            return
+        lst = lists[i]
+        j = bisect_left(lst, key)
+        if j == len(lst) or lst[j] != key:
+            return
+        del lst[j]
+        self._len -= 1
+        if lst:
+            maxes[i] = lst[-1]
+        else:
+            del lists[i]
+            del maxes[i]
+    
+    def iter_from(self, low: str) -> Iterator[str]:
+        """Yield keys >= low in sorted order."""
+        lists = self._lists
+        i = bisect_left(self._maxes, low)
+        if i == len(lists):
+            return
+        lst = lists[i]
+        yield from lst[bisect_left(lst, low):]
+        for lst in lists[i + 1:]:
+            yield from lst
+
+
+class TagIndex:
+    """
+    Secondary index for bulk invalidation by tag or key prefix.
+    
+    Tags map to key sets and str keys are kept in a _SortedKeys, so both
+    lookups cost O(matches) plus a logarithmic seek, never a scan of the
+    cache. The cache updates the index on every insert and removal
+    (set, delete, eviction, expiry, clear, load), and persists tags.
+    Non-str keys can be tagged but are not prefix-indexed.
+    """
+    
+    def __init__(self, *, prefixes: bool = True) -> None:
+        """
+        Args:
+            prefixes: Maintain the sorted key index for invalidate_prefix()
+        """
+        self._prefixes = prefixes
+        self.clear()
+    
+    def clear(self) -> None:
+        self._tags: dict[str, set[Any]] = {}
+        self._key_tags: dict[Any, tuple[str, ...]] = {}
+        self._sorted = _SortedKeys() if self._prefixes else None
+    
+    def add(self, key: Any, tags: tuple[str, ...] = ()) -> None:
+        """Index a newly inserted key (the cache removes it first on overwrite)."""
+        if tags:
+            self._key_tags[key] = tags
+            for tag in tags:
+                keys = self._tags.get(tag)
+                if keys is None:
+                    self._tags[tag] = {key}
+                else:
+                    keys.add(key)
+        if self._sorted is not None and type(key) is str:
+            self._sorted.add(key)
+    
+    def remove(self, key: Any) -> None:
+        """Drop a key from the index (no-op if absent)."""
+        tags = self._key_tags.pop(key, ())
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+        if self._sorted is not None and type(key) is str:
+            self._sorted.discard(key)
+    
+    def tags_of(self, key: Any) -> tuple[str, ...]:
+        return self._key_tags.get(key, ())
+    
+    def keys_with_tag(self, tag: str) -> list[Any]:
+        return list(self._tags.get(tag, ()))
+    
+    def keys_with_prefix(self, prefix: str) -> list[str]:
+        """
+        Raises:
+            RuntimeError: If the index was created with prefixes=False
+        """
+        if self._sorted is None:
+            raise RuntimeError("prefix index disabled (prefixes=False)")
+        matches = []
+        for key in self._sorted.iter_from(prefix):
+            if not key.startswith(prefix):
+                break
+            matches.append(key)
+        return matches
+    
+    def snapshot(self) -> dict:
+        return {
+            "tags": len(self._tags),
+            "tagged_keys": len(self._key_tags),
+            "prefix_keys": len(self._sorted) if self._sorted is not None else None,
+        }
+
+
+class _Sentinel:
+    """Named marker returned by PersistentLRUTTLCache.lookup()."""
+    
+    __slots__ = ('_name',)
+    
+    def __init__(self, name: str) -> None:
+        self._name = name
+    
+    def __repr__(self) -> str:
+        return self._name
+    
+    def __bool__(self) -> bool:
+        return False
+
+
+# lookup() results for "never seen / expired" and "known not to exist"
+MISS = _Sentinel("MISS")
+NEGATIVE = _Sentinel("NEGATIVE")
+
+
+class NegativeCache:
+    """
+    Bounded LRU of keys known not to exist, with its own short TTL.
+    
+    Negatives live apart from positive entries, so a flood of lookups for
+    missing keys evicts only other negatives. They are memory-only: a
+    negative is a hint with a short lifetime, not data worth persisting.
+    The owning cache drops a key's negative when the key is set, and its
+    positive entry when the key is marked negative.
+    """
+    
+    __slots__ = ('_max_size', '_ttl', '_keys', 'hits', 'stores', 'evictions',
+                 'expired')
+    
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 30.0) -> None:
+        """
+        Args:
+            max_size: Maximum negative entries (must be >= 1)
+            ttl_seconds: Default lifetime of a negative entry (must be > 0)
+        
+        Raises:
+            ValueError: If max_size < 1 or ttl_seconds <= 0
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be >= 1, got {max_size}")
+        if ttl_seconds <= 0:
+            raise ValueError(f"ttl_seconds must be > 0, got {ttl_seconds}")
+        self._max_size = max_size
+        self._ttl = ttl_seconds
+        self._keys: OrderedDict[Any, float] = OrderedDict()
+        self.hits = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+    
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+    
+    @property
+    def ttl_seconds(self) -> float:
+        return self._ttl
+    
+    def add(self, key: Any, now: float, ttl_seconds: float | None = None) -> None:
+        """Record ``key`` as absent until now + ttl (default ttl_seconds)."""
+        keys = self._keys
+        keys.pop(key, None)
+        while len(keys) >= self._max_size:
+            keys.popitem(last=False)
+            self.evictions += 1
+        keys[key] = now + (self._ttl if ttl_seconds is None else ttl_seconds)
+        self.stores += 1
+    
+    def check(self, key: Any, now: float) -> bool:
+        """True if ``key`` has a live negative entry (refreshes its LRU slot)."""
+        expires_at = self._keys.get(key)
+        if expires_at is None:
+            return False
+        if now >= expires_at:
+            del self._keys[key]
+            self.expired += 1
+            return False
+        self._keys.move_to_end(key)
+        self.hits += 1
+        return True
+    
+    def discard(self, key: Any) -> bool:
+        return self._keys.pop(key, None) is not None
+    
+    def clear(self) -> None:
+        self._keys.clear()
+    
+    def __len__(self) -> int:
+        return len(self._keys)
+    
+    def __contains__(self, key: Any) -> bool:
+        return key in self._keys
+    
+    def snapshot(self) -> dict:
+        return {
+            "entries": len(self._keys),
+            "max_size": self._max_size,
+            "ttl_seconds": self._ttl,
+            "hits": self.hits,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+
+class MutationJournal:
+    """
+    Bounded, sequenced log of a cache's set/delete/clear mutations.
+    
+    Feeds replication (see cache_replication.py). Every mutation gets the
+    next sequence number; only the last ``capacity`` are kept, so a reader
+    that falls further behind must resynchronise from a full snapshot.
+    Evictions (by set() or resize()) are logged as "evict" ahead of the
+    set that caused them, so a replica drops the same keys instead of its
+    own LRU ones. Hits are not logged (they would cost every get() and
+    fill the journal on read-heavy loads): a replica's recency order is
+    that of its snapshot and the writes since. Expiry is not logged:
+    replicas with the same clock apply it on their own. Values are logged
+    by reference.
+    
+    Entries: (seq, op, key, value, expires_at) with op "set", "delete",
+    "evict", "clear" or "reset" (after load(): readers need a new
+    snapshot); key, value and expires_at are None where unused.
+    """
+    
+    __slots__ = ('_entries', 'seq', 'listeners')
+    
+    def __init__(self, capacity: int = 100_000) -> None:
+        """
+        Args:
+            capacity: Mutations retained for catching up (must be >= 1)
+        
+        Raises:
+            ValueError: If capacity < 1
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity must be >= 1, got {capacity}")
+        self._entries: deque[tuple] = deque(maxlen=capacity)
+        self.seq = 0
+        # Called with each new entry (e.g. to wake replication senders)
+        self.listeners: list[Callable[[tuple], None]] = []
+    
+    @property
+    def capacity(self) -> int:
+        return self._entries.maxlen
+    
+    @property
+    def first_seq(self) -> int:
+        """Oldest retained sequence number (seq + 1 when empty)."""
+        return self._entries[0][0] if self._entries else self.seq + 1
+    
+    def append(
+        self,
+        op: str,
+        key: Any = None,
+        value: Any = None,
+        expires_at: float | None = None
+    ) -> None:
+        self.seq += 1
+        entry = (self.seq, op, key, value, expires_at)
+        self._entries.append(entry)
+        for listener in self.listeners:
+            listener(entry)
+    
+    def since(self, seq: int) -> list[tuple] | None:
+        """
+        Entries after ``seq``, or None if some were already dropped (the
+        reader must resynchronise from a snapshot).
+        """
+        if seq >= self.seq:
+            return []
+        first = self.first_seq
+        if seq + 1 < first:
+            return None
+        return list(itertools.islice(self._entries, seq + 1 - first, None))
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteBackend:
+    """
+    Incremental persistence in an SQLite database (WAL mode).
+    
+    Replaces the snapshot file: flush() writes only what changed since the
+    last flush, and load() reads the max_size most recently used live rows
+    with one query on the seq index.
+    
+    Schema (one row per entry):
+        entries(key TEXT PRIMARY KEY,   -- JSON-encoded key
+                value BLOB,             -- codec-encoded value
+                expires_at REAL, seq INTEGER, tags TEXT)
+        index on seq (LRU order), partial index on expires_at
+    
+    The cache reports every set, hit, removal and clear. A hit only moves
+    the entry to MRU, so its row just gets a new seq; a set upserts the
+    whole row. Entries touched since the last flush are exactly the MRU
+    tail of the cache, so numbering them in touch order after the current
+    maximum seq keeps the table's order equal to the cache's. Expired rows
+    are removed in bulk through the expires_at index on every flush.
+    
+    Changes are written in transactions of at most batch_size rows, so
+    WAL readers and checkpoints are never blocked for long.
+    """
+    
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL, "
+        "seq INTEGER NOT NULL, tags TEXT)",
+        "CREATE INDEX IF NOT EXISTS entries_seq ON entries (seq)",
+        "CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at) "
+        "WHERE expires_at IS NOT NULL",
+    )
+    _SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+    
+    def __init__(self, *, batch_size: int = 1000, synchronous: str = "NORMAL") -> None:
+        """
+        Args:
+            batch_size: Rows per write transaction (must be >= 1)
+            synchronous: SQLite synchronous pragma; NORMAL is durable
+                against process crashes in WAL mode, FULL also against
+                power loss
+        
+        Raises:
+            ValueError: If batch_size < 1 or synchronous is unknown
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be >= 1, got {batch_size}")
+        if synchronous.upper() not in self._SYNCHRONOUS:
+            raise ValueError(
+                f"synchronous must be one of {self._SYNCHRONOUS}, got {synchronous!r}"
+            )
+        self._batch_size = batch_size
+        self._synchronous = synchronous.upper()
+        self._conn: sqlite3.Connection | None = None
+        self._seq = 0
+        # key -> True if its value changed, False if it only moved to MRU;
+        # kept in touch order
+        self._changed: dict[Any, bool] = {}
+        self._removed: set[Any] = set()
+        self._cleared = False
+        self._trim_below: int | None = None
+        self.rows_written = 0
+        self.rows_deleted = 0
+        self.transactions = 0
+    
+    def open(self, path: str | Path) -> None:
+        """Open (creating if needed) the database; called by the cache."""
+        # The cache serialises access; flush() may run on another thread
+        conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self._synchronous}")
+        for statement in self._SCHEMA:
+            conn.execute(statement)
+        self._seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM entries").fetchone()[0]
+        self._conn = conn
+    
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+    
+    @property
+    def pending(self) -> int:
+        """Rows the next flush will write or delete."""
+        return len(self._changed) + len(self._removed)
+    
+    def touch(self, key: Any) -> None:
+        changed = self._changed
+        value_changed = changed.pop(key, False)
+        changed[key] = value_changed
+    
+    def changed(self, key: Any) -> None:
+        self._removed.discard(key)
+        self._changed.pop(key, None)
+        self._changed[key] = True
+    
+    def removed(self, key: Any) -> None:
+        self._changed.pop(key, None)
+        self._removed.add(key)
+    
+    def cleared(self) -> None:
+        self._changed.clear()
+        self._removed.clear()
+        self._cleared = True
+    
+    def _reset(self) -> None:
+        self._changed.clear()
+        self._removed.clear()
+        self._cleared = False
+    
+    def _write(self, sql: str, rows: list[tuple]) -> None:
+        """executemany() in transactions of at most batch_size rows."""
+        conn = self._conn
+        size = self._batch_size
+        for i in range(0, len(rows), size):
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(sql, rows[i:i + size])
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self.transactions += 1
+    
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        """One statement in its own transaction; returns rows affected."""
+        count = self._conn.execute(sql, params).rowcount
+        self.transactions += 1
+        return count
+    
+    def sync(self, cache: PersistentLRUTTLCache) -> int:
+        """
+        Write the changes since the last sync.
+        
+        Returns:
+            Value bytes written
+        """
+        upserts: list[tuple] = []
+        moves: list[tuple] = []
+        bytes_written = 0
+        index = cache._index
+        for key, value_changed in self._changed.items():
+            entry = cache._cache.get(key)
+            if entry is None:
+                continue
+            self._seq += 1
+            encoded_key = json.dumps(key)
+            if not value_changed:
+                moves.append((self._seq, encoded_key))
+                continue
+            stored, expires_at = entry
+            blob = cache._codec.encode(cache._unpack(stored) if cache._packed else stored)
+            tags = index.tags_of(key) if index is not None else ()
+            upserts.append((
+                encoded_key, blob, expires_at, self._seq,
+                json.dumps(list(tags)) if tags else None,
+            ))
+            bytes_written += len(blob)
+        deletes = [(json.dumps(key),) for key in self._removed]
+        
+        if self._cleared:
+            self.rows_deleted += self._execute("DELETE FROM entries")
+        self._write("DELETE FROM entries WHERE key = ?", deletes)
+        self._write(
+            "INSERT INTO entries (key, value, expires_at, seq, tags) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+            "value = excluded.value, expires_at = excluded.expires_at, "
+            "seq = excluded.seq, tags = excluded.tags",
+            upserts
+        )
+        self._write("UPDATE entries SET seq = ? WHERE key = ?", moves)
+        self.rows_deleted += len(deletes) + self._execute(
+            "DELETE FROM entries WHERE expires_at <= ?", (cache._now(),)
+        )
+        if self._trim_below is not None:
+            # Rows beyond max_size that the last load() skipped
+            self.rows_deleted += self._execute(
+                "DELETE FROM entries WHERE seq < ?", (self._trim_below,)
+            )
+            self._trim_below = None
+        self.rows_written += len(upserts) + len(moves)
+        self._reset()
+        return bytes_written
+    
+    def load_into(self, cache: PersistentLRUTTLCache) -> None:
+        """Insert the max_size most recently used live rows, LRU first."""
+        rows = self._conn.execute(
+            "SELECT key, value, expires_at, tags, seq FROM entries "
+            "WHERE expires_at IS NULL OR expires_at > ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (cache._now(), cache._max_size)
+        ).fetchall()
+        codec = cache._codec
+        for encoded_key, blob, expires_at, tags, _ in reversed(rows):
+            try:
+                key = json.loads(encoded_key)
+                hash(key)
+                value = codec.decode(blob)
+                stored = cache._store(cache._encode(value)) if cache._packed else value
+            except (ValueError, TypeError, SerializationError, pickle.UnpicklingError,
+                    EOFError):
+                continue
+            cache._load_insert(key, stored, expires_at, json.loads(tags) if tags else None)
+        if len(rows) == cache._max_size:
+            self._trim_below = rows[-1][4]
+        self._reset()
+    
+    def snapshot(self) -> dict:
+        return {
+            "pending": self.pending,
+            "rows_written": self.rows_written,
+            "rows_deleted": self.rows_deleted,
+            "transactions": self.transactions,
+        }
+
+
+def _write_shard(path: str, entries: list[dict]) -> int:
+    """Write one snapshot shard (runs in a ShardedSnapshot worker)."""
+    return write_atomically(
+        Path(path), lambda f: json.dump(entries, f, indent=2, ensure_ascii=False)
+    )
+
+
+def _read_shard(path: str) -> list:
+    """Read one snapshot shard (runs in a ShardedSnapshot worker)."""
+    with open(path, 'rb') as f:
+        return json.loads(f.read())
+
+
+class ShardedSnapshot:
+    """
+    JSON snapshot split over shard files written and read by a process pool.
+    
+    JSON encoding and decoding hold the GIL, so one file is bound to one
+    core. With a ShardedSnapshot, flush() cuts the LRU-to-MRU entry list
+    into contiguous ranges and workers encode and write one shard file
+    each; the persist_path file becomes a manifest listing the shards in
+    order:
+    
+        {"version": 3, "max_size": <int>,
+         "shards": [{"file": "<name>.shard-<gen>-<i>.json", "entries": <n>}, ...]}
+    
+    Because shards are contiguous ranges, concatenating them in manifest
+    order restores the global LRU order exactly; load() decodes them in
+    parallel and skips the LRU-most shards that max_size would truncate.
+    
+    Shards are written atomically under a fresh generation name before
+    the manifest is replaced, and the previous generation's files are only
+    deleted afterwards, so a crash at any point leaves a loadable snapshot.
+    
+    The pool (spawn context) is started on first use and lives until
+    close(); with workers=1 shards are handled in-process.
+    """
+    
+    def __init__(
+        self,
+        shards: int | None = None,
+        *,
+        workers: int | None = None,
+        min_shard_entries: int = 10_000
+    ) -> None:
+        """
+        Args:
+            shards: Maximum shard files per snapshot (default: workers)
+            workers: Worker processes (default: os.cpu_count())
+            min_shard_entries: Fewer entries per shard than this are not
+                worth a process round trip; small caches use fewer shards
+        
+        Raises:
+            ValueError: If any argument is < 1
+        """
+        workers = workers if workers is not None else (os.cpu_count() or 1)
+        shards = shards if shards is not None else workers
+        for name, value in (("shards", shards), ("workers", workers),
+                            ("min_shard_entries", min_shard_entries)):
+            if value < 1:
+                raise ValueError(f"{name} must be >= 1, got {value}")
+        self._shards = shards
+        self._workers = workers
+        self._min_shard_entries = min_shard_entries
+        self._pool: ProcessPoolExecutor | None = None
+    
+    @property
+    def shards(self) -> int:
+        return self._shards
+    
+    def _map(self, fn: Callable, *iterables: Iterable) -> list:
+        """fn over the arguments, in the pool if there is work for more than one."""
+        args = list(zip(*iterables))
+        if self._workers == 1 or len(args) < 2:
+            return [fn(*a) for a in args]
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._workers, mp_context=get_context("spawn")
+            )
+        return list(self._pool.map(fn, *zip(*args)))
+    
+    def write(self, path: Path, entries: list[dict], max_size: int) -> int:
+        """
+        Write entries (LRU to MRU) as shards plus the manifest at path.
+        
+        Returns:
+            Bytes written (shards and manifest)
+        """
+        count = max(1, min(self._shards, -(-len(entries) // self._min_shard_entries)))
+        bounds = [len(entries) * i // count for i in range(count + 1)]
+        generation = os.urandom(4).hex()
+        names = [f"{path.name}.shard-{generation}-{i}.json" for i in range(count)]
+        sizes = self._map(
+            _write_shard,
+            [str(path.with_name(name)) for name in names],
+            [entries[bounds[i]:bounds[i + 1]] for i in range(count)],
+        )
+        manifest = {
+            "version": 3,
+            "max_size": max_size,
+            "shards": [
+                {"file": name, "entries": bounds[i + 1] - bounds[i]}
+                for i, name in enumerate(names)
+            ],
+        }
+        bytes_written = sum(sizes) + write_atomically(
+            path, lambda f: json.dump(manifest, f, indent=2)
+        )
+        current = set(names)
+        for old in path.parent.glob(f"{path.name}.shard-*.json"):
+            if old.name not in current:
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
+        return bytes_written
+    
+    def read(self, path: Path, manifest: dict, limit: int) -> list:
+        """
+        Entries of the shards a manifest lists, LRU to MRU.
+        
+        Only the MRU-most shards holding at least ``limit`` entries are read.
+        
+        Raises:
+            ValueError, TypeError, KeyError or OSError for a bad manifest
+            or unreadable shard
+        """
+        shards = manifest["shards"]
+        if not isinstance(shards, list):
+            raise TypeError("shards must be a list")
+        files: list[str] = []
+        total = 0
+        for shard in reversed(shards):
+            if total >= limit:
+                break
+            name = shard["file"]
+            if not isinstance(name, str) or Path(name).name != name:
+                raise ValueError(f"bad shard file name {name!r}")
+            files.append(str(path.with_name(name)))
+            total += int(shard["entries"])
+        files.reverse()
+        merged: list = []
+        for entries in self._map(_read_shard, files):
+            if not isinstance(entries, list):
+                raise TypeError("shard must hold a list")
+            merged.extend(entries)
+        return merged
+    
+    def close(self) -> None:
+        """Shut the worker pool down (restarted on next use)."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def write_atomically(
+    path: Path,
+    write: Callable[[Any], None],
+    *,
+    binary: bool = False
+) -> int:
+    """
+    Write a file via a temp file in the same directory and os.replace().
+    
+    Args:
+        path: Destination file (parent directories are created)
+        write: Called with the open temp file (text UTF-8, or binary)
+        binary: Open the temp file in binary mode
+    
+    Returns:
+        Bytes written
+    
+    Raises:
+        OSError: If file cannot be written
+    """
+    # Create temp file in same directory to ensure same filesystem
+    dir_path = path.parent
+    dir_path.mkdir(parents=True, exist_ok=True)
+    
+    fd, temp_path = tempfile.mkstemp(
+        suffix='.tmp',
+        prefix='.cache_',
+        dir=dir_path
+    )
+    
+    try:
+        if binary:
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w', encoding='utf-8')
+        with f:
+            write(f)
+            f.flush()
+            bytes_written = os.fstat(f.fileno()).st_size
+        os.replace(temp_path, path)
+    except:
+        # Clean up temp file on error
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return bytes_written
+
+
+class PersistentLRUTTLCache(Generic[K, V]):
+    """
+    Thread-unsafe LRU cache with TTL and file persistence.
+    
+    Type Parameters:
+        K: Key type (must be JSON-serializable and hashable)
+        V: Value type (must be JSON-serializable)
+    
+    Attributes:
+        max_size: Maximum number of entries before eviction
+        persist_path: Path to JSON persistence file
+    
+    Behavior on corrupted/missing file:
+        - Missing file: starts with empty cache, no error
+        - Corrupted JSON: starts with empty cache, no error
+        - Invalid schema: starts with empty cache, no error
+        All cases are logged to stderr if you add logging; currently silent for cleaner output.
+    
+    Thread Safety:
+        This implementation is NOT thread-safe. Callers must provide external
+        synchronization (e.g., threading.Lock) for concurrent access.
+    """
+    
+    __slots__ = (
+        '_max_size', '_persist_path', '_now_fn', '_clock', '_cache', '_stats',
+        '_mrc', '_autosizer', '_arena', '_freeze_gc', '_compressor', '_packed',
+        '_codec', '_frames', '_blobs', '_index', '_negatives', '_hot',
+        '_journal', '_sql', '_sharded', '_scans', '_recorder', '_versions',
+        '_version_seq'
+    )
+    
+    # Open scan() snapshots kept for the OrderedDict store; the oldest is
+    # dropped when another scan starts
+    MAX_SCANS = 16
+    _SCAN_SHIFT = 40
+    _scan_ids = itertools.count(1)
+    
+    def __init__(
+        self,
+        max_size: int,
+        persist_path: str,
+        *,
+        now_fn: Callable[[], float] | None = None,
+        coarse_clock: CoarseClock | None = None,
+        stats: CacheStats | bool = True,
+        mrc: ShardsMRC | None = None,
+        autosizer: MemoryAutoSizer | None = None,
+        storage: str = "ordered",
+        arena: SlabArena | None = None,
+        freeze_gc: bool = False,
+        compressor: ValueCompressor | None = None,
+        codec: JsonCodec | PickleCodec | None = None,
+        blob_store: BlobStore | None = None,
+        tag_index: TagIndex | None = None,
+        negative_cache: NegativeCache | None = None,
+        hot_keys: HeavyHitters | None = None,
+        journal: MutationJournal | None = None,
+        backend: SqliteBackend | None = None,
+        sharded: ShardedSnapshot | None = None,
+        recorder: AccessRecorder | None = None,
+        versioned: bool = False,
+        load_on_init: bool = True
+    ) -> None:
+        """
+        Initialize the cache.
+        
+        Args:
+            max_size: Maximum entries (must be >= 1)
+            persist_path: Path to persistence file
+            now_fn: Optional time function for testing (default: time.time)
+            coarse_clock: Optional CoarseClock; when given, TTL checks read
+                its cached ``now`` attribute and now_fn is ignored
+            stats: True for default CacheStats, False to disable counting,
+                or a CacheStats instance (e.g. with a custom sample rate)
+            mrc: Optional ShardsMRC fed with every get() key, for
+                estimating hit ratios at other cache sizes
+            autosizer: Optional MemoryAutoSizer; max_size then becomes the
+                ceiling and the effective size follows memory headroom
+            storage: "ordered" (OrderedDict) or "compact" (CompactLRUStore,
+                lower per-entry memory at some CPU cost; keys(), items()
+                and scan() then page without copying keys)
+            arena: Optional SlabArena owned by this cache; values are then
+                stored JSON-encoded in its slabs and decoded on get()
+            freeze_gc: Call gc.freeze() after load() so loaded entries are
+                moved out of the cyclic GC's generations
+            compressor: Optional ValueCompressor; values are then stored
+                encoded and compressed above its size threshold
+            codec: Value codec (default JsonCodec). A PickleCodec accepts any
+                picklable value and persists to a binary file; without an
+                arena or compressor it keeps large buffers out-of-band
+            blob_store: Optional BlobStore; encoded values at or above its
+                threshold are kept in files and read back on each get()
+            tag_index: Optional TagIndex owned by this cache; enables set()
+                tags, invalidate_tag() and invalidate_prefix()
+            negative_cache: Optional NegativeCache owned by this cache;
+                enables set_negative() and negative results from lookup()
+            hot_keys: Optional HeavyHitters fed with every get() and set()
+                key; read it with hot_keys()
+            journal: Optional MutationJournal receiving every set(),
+                delete(), clear() and invalidation, for replication
+            backend: Optional SqliteBackend owned by this cache; persist_path
+                is then an SQLite database written incrementally by flush()
+            sharded: Optional ShardedSnapshot; flush() then writes the JSON
+                snapshot as shard files in parallel, with persist_path as
+                their manifest (not with a PickleCodec or backend)
+            recorder: Optional AccessRecorder sampling get() keys for a
+                Prefetcher on the next start; saved by flush()
+            versioned: Stamp every stored entry with a version number for
+                gets()/cas()
+            load_on_init: Call load() now (False when an owner such as
+                NamespacedCache fills the cache itself)
+        
+        Raises:
+            ValueError: If max_size < 1, storage is unknown, or sharded is
+                combined with a PickleCodec or backend
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be >= 1, got {max_size}")
+        if storage not in STORAGE_ENGINES:
+            raise ValueError(
+                f"storage must be one of {STORAGE_ENGINES}, got {storage!r}"
+            )
+        if sharded is not None and (isinstance(codec, PickleCodec) or backend is not None):
+            raise ValueError("sharded snapshots are JSON only: no PickleCodec or backend")
+        
+        self._max_size = max_size
+        self._persist_path = Path(persist_path)
+        self._clock = coarse_clock
+        if coarse_clock is not None:
+            self._now_fn: Callable[[], float] = coarse_clock
+        else:
+            self._now_fn = now_fn if now_fn is not None else self._default_now
+        self._cache: OrderedDict[K, tuple[V, float | None]] | CompactLRUStore = (
+            CompactLRUStore() if storage == "compact" else OrderedDict()
+        )
+        if stats is True:
+            stats = CacheStats()
+        self._stats: CacheStats | None = stats or None
+        self._mrc = mrc
+        self._autosizer = autosizer
+        if autosizer is not None:
+            autosizer.ceiling = max_size
+        self._arena = arena
+        self._freeze_gc = freeze_gc
+        self._compressor = compressor
+        self._codec = codec if codec is not None else JsonCodec()
+        self._blobs = blob_store
+        self._index = tag_index
+        self._negatives = negative_cache
+        self._hot = hot_keys
+        self._journal = journal
+        self._sql = backend
+        self._sharded = sharded
+        self._recorder = recorder
+        # key -> version of the stored value; stamps are never reused
+        self._versions: dict[K, int] | None = {} if versioned else None
+        self._version_seq = 0
+        self._scans: OrderedDict[int, list[K]] | None = None
+        if backend is not None:
+            backend.open(self._persist_path)
+        # Values are stored encoded (bytes, arena handle, BlobRef or pickle
+        # frames) rather than as the objects passed to set()
+        self._packed = (
+            arena is not None or compressor is not None or blob_store is not None
+            or self._codec.name != "json"
+        )
+        # Pickle frames (header, buffers) are stored directly when nothing
+        # needs the value as one contiguous byte string
+        self._frames = (
+            isinstance(self._codec, PickleCodec)
+            and arena is None and compressor is None and blob_store is None
+        )
+        
+        if load_on_init:
+            self.load()
+    
+    # Default time function, bound once rather than imported on every call
+    _default_now = staticmethod(time.time)
+    
+    def _now(self) -> float:
+        """Current time: the coarse clock's cached attribute, else now_fn()."""
+        clock = self._clock
+        return clock.now if clock is not None else self._now_fn()
+    
+    def get(self, key: K) -> V | None:
+        """
+        Retrieve a value by key.
+        
+        Semantics:
+            - Returns None if key not found
+            - Returns None and removes entry if expired
+            - Moves entry to MRU position on successful access
+        
+        Args:
+            key: The key to look up
+        
+        Returns:
+            The value if found and not expired, None otherwise
+        """
+        value = self._access(key, True)
+        return None if value is MISS else value
+    
+    def _access(self, key: K, decode: bool) -> Any:
+        """
+        get() and stream(): record the access, check expiry, move to MRU
+        and count stats.
+        
+        Returns:
+            The value (decoded if ``decode``, else as stored), or MISS
+        """
+        stats = self._stats
+        started = stats.sample_get() if stats is not None else 0.0
+        if self._mrc is not None:
+            self._mrc.record(key)
+        if self._hot is not None:
+            self._hot.record(key)
+        if self._recorder is not None:
+            self._recorder.record(key)
+        
+        # Single lookup; entries are tuples so None always means missing
+        entry = self._cache.get(key)
+        if entry is None:
+            if stats is not None:
+                stats.misses += 1
+                if started:
+                    stats.get_latency.observe(time.perf_counter() - started)
+            return MISS
+        
+        value, expires_at = entry
+        
+        # Check expiration (clock only consulted for entries with a TTL)
+        if expires_at is not None:
+            clock = self._clock
+            now = clock.now if clock is not None else self._now_fn()
+            if now >= expires_at:
+                self._discard(key)
+                if stats is not None:
+                    stats.misses += 1
+                    stats.expired_on_read += 1
+                    if started:
+                        stats.get_latency.observe(time.perf_counter() - started)
+                return MISS
+        
+        # Move to MRU (most recently used)
+        self._cache.move_to_end(key)
+        if self._sql is not None:
+            self._sql.touch(key)
+        if decode and self._packed:
+            value = self._unpack(value)
+        if stats is not None:
+            stats.hits += 1
+            if started:
+                stats.get_latency.observe(time.perf_counter() - started)
+        return value
+    
+    def lookup(self, key: K) -> V | _Sentinel:
+        """
+        Like get(), but tells a miss apart from a cached negative.
+        
+        Returns:
+            The value (possibly None, if None was stored); NEGATIVE if the
+            key was marked absent with set_negative() and that has not
+            expired; MISS otherwise. Both markers are falsy.
+        """
+        negatives = self._negatives
+        if negatives is not None and negatives.check(key, self._now()):
+            return NEGATIVE
+        value = self.get(key)
+        if value is None and key not in self._cache:
+            return MISS
+        return value
+    
+    def set_negative(self, key: K, ttl_seconds: float | None = None) -> None:
+        """
+        Record that ``key`` does not exist in the backing store.
+        
+        Removes any positive entry for the key. The negative is kept in the
+        NegativeCache (its own capacity and TTL) and never evicts positive
+        entries.
+        
+        Args:
+            key: The key known to be absent
+            ttl_seconds: Lifetime (default: the NegativeCache's ttl_seconds)
+        
+        Raises:
+            RuntimeError: If the cache has no negative_cache
+            ValueError: If ttl_seconds <= 0
+        """
+        negatives = self._negatives
+        if negatives is None:
+            raise RuntimeError("set_negative() requires a negative_cache")
+        if ttl_seconds is not None and ttl_seconds <= 0:
+            raise ValueError(f"ttl_seconds must be > 0, got {ttl_seconds}")
+        self._delete(key)
+        negatives.add(key, self._now(), ttl_seconds)
+    
+    def set(
+        self,
+        key: K,
+        value: V,
+        ttl_seconds: float | None = None,
+        *,
+        tags: Iterable[str] = ()
+    ) -> None:
+        """
+        Store a value with optional TTL.
+        
+        Semantics:
+            - Validates JSON serializability before modifying cache
+            - Removes existing entry (if any) before re-inserting
+            - Prunes all expired entries before eviction check
+            - Evicts LRU entries until size < max_size
+            - New entry always goes to MRU position
+        
+        Args:
+            key: Cache key (must be JSON-serializable and hashable)
+            value: Value to store (must be JSON-serializable)
+            ttl_seconds: Time-to-live in seconds, None for no expiration
+            tags: Tags for invalidate_tag() (replace any previous tags;
+                requires a tag_index)
+        
+        Raises:
+            SerializationError: If key or value cannot be JSON-serialized
+            ValueError: If tags are given without a tag_index, or a tag is
+                not a str
+        """
+        # Validate serializability BEFORE any mutation
+        self._validate_serializable(key, "key")
+        if tags:
+            tags = self._check_tags(tags)
+        if self._packed:
+            data = self._encode(value)
+        else:
+            self._validate_serializable(value, "value")
+        
+        stats = self._stats
+        started = stats.sample_set() if stats is not None else 0.0
+        if self._hot is not None:
+            self._hot.record(key)
+        
+        # Calculate expiration
+        expires_at: float | None = None
+        if ttl_seconds is not None:
+            if ttl_seconds <= 0:
+                # Zero or negative TTL means already expired; don't insert
+                # But do remove existing entry if present
+                self._delete(key)
+                if stats is not None:
+                    stats.admission_rejects += 1
+                    if started:
+                        stats.set_latency.observe(time.perf_counter() - started)
+                return
+            expires_at = self._now() + ttl_seconds
+        
+        # Remove existing entry to reset LRU position
+        self._discard(key)
+        if self._negatives is not None:
+            self._negatives.discard(key)
+        
+        # Aggressively prune expired entries before eviction
+        self._prune_expired()
+        
+        sizer = self._autosizer
+        if sizer is not None and sizer.due():
+            sizer.adjust(self)
+        
+        # Evict LRU entries until we have space
+        while len(self._cache) >= self._max_size:
+            self._evict()
+            if stats is not None:
+                stats.evictions += 1
+        
+        if self._journal is not None:
+            self._journal.append("set", key, value, expires_at)
+        
+        # Insert at MRU position (end of OrderedDict)
+        if self._packed:
+            value = self._store(data)
+        self._cache[key] = (value, expires_at)
+        if self._index is not None:
+            self._index.add(key, tags)
+        if self._sql is not None:
+            self._sql.changed(key)
+        if self._versions is not None:
+            self._stamp(key)
+        if started:
+            stats.set_latency.observe(time.perf_counter() - started)
+    
+    def gets(self, key: K) -> tuple[V, int] | None:
+        """
+        get() plus the entry's version, for a later cas().
+        
+        Raises:
+            RuntimeError: If the cache is not versioned
+        """
+        versions = self._require_versions()
+        value = self.get(key)
+        if value is None:
+            return None
+        return value, versions[key]
+    
+    def cas(
+        self,
+        key: K,
+        value: V,
+        version: int,
+        ttl_seconds: float | None = None,
+        *,
+        tags: Iterable[str] = ()
+    ) -> bool:
+        """
+        Compare-and-set: set() only if the entry still has ``version``.
+        
+        Read-modify-write without a lock: gets(), compute, cas(), and retry
+        from gets() on False. Any set(), cas() or incr() of the key in
+        between gives it a new version, so a stale update cannot win. Each
+        call is atomic with respect to other cache calls because the cache
+        is driven by one thread or event loop (see CacheServer).
+        
+        Returns:
+            True if stored; False if the key is missing, expired, or was
+            changed since ``version`` was read
+        
+        Raises:
+            RuntimeError: If the cache is not versioned
+            SerializationError, ValueError: As set()
+        """
+        versions = self._require_versions()
+        if versions.get(key) != version or key not in self:
+            return False
+        self.set(key, value, ttl_seconds, tags=tags)
+        return True
+    
+    def incr(
+        self,
+        key: K,
+        delta: int = 1,
+        *,
+        initial: int | None = None,
+        ttl_seconds: float | None = None
+    ) -> int | None:
+        """
+        Add ``delta`` to a counter in one step, keeping its TTL and tags.
+        
+        Counters are int values, or ASCII-decimal bytes as CacheServer
+        stores them; those follow memcached (unsigned 64-bit: decrementing
+        stops at 0, incrementing wraps) and stay bytes.
+        
+        Args:
+            key: Counter key
+            delta: Amount to add (may be negative)
+            initial: Value to store if the key is missing (None: leave it
+                missing); delta is not applied to it
+            ttl_seconds: TTL when ``initial`` is stored
+        
+        Returns:
+            The new value, or None if the key is missing and no initial
+        
+        Raises:
+            TypeError: If the value is not a counter
+        """
+        entry = self._cache.get(key)
+        if entry is None or key not in self:
+            if initial is None:
+                return None
+            self.set(key, initial, ttl_seconds)
+            return initial
+        stored, expires_at = entry
+        value = self._unpack(stored) if self._packed else stored
+        if (isinstance(value, (bytes, bytearray, memoryview)) and len(value) <= 20
+                and bytes(value).isdigit()):
+            number = max(int(bytes(value)) + delta, 0) % (1 << 64)
+            new_value: Any = str(number).encode('ascii')
+        elif isinstance(value, int) and not isinstance(value, bool):
+            number = new_value = value + delta
+        else:
+            raise TypeError(f"cannot increment non-numeric value for {key!r}")
+        ttl = None if expires_at is None else expires_at - self._now()
+        tags = self._index.tags_of(key) if self._index is not None else ()
+        self.set(key, new_value, ttl, tags=tags)
+        return number
+    
+    def decr(self, key: K, delta: int = 1, **kwargs: Any) -> int | None:
+        """incr() by -delta."""
+        return self.incr(key, -delta, **kwargs)
+    
+    def _require_versions(self) -> dict[K, int]:
+        if self._versions is None:
+            raise RuntimeError("cache is not versioned (pass versioned=True)")
+        return self._versions
+    
+    def _stamp(self, key: K) -> None:
+        self._version_seq += 1
+        self._versions[key] = self._version_seq
+    
+    def invalidate_tag(self, tag: str) -> int:
+        """
+        Remove every entry carrying ``tag``.
+        
+        Returns:
+            Number of entries removed (expired or not)
+        
+        Raises:
+            RuntimeError: If the cache has no tag_index
+        """
+        return self._invalidate(self._require_index().keys_with_tag(tag))
+    
+    def invalidate_prefix(self, prefix: str) -> int:
+        """
+        Remove every entry whose str key starts with ``prefix``.
+        
+        Returns:
+            Number of entries removed (expired or not)
+        
+        Raises:
+            RuntimeError: If the cache has no tag_index (or prefixes are off)
+        """
+        return self._invalidate(self._require_index().keys_with_prefix(prefix))
+    
+    def _invalidate(self, keys: list[K]) -> int:
+        for key in keys:
+            self._delete(key)
+        return len(keys)
+    
+    def _require_index(self) -> TagIndex:
+        if self._index is None:
+            raise RuntimeError("no tag index configured (pass tag_index=)")
+        return self._index
+    
+    def _check_tags(self, tags: Iterable[str]) -> tuple[str, ...]:
+        """Validate set() tags before any mutation."""
+        if self._index is None:
+            raise ValueError("tags require a tag_index")
+        tags = tuple(dict.fromkeys(tags))
+        for tag in tags:
+            if not isinstance(tag, str):
+                raise ValueError(f"tags must be str, got {type(tag).__name__}")
+        return tags
+    
+    def stream(self, key: K, chunk_size: int = 1 << 20) -> Iterator[bytes] | None:
+        """
+        Stream a value's encoded bytes (codec output, e.g. JSON text).
+        
+        Blob values are read from their file chunk by chunk (decompressed
+        incrementally), so a large value is never fully in memory. Other
+        values are yielded as one chunk. Counts as a get() for LRU order,
+        stats and access tracking.
+        
+        Args:
+            key: The key to look up
+            chunk_size: Bytes per file read
+        
+        Returns:
+            Iterator of byte chunks, or None if missing or expired
+        """
+        stored = self._access(key, False)
+        if stored is MISS:
+            return None
+        if type(stored) is BlobRef:
+            return self._stream_blob(stored, chunk_size)
+        if not self._packed:
+            return iter((self._codec.encode(stored),))
+        if self._frames:
+            return iter((self._codec.encode(self._unpack(stored)),))
+        return iter((bytes(self._decompressed(stored)),))
+    
+    def _stream_blob(self, ref: BlobRef, chunk_size: int) -> Iterator[bytes]:
+        with self._blobs.open(ref) as f:
+            decompressor = None
+            if self._compressor is not None:
+                flag = f.read(1)[0]
+                if flag:
+                    decompressor = _STREAM_DECOMPRESSORS[flag]()
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield decompressor.decompress(chunk) if decompressor else chunk
+    
+    def delete(self, key: K) -> bool:
+        """
+        Remove an entry by key.
+        
+        Args:
+            key: The key to remove
+        
+        Returns:
+            True if key existed (regardless of expiration), False otherwise
+        """
+        if self._negatives is not None:
+            self._negatives.discard(key)
+        return self._delete(key)
+    
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        if self._journal is not None:
+            self._journal.append("clear")
+        self._clear()
+    
+    def _clear(self) -> None:
+        """clear() without journaling, for load() (which journals "reset")."""
+        self._cache.clear()
+        if self._sql is not None:
+            self._sql.cleared()
+        if self._versions is not None:
+            self._versions.clear()
+        if self._negatives is not None:
+            self._negatives.clear()
+        if self._arena is not None:
+            self._arena.clear()
+        if self._blobs is not None:
+            self._blobs.release_all()
+        if self._index is not None:
+            self._index.clear()
+    
+    @property
+    def max_size(self) -> int:
+        """Current capacity in entries."""
+        return self._max_size
+    
+    @property
+    def codec(self) -> JsonCodec | PickleCodec:
+        """Value codec (decides which values set() accepts)."""
+        return self._codec
+    
+    @property
+    def versioned(self) -> bool:
+        return self._versions is not None
+    
+    @property
+    def journal(self) -> MutationJournal | None:
+        return self._journal
+    
+    def resize(self, max_size: int, *, max_evictions: int | None = None) -> int:
+        """
+        Change capacity, evicting LRU entries if the cache is now over it.
+        
+        Expired entries are pruned first. With ``max_evictions`` set, at
+        most that many live entries are evicted now and max_size is held at
+        the resulting size, so the remainder is shed by later calls instead
+        of in one burst.
+        
+        Args:
+            max_size: New capacity (must be >= 1)
+            max_evictions: Optional cap on LRU evictions in this call
+        
+        Returns:
+            Number of live entries evicted
+        
+        Raises:
+            ValueError: If max_size < 1
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be >= 1, got {max_size}")
+        
+        if len(self._cache) > max_size:
+            self._prune_expired()
+        
+        evicted = 0
+        while len(self._cache) > max_size:
+            if max_evictions is not None and evicted >= max_evictions:
+                break
+            self._evict()
+            evicted += 1
+        
+        if self._stats is not None:
+            self._stats.evictions += evicted
+        self._max_size = max(max_size, len(self._cache))
+        return evicted
+    
+    def __len__(self) -> int:
+        """
+        Return the count of non-expired entries.
+        
+        Note: This performs a full scan to ensure accuracy.
+        For raw count (including potentially expired), use len(cache._cache).
+        """
+        now = self._now()
+        return sum(
+            1 for _, (__, expires_at) in self._cache.items()
+            if expires_at is None or now < expires_at
+        )
+    
+    def __contains__(self, key: K) -> bool:
+        """Check if key exists and is not expired (does NOT update LRU)."""
+        if key not in self._cache:
+            return False
+        _, expires_at = self._cache[key]
+        return expires_at is None or self._now() < expires_at
+    
+    def keys(self) -> Iterator[K]:
+        """
+        Yield live keys, LRU to MRU for the OrderedDict store.
+        
+        Does not update LRU order or stats. Entries may be set, read or
+        deleted while iterating: keys added meanwhile may or may not be
+        seen, removed or expired ones are skipped. The compact store is
+        walked by slot in pages of 1024 (see scan()), so memory stays flat.
+        An OrderedDict cannot be paged while it changes, so that store
+        snapshots its keys first: a list of one reference (8 bytes) per
+        entry, about 80 MB for 10M entries, held until iteration ends.
+        """
+        for key, _ in self._live(self._walk()):
+            yield key
+    
+    def items(self) -> Iterator[tuple[K, V]]:
+        """Yield live (key, value) pairs; same order and guarantees as keys()."""
+        packed = self._packed
+        for key, value in self._live(self._walk()):
+            yield key, (self._unpack(value) if packed else value)
+    
+    def scan(
+        self,
+        cursor: int = 0,
+        count: int = 100,
+        match: str | None = None
+    ) -> tuple[int, list[K]]:
+        """
+        Page through live keys with a cursor, like Redis SCAN.
+        
+        Start with cursor 0 and pass each returned cursor back until it is
+        0 again. Every call visits at most ``count`` entries, so a page may
+        hold fewer keys than ``count`` (even none) before the scan is done.
+        A key present for the whole scan is returned exactly once.
+        
+        With the compact store the cursor is a slot number: it holds no
+        state and survives any mutation. With the OrderedDict store a scan
+        pages over a snapshot of the keys taken at cursor 0 (8 bytes per
+        entry, freed when the scan ends); only MAX_SCANS such scans are
+        kept open, so they hold at most MAX_SCANS key lists.
+        
+        Args:
+            cursor: 0 to start, else a cursor returned by scan()
+            count: Entries visited per call (must be >= 1)
+            match: Optional glob pattern (fnmatch) for str keys; other keys
+                never match
+        
+        Returns:
+            (next cursor, 0 when done; live matching keys)
+        
+        Raises:
+            ValueError: If count < 1 or the cursor is unknown (e.g. its
+                scan snapshot was dropped)
+        """
+        if count < 1:
+            raise ValueError(f"count must be >= 1, got {count}")
+        if isinstance(self._cache, CompactLRUStore):
+            cursor, keys = self._cache.scan(cursor, count)
+        else:
+            cursor, keys = self._scan_snapshot(cursor, count)
+        if match is not None:
+            keys = [k for k in keys if isinstance(k, str) and fnmatch.fnmatchcase(k, match)]
+        return cursor, [key for key, _ in self._live(keys)]
+    
+    def _scan_snapshot(self, cursor: int, count: int) -> tuple[int, list[K]]:
+        """scan() for the OrderedDict store: pages of a key snapshot."""
+        scans = self._scans
+        if scans is None:
+            scans = self._scans = OrderedDict()
+        if cursor == 0:
+            scan_id = next(self._scan_ids)
+            scans[scan_id] = list(self._cache)
+            while len(scans) > self.MAX_SCANS:
+                scans.popitem(last=False)
+            position = 0
+        else:
+            scan_id, position = cursor >> self._SCAN_SHIFT, cursor & ((1 << self._SCAN_SHIFT) - 1)
+            if scan_id not in scans:
+                raise ValueError(f"unknown scan cursor {cursor}")
+        snapshot = scans[scan_id]
+        stop = position + count
+        if stop >= len(snapshot):
+            del scans[scan_id]
+            return 0, snapshot[position:]
+        return scan_id << self._SCAN_SHIFT | stop, snapshot[position:stop]
+    
+    def _walk(self) -> Iterator[K]:
+        """Keys for keys()/items(), robust to mutation between yields."""
+        if isinstance(self._cache, CompactLRUStore):
+            cursor = 0
+            while True:
+                cursor, keys = self._cache.scan(cursor, 1024)
+                yield from keys
+                if not cursor:
+                    return
+        else:
+            yield from list(self._cache)
+    
+    def _live(self, keys: Iterable[K]) -> Iterator[tuple[K, Any]]:
+        """(key, stored value) for keys still present and unexpired."""
+        cache = self._cache
+        now = self._now()
+        for key in keys:
+            entry = cache.get(key)
+            if entry is None:
+                continue
+            stored, expires_at = entry
+            if expires_at is None or now < expires_at:
+                yield key, stored
+    
+    def flush(self) -> None:
+        """
+        Persist cache to file atomically.
+        
+        File format:
+            {
+                "version": 3,
+                "max_size": <int>,
+                "entries": [
+                    {"key": <K>, "value": <V>, "expires_at": <float|null>},
+                    ...  // ordered from LRU to MRU
+                ]
+            }
+        
+        Compressed values are written as-is: "value" holds the base64
+        payload and an extra "compressed" field names the algorithm.
+        Values in the BlobStore are written as references instead:
+        {"key", "blob": <sha256>, "size", "expires_at", "codec", "framed"}.
+        
+        With a PickleCodec the file is binary instead (see _write_binary),
+        and value buffers are written straight from the cache.
+        
+        With a SqliteBackend only the rows changed since the last flush are
+        written (see SqliteBackend). With a ShardedSnapshot the entries are
+        written as parallel shard files and the file holds their manifest.
+        
+        Atomic write:
+            Writes to a temp file in the same directory, then uses os.replace()
+            for atomic rename. This prevents corruption on crash.
+        
+        Raises:
+            OSError: If file cannot be written
+        """
+        started = time.perf_counter()
+        binary = isinstance(self._codec, PickleCodec)
+        
+        if self._sql is not None:
+            bytes_written = self._sql.sync(self)
+        elif self._sharded is not None:
+            bytes_written = self._sharded.write(
+                self._persist_path, self._snapshot_entries(), self._max_size
+            )
+        elif binary:
+            bytes_written = write_atomically(
+                self._persist_path, self._write_binary, binary=True
+            )
+        else:
+            data = {
+                "version": 3,
+                "max_size": self._max_size,
+                "entries": self._snapshot_entries()
+            }
+            bytes_written = write_atomically(
+                self._persist_path,
+                lambda f: json.dump(data, f, indent=2, ensure_ascii=False)
+            )
+        
+        if self._blobs is not None:
+            # Only now is no snapshot referencing the orphans
+            self._blobs.collect()
+        if self._recorder is not None:
+            self._recorder.save()
+        
+        stats = self._stats
+        if stats is not None:
+            stats.flushes += 1
+            stats.flush_seconds += time.perf_counter() - started
+            stats.bytes_written += bytes_written
+    
+    def _snapshot_entries(self) -> list[dict]:
+        """JSON snapshot records for all entries, LRU to MRU."""
+        entries = [
+            self._persisted_entry(k, v, exp) for k, (v, exp) in self._cache.items()
+        ]
+        self._add_tags(entries)
+        return entries
+    
+    def load(self) -> None:
+        """
+        Load cache from persistence file.
+        
+        Behavior:
+            - Missing file: starts empty (not an error)
+            - Corrupted JSON: starts empty (not an error)
+            - Invalid schema: starts empty (not an error)
+            - Expired entries: discarded during load
+            - Entries exceeding max_size: oldest (LRU) entries truncated
+            - Journal: one "reset" (never "clear", which invalidation peers
+              would broadcast)
+        
+        LRU order is preserved from file (entries stored LRU to MRU).
+        With freeze_gc, gc.freeze() runs after a successful load.
+        Binary (pickle) files are only read by a cache with a PickleCodec.
+        Blob entries are not read, only checked to exist; unreferenced blob
+        files are swept afterwards.
+        With a SqliteBackend the most recently used live rows are read.
+        A sharded manifest is read with or without a ShardedSnapshot (in
+        parallel with one).
+        """
+        try:
+            self._load()
+        finally:
+            if self._journal is not None:
+                # Bulk change, even to empty: journal readers must take a
+                # fresh snapshot
+                self._journal.append("reset")
+    
+    def _load(self) -> None:
+        """load() without journaling; every path starts from _clear()."""
+        self._clear()
+        
+        if self._sql is not None:
+            self._sql.load_into(self)
+            self._loaded(set())
+            return
+        
+        if not self._persist_path.exists():
+            return
+        
+        try:
+            with open(self._persist_path, 'rb') as f:
+                raw = f.read()
+            
+            if raw.startswith(_BINARY_MAGIC):
+                if isinstance(self._codec, PickleCodec):
+                    self._loaded(self._read_binary(raw))
+                return
+            
+            data = json.loads(raw)
+            
+            # Validate structure
+            if not isinstance(data, dict):
+                return
+            
+            entries = data.get("entries")
+            if "shards" in data:
+                reader = self._sharded or ShardedSnapshot(workers=1)
+                entries = reader.read(self._persist_path, data, self._max_size)
+            if not isinstance(entries, list):
+                return
+            
+            self._loaded(self._load_entries(entries))
+                
+        except (ValueError, OSError, TypeError, KeyError, SerializationError,
+                pickle.UnpicklingError, EOFError):
+            # Any error during load (ValueError covers JSONDecodeError and
+            # bad UTF-8): start fresh
+            self._clear()
+    
+    def _prune_expired(self) -> int:
+        """
+        Remove all expired entries.
+        
+        Returns:
+            Number of entries removed
+        """
+        now = self._now()
+        expired_keys = [
+            k for k, (_, expires_at) in self._cache.items()
+            if expires_at is not None and now >= expires_at
+        ]
+        for key in expired_keys:
+            self._discard(key)
+        if self._stats is not None:
+            self._stats.expired_pruned += len(expired_keys)
+        return len(expired_keys)
+    
+    def _load_entries(self, entries: list) -> set[str]:
+        """
+        Insert JSON snapshot records (LRU to MRU), skipping invalid and
+        expired ones.
+        
+        Returns:
+            Digests of all blob entries named in ``entries``
+        
+        Raises:
+            Same as load() handles, for the cache to start fresh
+        """
+        now = self._now()
+        snapshot_blobs: set[str] = set()
+        
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            
+            # Extract fields with validation
+            if "key" not in entry or ("value" not in entry and "blob" not in entry):
+                continue
+            
+            key = entry["key"]
+            value = entry.get("value")
+            expires_at = entry.get("expires_at")
+            
+            # Skip expired entries
+            if expires_at is not None and now >= expires_at:
+                continue
+            
+            data = stored = None
+            algorithm = entry.get("compressed")
+            if "blob" in entry:
+                snapshot_blobs.add(str(entry["blob"]))
+                try:
+                    stored = self._load_blob_entry(entry)
+                except (*_DECOMPRESSION_ERRORS, TypeError, KeyError,
+                        SerializationError):
+                    continue
+            elif algorithm is not None:
+                try:
+                    data, value = self._load_compressed(algorithm, value)
+                except (*_DECOMPRESSION_ERRORS, TypeError):
+                    continue
+            
+            if self._packed and stored is None:
+                if data is None:
+                    data = self._encode(value)
+                stored = self._store(data)
+            self._load_insert(
+                key, stored if self._packed else value, expires_at,
+                entry.get("tags")
+            )
+        return snapshot_blobs
+    
+    def _load_insert(
+        self,
+        key: K,
+        stored: Any,
+        expires_at: float | None,
+        tags: Any
+    ) -> None:
+        """Insert one entry read from the snapshot, keeping index and store in step."""
+        # Respect max_size during load
+        if len(self._cache) >= self._max_size:
+            # Remove LRU to make space (preserves MRU entries from file)
+            self._evict_lru()
+        
+        previous = self._cache.get(key)
+        if previous is not None:
+            self._discard_value(previous)
+            if self._index is not None:
+                self._index.remove(key)
+        self._cache[key] = (stored, expires_at)
+        if self._versions is not None:
+            self._stamp(key)
+        
+        if self._index is not None:
+            if isinstance(tags, list):
+                tags = tuple(dict.fromkeys(t for t in tags if isinstance(t, str)))
+            else:
+                tags = ()
+            self._index.add(key, tags)
+    
+    def _add_tags(self, entries: list[dict]) -> None:
+        """Attach each entry's tags (if any) to its snapshot record."""
+        index = self._index
+        if index is None:
+            return
+        for entry in entries:
+            tags = index.tags_of(entry["key"])
+            if tags:
+                entry["tags"] = list(tags)
+    
+    def _loaded(self, snapshot_blobs: set[str]) -> None:
+        """Post-load housekeeping: sweep unreferenced blobs, freeze the GC."""
+        if self._blobs is not None:
+            self._blobs.sweep(keep=snapshot_blobs)
+        if self._freeze_gc:
+            gc.freeze()
+    
+    def _release(self, stored: Any) -> None:
+        """Return a removed value's arena chunk or blob reference."""
+        if type(stored) is BlobRef:
+            self._blobs.release(stored)
+        elif self._arena is not None:
+            self._arena.free(stored)
+    
+    def _discard(self, key: K) -> bool:
+        """Remove key if present, releasing its stored value."""
+        entry = self._cache.pop(key, None)
+        if entry is None:
+            return False
+        if self._packed:
+            self._release(entry[0])
+        if self._index is not None:
+            self._index.remove(key)
+        if self._sql is not None:
+            self._sql.removed(key)
+        if self._versions is not None:
+            del self._versions[key]
+        return True
+    
+    def _delete(self, key: K) -> bool:
+        """
+        _discard() for caller-visible removals, which are journaled even if
+        the key was not held here (another cache may still hold it).
+        """
+        removed = self._discard(key)
+        if self._journal is not None:
+            self._journal.append("delete", key)
+        return removed
+    
+    def _discard_value(self, entry: tuple[Any, float | None] | None) -> None:
+        """Release the stored value of an entry that is being overwritten."""
+        if entry is not None and self._packed:
+            self._release(entry[0])
+    
+    def _evict(self) -> None:
+        """_evict_lru() for evictions replicas must repeat, which are journaled."""
+        if self._journal is not None:
+            self._journal.append("evict", next(iter(self._cache)))
+        self._evict_lru()
+    
+    def _evict_lru(self) -> None:
+        """Remove the least recently used entry."""
+        # popitem(last=False) removes the oldest (LRU) entry
+        key, (value, _) = self._cache.popitem(last=False)
+        if self._packed:
+            self._release(value)
+        if self._index is not None:
+            self._index.remove(key)
+        if self._sql is not None:
+            self._sql.removed(key)
+        if self._versions is not None:
+            del self._versions[key]
+    
+    def _decoded_items(self) -> Iterator[tuple[K, V, float | None]]:
+        """Yield (key, value, expires_at) from LRU to MRU, decoding packed values."""
+        packed = self._packed
+        for k, (v, exp) in self._cache.items():
+            yield k, (self._unpack(v) if packed else v), exp
+    
+    def _encode(self, value: Any) -> Any:
+        """
+        Encode a value for storage: pickle frames, or codec bytes passed
+        through the compressor (if any).
+        
+        Raises:
+            SerializationError: If the codec cannot encode the value
+        """
+        if self._frames:
+            return self._codec.encode_frames(value)
+        data = self._codec.encode(value)
+        if self._compressor is None:
+            return data
+        return self._compressor.pack(data)
+    
+    def _store(self, data: Any) -> Any:
+        """Place packed bytes in a blob or the arena (if any); returns the stored form."""
+        blobs = self._blobs
+        if blobs is not None and len(data) >= blobs.threshold:
+            return blobs.put(data)
+        if self._arena is None:
+            return data
+        return self._arena.put(data)
+    
+    def _raw(self, stored: Any) -> bytes | bytearray:
+        """Packed bytes for a stored value (inverse of _store)."""
+        if type(stored) is BlobRef:
+            return self._blobs.read(stored)
+        return stored if self._arena is None else self._arena.get(stored)
+    
+    def _decompressed(self, stored: Any) -> bytes | bytearray:
+        """Codec bytes for a stored (non-frames) value."""
+        data = self._raw(stored)
+        if self._compressor is not None:
+            data = self._compressor.unpack(data)
+        return data
+    
+    def _unpack(self, stored: Any) -> Any:
+        """Decode a stored value back to the object passed to set()."""
+        if self._frames:
+            return self._codec.decode_frames(*stored)
+        return self._codec.decode(self._decompressed(stored))
+    
+    def _blob_entry(self, key: K, ref: BlobRef, expires_at: float | None) -> dict:
+        """Snapshot reference to a blob, with what is needed to decode it."""
+        return {
+            "key": key,
+            "blob": ref.digest,
+            "size": ref.size,
+            "expires_at": expires_at,
+            "codec": self._codec.name,
+            "framed": self._compressor is not None,
+        }
+    
+    def _load_blob_entry(self, entry: dict) -> Any:
+        """
+        Stored form for a snapshot blob entry.
+        
+        The reference is adopted as-is when codec and compression framing
+        match this cache; otherwise the blob is decoded and re-stored.
+        
+        Raises:
+            KeyError: If the cache has no blob store or the blob is missing
+            ValueError, TypeError or a decompressor error if it is unusable
+        """
+        blobs = self._blobs
+        if blobs is None or not blobs.exists(entry["blob"]):
+            raise KeyError(entry["blob"])
+        ref = BlobRef(entry["blob"], int(entry["size"]))
+        codec = entry.get("codec", "json")
+        framed = bool(entry.get("framed"))
+        if codec == self._codec.name and framed == (self._compressor is not None):
+            blobs.retain(ref)
+            return ref
+        
+        if codec != "json" and codec != self._codec.name:
+            # Never unpickle from a cache that was not configured for it
+            raise ValueError(f"cannot decode {codec!r} blob with {self._codec.name!r}")
+        data = blobs.read(ref)
+        if framed and data[0]:
+            data = decompress_with(_ALGORITHM_BY_FLAG[data[0]], data[1:])
+        elif framed:
+            data = data[1:]
+        decoder = JsonCodec() if codec == "json" else self._codec
+        return self._store(self._encode(decoder.decode(data)))
+    
+    def _persisted_entry(self, key: K, stored: Any, expires_at: float | None) -> dict:
+        """File representation of one entry; compressed payloads stay compressed."""
+        if type(stored) is BlobRef:
+            return self._blob_entry(key, stored, expires_at)
+        if self._compressor is not None:
+            data = self._raw(stored)
+            if data[0]:
+                return {
+                    "key": key,
+                    "value": base64.b64encode(data[1:]).decode('ascii'),
+                    "expires_at": expires_at,
+                    "compressed": _ALGORITHM_BY_FLAG[data[0]],
+                }
+        value = self._unpack(stored) if self._packed else stored
+        return {"key": key, "value": value, "expires_at": expires_at}
+    
+    def _load_compressed(self, algorithm: str, value: str) -> tuple[bytes | None, Any]:
+        """
+        Read a compressed file entry.
+        
+        Payloads from the compressor's own algorithm are adopted without
+        being decompressed, so loading stays cheap.
+        
+        Returns:
+            (packed bytes, None) if the payload can be kept as-is, else
+            (None, decoded value)
+        
+        Raises:
+            ValueError, json.JSONDecodeError or a decompressor error if the
+            entry is corrupt
+        """
+        payload = base64.b64decode(value, validate=True)
+        if self._compressor is not None and self._codec.name == "json":
+            data = self._compressor.adopt(algorithm, payload)
+            if data is not None:
+                return data, None
+        return None, json.loads(decompress_with(algorithm, payload))
+    
+    def _write_binary(self, f: Any) -> None:
+        """
+        Write the binary (PickleCodec) file format.
+        
+        Layout:
+            _BINARY_MAGIC
+            8-byte little-endian length of the JSON index, then the index:
+                {"version": 3, "codec": "pickle", "max_size": <int>,
+                 "entries": [{"key": <K>, "expires_at": <float|null>,
+                              "sizes": [<header>, <buffer>, ...]}, ...]}
+            each entry's pickle header then its out-of-band buffers, in
+            index order (LRU to MRU)
+        
+        Buffers are passed to f.write() as the memoryviews held by the
+        cache, so large values are not copied on the way to the file.
+        """
+        entries = []
+        frames: list[Any] = []
+        for key, (stored, expires_at) in self._cache.items():
+            if type(stored) is BlobRef:
+                entries.append(self._blob_entry(key, stored, expires_at))
+                continue
+            if self._frames:
+                header, buffers = stored
+            else:
+                header, buffers = self._decompressed(stored), ()
+            entries.append({
+                "key": key,
+                "expires_at": expires_at,
+                "sizes": [len(header), *(b.nbytes for b in buffers)],
+            })
+            frames.append(header)
+            frames.extend(buffers)
+        self._add_tags(entries)
+        
+        index = json.dumps({
+            "version": 3,
+            "codec": self._codec.name,
+            "max_size": self._max_size,
+            "entries": entries,
+        }, ensure_ascii=False).encode('utf-8')
+        f.write(_BINARY_MAGIC)
+        f.write(len(index).to_bytes(8, 'little'))
+        f.write(index)
+        for frame in frames:
+            f.write(frame)
+    
+    def _read_binary(self, raw: bytes) -> set[str]:
+        """
+        Load the format written by _write_binary.
+        
+        Out-of-band buffers become read-only memoryview slices of ``raw``,
+        so they are not copied (``raw`` stays alive while any is cached).
+        
+        Returns:
+            Digests of all blob entries named in the file
+        
+        Raises:
+            ValueError, KeyError, TypeError or an unpickling error if the
+            file is corrupt
+        """
+        view = memoryview(raw)
+        pos = len(_BINARY_MAGIC)
+        index_len = int.from_bytes(view[pos:pos + 8], 'little')
+        pos += 8
+        index = json.loads(view[pos:pos + index_len].tobytes())
+        pos += index_len
+        
+        now = self._now()
+        snapshot_blobs = set()
+        for entry in index["entries"]:
+            if "blob" in entry:
+                snapshot_blobs.add(str(entry["blob"]))
+                if entry["expires_at"] is not None and now >= entry["expires_at"]:
+                    continue
+                try:
+                    stored = self._load_blob_entry(entry)
+                except (*_DECOMPRESSION_ERRORS, TypeError, KeyError,
+                        SerializationError):
+                    continue
+                self._load_insert(
+                    entry["key"], stored, entry["expires_at"], entry.get("tags")
+                )
+                continue
+            
+            sizes = entry["sizes"]
+            end = pos + sum(sizes)
+            if end > len(raw):
+                raise ValueError("truncated binary cache file")
+            header = view[pos:pos + sizes[0]].tobytes()
+            pos += sizes[0]
+            buffers = []
+            for size in sizes[1:]:
+                buffers.append(view[pos:pos + size])
+                pos += size
+            
+            key = entry["key"]
+            expires_at = entry["expires_at"]
+            if expires_at is not None and now >= expires_at:
+                continue
+            
+            if self._frames:
+                stored = (header, tuple(buffers))
+            else:
+                value = self._codec.decode_frames(header, tuple(buffers))
+                stored = self._store(self._encode(value))
+            
+            self._load_insert(key, stored, expires_at, entry.get("tags"))
+        return snapshot_blobs
+    
+    def _validate_serializable(self, obj: Any, name: str) -> None:
+        """
+        Validate that an object can be JSON-serialized.
+        
+        Args:
+            obj: Object to validate
+            name: Name for error message ("key" or "value")
+        
+        Raises:
+            SerializationError: If object cannot be serialized
+        """
+        try:
+            json.dumps(obj)
+        except (TypeError, ValueError) as e:
+            raise SerializationError(
+                f"{name} is not JSON-serializable: {type(obj).__name__} - {e}"
+            ) from e
+    
+    @property
+    def stats(self) -> CacheStats | None:
+        """Live statistics object, or None if stats are disabled."""
+        return self._stats
+    
+    def estimate_hit_ratios(
+        self,
+        factors: tuple[float, ...] = (0.5, 1.0, 2.0, 10.0)
+    ) -> list[dict]:
+        """
+        Estimate hit ratios at multiples of the current max_size.
+        
+        Args:
+            factors: Size multipliers to evaluate
+        
+        Returns:
+            One dict per factor: {"factor", "max_size", "hit_ratio"}
+        
+        Raises:
+            RuntimeError: If the cache was created without an mrc tracker
+        """
+        if self._mrc is None:
+            raise RuntimeError("no miss-ratio tracker configured (pass mrc=)")
+        results = []
+        for factor in factors:
+            size = max(1, int(self._max_size * factor))
+            results.append({
+                "factor": factor,
+                "max_size": size,
+                "hit_ratio": self._mrc.hit_ratio(size),
+            })
+        return results
+    
+    def hot_keys(self, n: int = 10) -> list[dict]:
+        """
+        The hottest keys by get()/set() references (see HeavyHitters.top).
+        
+        Raises:
+            RuntimeError: If the cache was created without a hot_keys tracker
+        """
+        if self._hot is None:
+            raise RuntimeError("no hot-key tracker configured (pass hot_keys=)")
+        return self._hot.top(n)
+    
+    def _debug_state(self) -> dict:
+        """
+        Return internal state for debugging/testing.
+        
+        Returns dict with:
+            - entries: list of (key, value, expires_at) in LRU->MRU order
+            - size: current entry count
+            - max_size: configured max size
+        """
+        return {
+            "entries": list(self._decoded_items()),
+            "size": len(self._cache),
+            "max_size": self._max_size
+        }
+    
+    def __repr__(self) -> str:
+        return (
+            f"PersistentLRUTTLCache("
+            f"max_size={self._max_size}, "
+            f"current_size={len(self)}, "
+            f"path={self._persist_path!r})"
+        )
+
+
+class _NamespaceStore(PersistentLRUTTLCache):
+    """
+    A namespace's cache. Its persist_path is the NamespacedCache's combined
+    snapshot, which only the owner reads and writes: flush() or load() here
+    would overwrite it with, or misread it as, a single-cache snapshot.
+    """
+    
+    __slots__ = ()
+    
+    def flush(self) -> None:
+        raise RuntimeError("namespaces are persisted by NamespacedCache.flush()")
+    
+    def load(self) -> None:
+        raise RuntimeError("namespaces are loaded by NamespacedCache.load()")
+
+
+class CacheNamespace:
+    """
+    Handle for one namespace of a NamespacedCache.
+    
+    Reads go straight to the namespace's PersistentLRUTTLCache; writes go
+    through the owner so the shared budget is enforced.
+    """
+    
+    __slots__ = ('_owner', 'name', 'cache', 'min_size', 'weight')
+    
+    def __init__(
+        self,
+        owner: NamespacedCache,
+        name: str,
+        cache: PersistentLRUTTLCache,
+        min_size: int,
+        weight: float
+    ) -> None:
+        self._owner = owner
+        self.name = name
+        self.cache = cache
+        self.min_size = min_size
+        self.weight = weight
+    
+    def get(self, key: Any) -> Any:
+        return self.cache.get(key)
+    
+    def set(self, key: Any, value: Any, ttl_seconds: float | None = None) -> None:
+        self._owner._set(self, key, value, ttl_seconds)
+    
+    def delete(self, key: Any) -> bool:
+        return self.cache.delete(key)
+    
+    def clear(self) -> None:
+        """O(1) clear (see NamespacedCache.clear_namespace)."""
+        self._owner.clear_namespace(self.name)
+    
+    @property
+    def max_size(self) -> int:
+        return self.cache.max_size
+    
+    def __len__(self) -> int:
+        return len(self.cache)
+    
+    def __contains__(self, key: Any) -> bool:
+        return key in self.cache
+    
+    def __repr__(self) -> str:
+        return (
+            f"CacheNamespace({self.name!r}, entries={len(self.cache._cache)}, "
+            f"min_size={self.min_size}, max_size={self.max_size})"
+        )
+
+
+class NamespacedCache:
+    """
+    Named sub-caches sharing one entry budget and one snapshot file.
+    
+    Each namespace is a PersistentLRUTTLCache capped at its max quota.
+    When an insert would push the total over max_size, entries are evicted
+    (LRU within the namespace, expired first) from the namespace using the
+    most of its weighted share, len / weight, among those above their
+    min_size quota. Minimums are reserved: their sum may not exceed
+    max_size.
+    
+    clear_namespace() swaps in an empty store in O(1). The old store is
+    released incrementally, reclaim_batch entries per set(), so clearing
+    a large namespace never stalls a request.
+    
+    Snapshot format:
+        {"version": 3, "max_size": <int>,
+         "namespaces": {<name>: {"min_size", "max_size", "weight",
+                                 "entries": [<as PersistentLRUTTLCache>]}}}
+    
+    Namespaces are declared in code with namespace(); a namespace's
+    entries are loaded when it is declared. Undeclared namespaces in the
+    file are dropped by the next flush(). Only this object persists: a
+    namespace's own cache raises on flush() and load().
+    
+    Thread Safety:
+        NOT thread-safe, like PersistentLRUTTLCache.
+    """
+    
+    def __init__(
+        self,
+        max_size: int,
+        persist_path: str,
+        *,
+        now_fn: Callable[[], float] | None = None,
+        coarse_clock: CoarseClock | None = None,
+        reclaim_batch: int = 256
+    ) -> None:
+        """
+        Args:
+            max_size: Global entry budget across all namespaces (>= 1)
+            persist_path: Path to the combined snapshot file
+            now_fn: Optional time function shared by all namespaces
+            coarse_clock: Optional CoarseClock shared by all namespaces
+            reclaim_batch: Entries of cleared stores released per set()
+        
+        Raises:
+            ValueError: If max_size < 1 or reclaim_batch < 1
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be >= 1, got {max_size}")
+        if reclaim_batch < 1:
+            raise ValueError(f"reclaim_batch must be >= 1, got {reclaim_batch}")
+        
+        self._max_size = max_size
+        self._persist_path = Path(persist_path)
+        self._now_fn = now_fn
+        self._clock = coarse_clock
+        self._reclaim_batch = reclaim_batch
+        self._namespaces: dict[str, CacheNamespace] = {}
+        self._retired: list[Any] = []
+        self._pending = self._read_snapshot()
+    
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+    
+    def namespace(
+        self,
+        name: str,
+        *,
+        min_size: int = 0,
+        max_size: int | None = None,
+        weight: float = 1.0
+    ) -> CacheNamespace:
+        """
+        Declare (or return the existing) namespace ``name``.
+        
+        Args:
+            name: Namespace name
+            min_size: Entries reserved for this namespace under pressure
+            max_size: Cap for this namespace (default: the global budget)
+            weight: Relative share when choosing eviction victims
+        
+        Returns:
+            The namespace handle
+        
+        Raises:
+            ValueError: If quotas are inconsistent or the reserved minimums
+                would exceed the global budget
+        """
+        existing = self._namespaces.get(name)
+        if existing is not None:
+            return existing
+        
+        cap = self._max_size if max_size is None else max_size
+        if min_size < 0 or cap < 1 or min_size > cap:
+            raise ValueError(
+                f"need 0 <= min_size <= max_size and max_size >= 1, "
+                f"got {min_size}, {cap}"
+            )
+        if weight <= 0:
+            raise ValueError(f"weight must be > 0, got {weight}")
+        reserved = sum(ns.min_size for ns in self._namespaces.values())
+        if reserved + min_size > self._max_size:
+            raise ValueError(
+                f"min_size quotas ({reserved + min_size}) exceed max_size "
+                f"({self._max_size})"
+            )
+        
+        cache = _NamespaceStore(
+            max_size=cap,
+            persist_path=str(self._persist_path),
+            now_fn=self._now_fn,
+            coarse_clock=self._clock,
+            load_on_init=False
+        )
+        ns = CacheNamespace(self, name, cache, min_size, weight)
+        self._namespaces[name] = ns
+        self._load_namespace(ns)
+        return ns
+    
+    def __getitem__(self, name: str) -> CacheNamespace:
+        return self._namespaces[name]
+    
+    def __contains__(self, name: str) -> bool:
+        return name in self._namespaces
+    
+    @property
+    def namespaces(self) -> list[str]:
+        return list(self._namespaces)
+    
+    def entry_count(self) -> int:
+        """Stored entries across namespaces (may include not-yet-pruned expired)."""
+        return sum(len(ns.cache._cache) for ns in self._namespaces.values())
+    
+    def clear_namespace(self, name: str) -> None:
+        """
+        Empty one namespace in O(1).
+        
+        Raises:
+            KeyError: If the namespace is not declared
+        """
+        cache = self._namespaces[name].cache
+        old = cache._cache
+        if old:
+            self._retired.append(old)
+        cache._cache = type(old)()
+    
+    def snapshot(self) -> dict:
+        """Budget usage plus per-namespace quotas and CacheStats."""
+        namespaces = {}
+        for name, ns in self._namespaces.items():
+            stats = ns.cache.stats
+            namespaces[name] = {
+                "entries": len(ns.cache._cache),
+                "min_size": ns.min_size,
+                "max_size": ns.max_size,
+                "weight": ns.weight,
+                "stats": stats.snapshot() if stats is not None else None,
+            }
+        return {
+            "max_size": self._max_size,
+            "entries": self.entry_count(),
+            "retired_entries": sum(len(store) for store in self._retired),
+            "namespaces": namespaces,
+        }
+    
+    def flush(self) -> None:
+        """
+        Persist all declared namespaces to one file atomically.
+        
+        Raises:
+            OSError: If file cannot be written
+        """
+        namespaces = {
+            name: {
+                "min_size": ns.min_size,
+                "max_size": ns.max_size,
+                "weight": ns.weight,
+                "entries": ns.cache._snapshot_entries(),
+            }
+            for name, ns in self._namespaces.items()
+        }
+        data = {
+            "version": 3,
+            "max_size": self._max_size,
+            "namespaces": namespaces,
+        }
+        write_atomically(
+            self._persist_path,
+            lambda f: json.dump(data, f, indent=2, ensure_ascii=False)
+        )
+    
+    def load(self) -> None:
+        """Reload every declared namespace from the snapshot file."""
+        self._pending = self._read_snapshot()
+        for ns in self._namespaces.values():
+            ns.cache.clear()
+            self._load_namespace(ns)
+    
+    def _read_snapshot(self) -> dict[str, list]:
+        """Namespace name -> entry list; empty on a missing or bad file."""
+        try:
+            with open(self._persist_path, 'rb') as f:
+                data = json.loads(f.read())
+        except (ValueError, OSError):
+            return {}
+        if not isinstance(data, dict) or not isinstance(data.get("namespaces"), dict):
+            return {}
+        return {
+            name: ns["entries"]
+            for name, ns in data["namespaces"].items()
+            if isinstance(ns, dict) and isinstance(ns.get("entries"), list)
+        }
+    
+    def _load_namespace(self, ns: CacheNamespace) -> None:
+        entries = self._pending.pop(ns.name, None)
+        if not entries:
+            return
+        try:
+            ns.cache._load_entries(entries)
+        except (ValueError, TypeError, KeyError, SerializationError):
+            ns.cache.clear()
+        
+        # Trim the newest namespaces' loads to the budget
+        while self.entry_count() > self._max_size:
+            victim = self._victim() or ns
+            if not victim.cache._cache:
+                break
+            victim.cache._evict_lru()
+    
+    def _set(
+        self,
+        ns: CacheNamespace,
+        key: Any,
+        value: Any,
+        ttl_seconds: float | None
+    ) -> None:
+        if self._retired:
+            self._reclaim()
+        if key not in ns.cache._cache:
+            self._make_room(ns)
+        ns.cache.set(key, value, ttl_seconds)
+    
+    def _make_room(self, inserting: CacheNamespace) -> None:
+        """Evict until one more entry fits in the global budget."""
+        if self.entry_count() < self._max_size:
+            return
+        # Expired entries are free to reclaim wherever they live
+        for ns in self._namespaces.values():
+            ns.cache._prune_expired()
+        while self.entry_count() >= self._max_size:
+            # With every namespace at its minimum, the inserting one yields
+            victim = self._victim(inserting) or inserting
+            cache = victim.cache
+            if not cache._cache:
+                break
+            cache._evict_lru()
+            if cache.stats is not None:
+                cache.stats.evictions += 1
+    
+    def _victim(
+        self,
+        inserting: CacheNamespace | None = None
+    ) -> CacheNamespace | None:
+        """
+        Namespace above its min_size using the most of its weighted share.
+        
+        The inserting namespace is scored as if the new entry were already
+        in, and wins ties, so equal weights converge to equal shares.
+        """
+        best = None
+        best_score = -1.0
+        for ns in self._namespaces.values():
+            size = len(ns.cache._cache)
+            if size > ns.min_size:
+                if ns is inserting:
+                    score = (size + 1) / ns.weight
+                    better = score >= best_score
+                else:
+                    score = size / ns.weight
+                    better = score > best_score
+                if better:
+                    best, best_score = ns, score
+        return best
+    
+    def _reclaim(self) -> None:
+        """Release up to reclaim_batch entries of stores retired by clear."""
+        budget = self._reclaim_batch
+        retired = self._retired
+        while budget and retired:
+            store = retired[-1]
+            n = min(budget, len(store))
+            for _ in range(n):
+                store.popitem()
+            budget -= n
+            if not store:
+                retired.pop()
+
+
+# =============================================================================
+# DETERMINISTIC TEST SUITE
+# =============================================================================
+
+import unittest
+from unittest import TestCase
+
+
+class MockClock:
+    """Deterministic clock for testing."""
+    
+    def __init__(self, start: float = 0.0):
+        self._time = start
+    
+    def __call__(self) -> float:
+        return self._time
+    
+    def advance(self, seconds: float) -> None:
+        self._time += seconds
+    
+    def set(self, time: float) -> None:
+        self._time = time
+
+
+class TestTTLExpiry(TestCase):
+    """Test 1: TTL expiry removal."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_entry_expires_after_ttl(self):
+        """Entry should be accessible before TTL, None after."""
+        self.cache.set("key", "value", ttl_seconds=10.0)
+        
+        # Before expiration
+        self.clock.advance(9.9)
+        self.assertEqual(self.cache.get("key"), "value")
+        
+        # At exactly expiration time
+        self.clock.advance(0.1)  # Now at 1010.0, expires_at = 1010.0
+        self.assertIsNone(self.cache.get("key"))
+    
+    def test_expired_entry_removed_on_get(self):
+        """get() on expired entry should remove it from cache."""
+        self.cache.set("key", "value", ttl_seconds=5.0)
+        self.clock.advance(10.0)
+        
+        # Verify entry exists in raw cache
+        self.assertIn("key", self.cache._cache)
+        
+        # get() should return None and remove
+        self.assertIsNone(self.cache.get("key"))
+        self.assertNotIn("key", self.cache._cache)
+    
+    def test_no_ttl_never_expires(self):
+        """Entry with no TTL should never expire."""
+        self.cache.set("permanent", "value")
+        
+        self.clock.advance(1_000_000.0)  # Far future
+        self.assertEqual(self.cache.get("permanent"), "value")
+    
+    def test_zero_ttl_not_inserted(self):
+        """Zero or negative TTL should not insert entry."""
+        self.cache.set("zero", "value", ttl_seconds=0)
+        self.assertIsNone(self.cache.get("zero"))
+        
+        self.cache.set("negative", "value", ttl_seconds=-5)
+        self.assertIsNone(self.cache.get("negative"))
+    
+    def test_ttl_update_on_set(self):
+        """set() on existing key should update TTL."""
+        self.cache.set("key", "v1", ttl_seconds=5.0)
+        self.clock.advance(3.0)
+        
+        # Update with new TTL
+        self.cache.set("key", "v2", ttl_seconds=10.0)
+        
+        # Original would expire at t=1005, we're at t=1003
+        # New expires at t=1013
+        self.clock.advance(5.0)  # t=1008
+        self.assertEqual(self.cache.get("key"), "v2")
+        
+        self.clock.advance(5.0)  # t=1013
+        self.assertIsNone(self.cache.get("key"))
+
+
+class TestLRUOrdering(TestCase):
+    """Test 2: LRU order updates on get()."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=3,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_get_moves_to_mru(self):
+        """get() should move entry to MRU position."""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.set("c", 3)
+        # Order: a(LRU), b, c(MRU)
+        
+        # Access 'a' - should move to MRU
+        self.cache.get("a")
+        # Order: b(LRU), c, a(MRU)
+        
+        # Add 'd' - should evict 'b' (new LRU)
+        self.cache.set("d", 4)
+        
+        self.assertIsNone(self.cache.get("b"))  # Evicted
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("d"), 4)
+    
+    def test_set_moves_existing_to_mru(self):
+        """set() on existing key should move to MRU."""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.set("c", 3)
+        # Order: a(LRU), b, c(MRU)
+        
+        # Update 'a' - should move to MRU
+        self.cache.set("a", 100)
+        # Order: b(LRU), c, a(MRU)
+        
+        # Add 'd' - should evict 'b'
+        self.cache.set("d", 4)
+        
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 100)
+    
+    def test_failed_get_does_not_affect_lru(self):
+        """get() on missing/expired key should not affect LRU order."""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.set("c", 3)
+        
+        # Access missing key
+        self.cache.get("nonexistent")
+        
+        # Add 'd' - should still evict 'a' (original LRU)
+        self.cache.set("d", 4)
+        self.assertIsNone(self.cache.get("a"))
+
+
+class TestEvictionCorrectness(TestCase):
+    """Test 3: Eviction correctness under max_size."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_evicts_lru_when_full(self):
+        """Should evict LRU entry when at capacity."""
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=2,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)  # Should evict 'a'
+        
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+    
+    def test_multiple_evictions(self):
+        """Should handle multiple sequential evictions."""
+        cache: PersistentLRUTTLCache[int, str] = PersistentLRUTTLCache(
+            max_size=2,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        for i in range(10):
+            cache.set(i, f"value_{i}")
+        
+        # Only last 2 should remain
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(7))
+        self.assertEqual(cache.get(8), "value_8")
+        self.assertEqual(cache.get(9), "value_9")
+    
+    def test_size_one_cache(self):
+        """Cache with max_size=1 should work correctly."""
+        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=1,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache.set("a", "1")
+        self.assertEqual(cache.get("a"), "1")
+        
+        cache.set("b", "2")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "2")
+
+
+class TestExpiredPrunedBeforeEviction(TestCase):
+    """Test 4: Expired entries pruned before eviction."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=3,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_expired_pruned_instead_of_valid_lru(self):
+        """Expired entries should be removed before evicting valid LRU."""
+        # Add entries with TTL
+        self.cache.set("expire1", 1, ttl_seconds=5.0)
+        self.cache.set("expire2", 2, ttl_seconds=5.0)
+        self.cache.set("permanent", 3)
+        # Order: expire1(LRU), expire2, permanent(MRU)
+        
+        # Let TTL entries expire
+        self.clock.advance(10.0)
+        
+        # Cache is "full" with 3 entries, but 2 are expired
+        self.assertEqual(len(self.cache._cache), 3)
+        
+        # Add new entry - should prune expired, NOT evict permanent
+        self.cache.set("new", 4)
+        
+        self.assertEqual(self.cache.get("permanent"), 3)
+        self.assertEqual(self.cache.get("new"), 4)
+        self.assertIsNone(self.cache.get("expire1"))
+        self.assertIsNone(self.cache.get("expire2"))
+    
+    def test_mixed_expired_and_eviction(self):
+        """When expired pruning isn't enough, also evict LRU."""
+        self.cache.set("a", 1, ttl_seconds=5.0)  # Will expire
+        self.cache.set("b", 2)  # Permanent, LRU among valid
+        self.cache.set("c", 3)  # Permanent, MRU among valid
+        
+        self.clock.advance(10.0)  # 'a' expires
+        
+        # Add two new entries
+        self.cache.set("d", 4)  # Prunes 'a', fits
+        self.cache.set("e", 5)  # Must evict 'b'
+        
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.get("d"), 4)
+        self.assertEqual(self.cache.get("e"), 5)
+
+
+class TestPersistenceRoundTrip(TestCase):
+    """Test 5: Persistence round-trip preserves order + TTL semantics."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_basic_round_trip(self):
+        """Basic save and load preserves data."""
+        cache1: PersistentLRUTTLCache[str, dict] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache1.set("str", "value")
+        cache1.set("int", 42)
+        cache1.set("dict", {"nested": [1, 2, 3]})
+        cache1.flush()
+        
+        # Load into new cache
+        cache2: PersistentLRUTTLCache[str, dict] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        self.assertEqual(cache2.get("str"), "value")
+        self.assertEqual(cache2.get("int"), 42)
+        self.assertEqual(cache2.get("dict"), {"nested": [1, 2, 3]})
+    
+    def test_lru_order_preserved(self):
+        """LRU order should be preserved across persistence."""
+        cache1: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=3,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache1.set("a", 1)
+        cache1.set("b", 2)
+        cache1.set("c", 3)
+        cache1.get("a")  # Move 'a' to MRU
+        # Order: b(LRU), c, a(MRU)
+        cache1.flush()
+        
+        # Load and verify order by adding new entry
+        cache2: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=3,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache2.set("d", 4)  # Should evict 'b'
+        
+        self.assertIsNone(cache2.get("b"))
+        self.assertEqual(cache2.get("c"), 3)
+        self.assertEqual(cache2.get("a"), 1)
+        self.assertEqual(cache2.get("d"), 4)
+    
+    def test_ttl_preserved_and_enforced(self):
+        """TTL should be preserved and enforced after reload."""
+        cache1: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache1.set("short", "expires", ttl_seconds=10.0)
+        cache1.set("long", "lasts", ttl_seconds=100.0)
+        cache1.flush()
+        
+        # Advance time and reload
+        self.clock.advance(50.0)
+        
+        cache2: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        # 'short' should be discarded on load (expired)
+        self.assertIsNone(cache2.get("short"))
+        # 'long' should still exist
+        self.assertEqual(cache2.get("long"), "lasts")
+    
+    def test_expired_discarded_on_load(self):
+        """Expired entries should not be loaded."""
+        cache1: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache1.set("expire1", 1, ttl_seconds=5.0)
+        cache1.set("expire2", 2, ttl_seconds=5.0)
+        cache1.set("permanent", 3)
+        cache1.flush()
+        
+        self.clock.advance(10.0)
+        
+        cache2: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        # Should only have permanent entry
+        self.assertEqual(len(cache2), 1)
+        self.assertEqual(cache2.get("permanent"), 3)
+    
+    def test_missing_file_starts_empty(self):
+        """Missing persistence file should start empty cache."""
+        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path="/nonexistent/path/cache.json",
+            now_fn=self.clock
+        )
+        
+        self.assertEqual(len(cache), 0)
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+    
+    def test_corrupted_file_starts_empty(self):
+        """Corrupted persistence file should start empty cache."""
+        # Write garbage to file
+        with open(self.path, 'w') as f:
+            f.write("not valid json {{{")
+        
+        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        self.assertEqual(len(cache), 0)
+
+
+class TestSerializationValidation(TestCase):
+    """Test serialization error handling."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.cache: PersistentLRUTTLCache = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_non_serializable_value_raises(self):
+        """Non-JSON-serializable value should raise SerializationError."""
+        with self.assertRaises(SerializationError) as ctx:
+            self.cache.set("key", lambda x: x)
+        
+        self.assertIn("value", str(ctx.exception))
+        self.assertIn("not JSON-serializable", str(ctx.exception))
+    
+    def test_non_serializable_key_raises(self):
+        """Non-JSON-serializable key should raise SerializationError."""
+        with self.assertRaises(SerializationError) as ctx:
+            self.cache.set(object(), "value")
+        
+        self.assertIn("key", str(ctx.exception))
+    
+    def test_mutation_not_applied_on_error(self):
+        """Cache should not be modified if serialization fails."""
+        self.cache.set("existing", "value")
+        
+        try:
+            self.cache.set("existing", lambda x: x)  # Will fail
+        except SerializationError:
+            pass
+        
+        # Original value should be preserved
+        self.assertEqual(self.cache.get("existing"), "value")
+
+
+class TestEdgeCases(TestCase):
+    """Additional edge case tests."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_invalid_max_size(self):
+        """max_size < 1 should raise ValueError."""
+        with self.assertRaises(ValueError):
+            PersistentLRUTTLCache(max_size=0, persist_path=self.path)
+        
+        with self.assertRaises(ValueError):
+            PersistentLRUTTLCache(max_size=-1, persist_path=self.path)
+    
+    def test_delete_returns_correct_bool(self):
+        """delete() should return True if key existed."""
+        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache.set("key", "value")
+        self.assertTrue(cache.delete("key"))
+        self.assertFalse(cache.delete("key"))
+        self.assertFalse(cache.delete("never_existed"))
+    
+    def test_clear(self):
+        """clear() should remove all entries."""
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        
+        cache.clear()
+        
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get("a"))
+    
+    def test_contains_does_not_update_lru(self):
+        """'in' operator should not update LRU order."""
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=2,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Order: a(LRU), b(MRU)
+        
+        # Check 'a' with 'in' - should NOT move to MRU
+        _ = "a" in cache
+        
+        # Add 'c' - should evict 'a' if 'in' didn't update LRU
+        cache.set("c", 3)
+        
+        self.assertIsNone(cache.get("a"))  # Evicted
+        self.assertEqual(cache.get("b"), 2)
+    
+    def test_len_excludes_expired(self):
+        """__len__ should only count non-expired entries."""
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            now_fn=self.clock
+        )
+        
+        cache.set("a", 1, ttl_seconds=5.0)
+        cache.set("b", 2, ttl_seconds=5.0)
+        cache.set("c", 3)  # Permanent
+        
+        self.assertEqual(len(cache), 3)
+        
+        self.clock.advance(10.0)
+        
+        self.assertEqual(len(cache), 1)
+
+
+class TestCoarseClock(TestCase):
+    """Coarse cached clock used for TTL checks."""
+    
+    def setUp(self):
+        self.source = MockClock(1000.0)
+        self.clock = CoarseClock(resolution=0.01, source=self.source)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
+            max_size=10,
+            persist_path=self.path,
+            coarse_clock=self.clock
+        )
+    
+    def tearDown(self):
+        self.clock.stop()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_invalid_resolution(self):
+        """resolution <= 0 should raise ValueError."""
+        with self.assertRaises(ValueError):
+            CoarseClock(resolution=0)
+    
+    def test_reads_cached_time_until_tick(self):
+        """TTL checks should see the cached time, not the source clock."""
+        self.cache.set("key", "value", ttl_seconds=10.0)
+        
+        # Source moves past expiry, but the cached time has not
+        self.source.advance(20.0)
+        self.assertEqual(self.cache.get("key"), "value")
+        self.assertIn("key", self.cache)
+        
+        # Per-batch refresh makes the expiry visible
+        self.clock.tick()
+        self.assertIsNone(self.cache.get("key"))
+    
+    def test_ttl_based_on_cached_time(self):
+        """set() should compute expires_at from the cached time."""
+        self.source.advance(5.0)
+        self.cache.set("key", "value", ttl_seconds=10.0)
+        self.assertEqual(self.cache._cache["key"][1], 1010.0)
+    
+    def test_ticker_thread_refreshes(self):
+        """Background ticker should refresh the cached time."""
+        self.source.advance(1.0)
+        self.clock.start()
+        deadline = time.monotonic() + 2.0
+        while self.clock.now != 1001.0 and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.clock.stop()
+        self.assertEqual(self.clock.now, 1001.0)
+    
+    def test_callable_as_now_fn(self):
+        """CoarseClock should also work as a plain now_fn."""
+        self.assertEqual(self.clock(), 1000.0)
+        self.assertEqual(self.cache._now_fn(), 1000.0)
+
+
+class TestCacheStats(TestCase):
+    """Hit/miss/eviction counters and latency histograms."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=2,
+            persist_path=self.path,
+            now_fn=self.clock,
+            stats=CacheStats(sample_every=1)
+        )
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_counts_hits_misses_and_expiry(self):
+        """get() outcomes should be counted separately."""
+        self.cache.set("a", 1, ttl_seconds=5.0)
+        self.cache.get("a")
+        self.cache.get("missing")
+        self.clock.advance(10.0)
+        self.cache.get("a")
+        
+        stats = self.cache.stats
+        self.assertEqual(stats.hits, 1)
+        self.assertEqual(stats.misses, 2)
+        self.assertEqual(stats.expired_on_read, 1)
+        self.assertAlmostEqual(stats.hit_ratio, 1 / 3)
+    
+    def test_counts_evictions_and_rejects(self):
+        """Evictions, prunes and rejected writes should be counted."""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl_seconds=1.0)
+        self.cache.set("c", 3)  # Evicts 'a'
+        self.clock.advance(5.0)
+        self.cache.set("d", 4)  # Prunes expired 'b'
+        self.cache.set("e", 5, ttl_seconds=0)
+        
+        stats = self.cache.stats
+        self.assertEqual(stats.evictions, 1)
+        self.assertEqual(stats.expired_pruned, 1)
+        self.assertEqual(stats.admission_rejects, 1)
+    
+    def test_flush_metrics(self):
+        """flush() should record count, duration and bytes written."""
+        self.cache.set("a", 1)
+        self.cache.flush()
+        
+        stats = self.cache.stats
+        self.assertEqual(stats.flushes, 1)
+        self.assertGreaterEqual(stats.flush_seconds, 0.0)
+        self.assertEqual(stats.bytes_written, os.path.getsize(self.path))
+    
+    def test_latency_sampling(self):
+        """Only one in sample_every operations should be timed."""
+        stats = CacheStats(sample_every=4)
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=10, persist_path=self.path, now_fn=self.clock,
+            stats=stats
+        )
+        for i in range(8):
+            cache.set(str(i), i)
+            cache.get(str(i))
+        self.assertEqual(stats.get_latency.count, 2)
+        self.assertEqual(stats.set_latency.count, 2)
+    
+    def test_disabled_stats(self):
+        """stats=False should disable counting entirely."""
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=2, persist_path=self.path, now_fn=self.clock,
+            stats=False
+        )
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.stats)
+    
+    def test_prometheus_export(self):
+        """Exposition text should include counters and histogram series."""
+        self.cache.set("a", 1)
+        self.cache.get("a")
+        self.cache.get("b")
+        text = self.cache.stats.to_prometheus(prefix="c")
+        
+        self.assertIn("# TYPE c_hits_total counter", text)
+        self.assertIn("c_hits_total 1\n", text)
+        self.assertIn("c_misses_total 1\n", text)
+        self.assertIn('c_get_latency_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn("c_get_latency_seconds_count 2", text)
+        self.assertTrue(text.endswith("\n"))
+    
+    def test_histogram_quantile(self):
+        """quantile() should return the containing bucket's upper bound."""
+        hist = LatencyHistogram(bounds=(0.001, 0.01, 0.1))
+        for _ in range(99):
+            hist.observe(0.0005)
+        hist.observe(0.05)
+        self.assertEqual(hist.quantile(0.5), 0.001)
+        self.assertEqual(hist.quantile(1.0), 0.1)
+        hist.observe(5.0)
+        self.assertEqual(hist.quantile(1.0), float('inf'))
+
+
+def _exact_lru_hit_ratio(keys: list, size: int) -> float:
+    """Reference read-through LRU simulation for MRC tests."""
+    lru: OrderedDict = OrderedDict()
+    hits = 0
+    for key in keys:
+        if key in lru:
+            hits += 1
+            lru.move_to_end(key)
+        else:
+            lru[key] = None
+            if len(lru) > size:
+                lru.popitem(last=False)
+    return hits / len(keys)
+
+
+class TestShardsMRC(TestCase):
+    """SHARDS miss-ratio curve estimation."""
+    
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            ShardsMRC(sample_rate=0)
+        with self.assertRaises(ValueError):
+            ShardsMRC(sample_rate=1.5)
+        with self.assertRaises(ValueError):
+            ShardsMRC(max_samples=0)
+    
+    def test_exact_at_full_sampling(self):
+        """With R=1 and small sizes the curve should match exact LRU."""
+        import random
+        rng = random.Random(7)
+        keys = [int(rng.expovariate(0.1)) for _ in range(3000)]
+        mrc = ShardsMRC(sample_rate=1.0, max_samples=10_000)
+        for key in keys:
+            mrc.record(key)
+        
+        for size in (1, 2, 5, 10, 15):
+            self.assertAlmostEqual(
+                mrc.hit_ratio(size), _exact_lru_hit_ratio(keys, size), places=9
+            )
+    
+    def test_sampled_estimate_is_close(self):
+        """Sampled, memory-bounded estimate should track exact LRU."""
+        import random
+        rng = random.Random(11)
+        keys = [min(int(rng.paretovariate(1.2)), 5000) for _ in range(40_000)]
+        mrc = ShardsMRC(sample_rate=0.2, max_samples=400)
+        for key in keys:
+            mrc.record(key)
+        
+        for size in (50, 200, 1000):
+            self.assertAlmostEqual(
+                mrc.hit_ratio(size), _exact_lru_hit_ratio(keys, size), delta=0.05
+            )
+    
+    def test_memory_is_bounded(self):
+        """Tracked keys should never exceed max_samples."""
+        mrc = ShardsMRC(sample_rate=1.0, max_samples=64)
+        tree_len = len(mrc._tree)
+        for i in range(20_000):
+            mrc.record(i)
+        self.assertLessEqual(len(mrc._last), 64)
+        self.assertLessEqual(len(mrc._heap), 64)
+        self.assertEqual(len(mrc._tree), tree_len)
+        self.assertLess(mrc.sample_rate, 1.0)
+    
+    def test_curve_is_monotonic(self):
+        mrc = ShardsMRC(sample_rate=1.0)
+        for i in range(2000):
+            mrc.record(i % 300)
+            mrc.record(i % 7)
+        ratios = [m for _, m in mrc.curve([1, 10, 100, 300, 1000])]
+        self.assertEqual(ratios, sorted(ratios, reverse=True))
+    
+    def test_cache_estimates(self):
+        """Cache should expose hit ratios at multiples of max_size."""
+        path = tempfile.mktemp(suffix='.json')
+        cache: PersistentLRUTTLCache[int, int] = PersistentLRUTTLCache(
+            max_size=10, persist_path=path, now_fn=MockClock(0.0),
+            mrc=ShardsMRC(sample_rate=1.0)
+        )
+        for i in range(1000):
+            key = i % 15
+            if cache.get(key) is None:
+                cache.set(key, i)
+        
+        estimates = cache.estimate_hit_ratios((0.5, 1.0, 2.0))
+        self.assertEqual([e["max_size"] for e in estimates], [5, 10, 20])
+        # Cyclic access over 15 keys: LRU thrashes below 15, hits above
+        self.assertEqual(estimates[1]["hit_ratio"], 0.0)
+        self.assertAlmostEqual(estimates[2]["hit_ratio"], 985 / 1000)
+        
+        plain: PersistentLRUTTLCache[int, int] = PersistentLRUTTLCache(
+            max_size=10, persist_path=path, now_fn=MockClock(0.0)
+        )
+        with self.assertRaises(RuntimeError):
+            plain.estimate_hit_ratios()
+
+
+class TestMemoryAutoSizer(TestCase):
+    """Memory-pressure-driven resizing."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+        self.rss = 50
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def _write(self, relpath: str, text: str) -> str:
+        path = os.path.join(self.tmpdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+    
+    def _cache(self, sizer: MemoryAutoSizer, max_size: int = 100) -> PersistentLRUTTLCache:
+        cache: PersistentLRUTTLCache[int, int] = PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock,
+            autosizer=sizer
+        )
+        return cache
+    
+    def _sizer(self, **kwargs) -> MemoryAutoSizer:
+        kwargs.setdefault("limit_bytes", 100)
+        return MemoryAutoSizer(rss_fn=lambda: self.rss, **kwargs)
+    
+    def test_read_process_rss(self):
+        path = self._write("statm", "1000 25 10 1 0 50 0\n")
+        self.assertEqual(read_process_rss(path), 25 * os.sysconf('SC_PAGE_SIZE'))
+        self.assertIsNone(read_process_rss(os.path.join(self.tmpdir, "missing")))
+    
+    def test_read_cgroup_limit(self):
+        """cgroup v2 and v1 limits, with 'unlimited' mapped to None."""
+        self.assertIsNone(read_cgroup_memory_limit(self.tmpdir))
+        
+        self._write("memory/memory.limit_in_bytes", "9223372036854771712\n")
+        self.assertIsNone(read_cgroup_memory_limit(self.tmpdir))
+        self._write("memory/memory.limit_in_bytes", "536870912\n")
+        self.assertEqual(read_cgroup_memory_limit(self.tmpdir), 536870912)
+        
+        self._write("memory.max", "max\n")
+        self.assertIsNone(read_cgroup_memory_limit(self.tmpdir))
+        self._write("memory.max", "1073741824\n")
+        self.assertEqual(read_cgroup_memory_limit(self.tmpdir), 1073741824)
+    
+    def test_shrinks_in_bounded_batches(self):
+        """Low headroom should shed at most evict_batch entries per check."""
+        sizer = self._sizer(shrink_step=0.5, evict_batch=10)
+        cache = self._cache(sizer)
+        for i in range(100):
+            cache.set(i, i)
+        
+        self.rss = 95  # 5% headroom
+        self.assertEqual(sizer.adjust(cache), 90)
+        self.assertEqual(len(cache._cache), 90)
+        self.assertEqual(cache.stats.evictions, 10)
+        self.assertEqual(sizer.adjust(cache), 80)
+        self.assertIsNone(cache.get(19))  # LRU entries went first
+        self.assertEqual(cache.get(20), 20)
+    
+    def test_shrink_respects_min_size(self):
+        sizer = self._sizer(min_size=40, shrink_step=0.5)
+        cache = self._cache(sizer)
+        self.rss = 99
+        for _ in range(5):
+            sizer.adjust(cache)
+            self.rss -= 1  # Each shrink frees some memory
+        self.assertEqual(cache.max_size, 40)
+    
+    def test_no_further_shrink_while_rss_stays_high(self):
+        """Constant RSS (memory not returned to the OS) stops after one step."""
+        sizer = self._sizer(check_every=1)
+        cache = self._cache(sizer, max_size=10000)
+        self.rss = 95
+        for i in range(200):
+            cache.set(i, i)
+        self.assertEqual((cache.max_size, sizer.shrinks), (9000, 1))
+        
+        self.rss = 94  # Freed memory shows up: one more step
+        cache.set("k", 0)
+        self.assertEqual((cache.max_size, sizer.shrinks), (8100, 2))
+        
+        self.rss = 80  # Pressure over: a new episode may shrink again
+        cache.set("k", 0)
+        self.rss = 95
+        cache.set("k", 0)
+        self.assertEqual((cache.max_size, sizer.shrinks), (7290, 3))
+    
+    def test_grows_gradually_to_ceiling(self):
+        """High headroom should grow by grow_step, never past the ceiling."""
+        sizer = self._sizer(grow_step=0.1)
+        cache = self._cache(sizer)
+        cache.resize(50)
+        
+        self.rss = 10  # 90% headroom
+        self.assertEqual(sizer.adjust(cache), 55)
+        for _ in range(20):
+            sizer.adjust(cache)
+        self.assertEqual(cache.max_size, 100)
+        self.assertEqual(sizer.ceiling, 100)
+    
+    def test_hysteresis_band_holds(self):
+        """Headroom between the watermarks should leave max_size alone."""
+        sizer = self._sizer()
+        cache = self._cache(sizer)
+        cache.resize(60)
+        self.rss = 80  # 20% headroom: between 10% and 25%
+        self.assertEqual(sizer.adjust(cache), 60)
+        self.assertEqual((sizer.shrinks, sizer.grows), (0, 0))
+    
+    def test_unknown_limit_is_noop(self):
+        sizer = MemoryAutoSizer(rss_fn=lambda: 10, limit_fn=lambda: None)
+        cache = self._cache(sizer)
+        self.assertEqual(sizer.adjust(cache), 100)
+        self.assertIsNone(sizer.last_headroom)
+    
+    def test_checks_run_from_set(self):
+        """set() should trigger a check every check_every calls."""
+        sizer = self._sizer(check_every=5, shrink_step=0.5)
+        cache = self._cache(sizer, max_size=10)
+        self.rss = 99
+        for i in range(4):
+            cache.set(i, i)
+        self.assertEqual(cache.max_size, 10)
+        cache.set(4, 4)
+        self.assertEqual(cache.max_size, 5)
+    
+    def test_resize(self):
+        """resize() should prune expired entries before evicting live ones."""
+        cache = self._cache(None, max_size=10)
+        cache.set("old", 0, ttl_seconds=1.0)
+        for i in range(5):
+            cache.set(i, i)
+        self.clock.advance(5.0)
+        
+        self.assertEqual(cache.resize(3), 2)
+        self.assertEqual(cache.max_size, 3)
+        self.assertEqual(cache.get(4), 4)
+        with self.assertRaises(ValueError):
+            cache.resize(0)
+    
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            MemoryAutoSizer(low_headroom=0.3, high_headroom=0.2)
+        with self.assertRaises(ValueError):
+            MemoryAutoSizer(shrink_step=1.5)
+        with self.assertRaises(ValueError):
+            MemoryAutoSizer(evict_batch=0)
+
+
+class TestCompactStorage(TestCase):
+    """CompactLRUStore behaves like the OrderedDict it replaces."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def test_differential_against_ordered_dict(self):
+        """Random operation sequences should match OrderedDict exactly."""
+        import random
+        rng = random.Random(3)
+        ref: OrderedDict = OrderedDict()
+        store = CompactLRUStore()
+        
+        for _ in range(5000):
+            op = rng.randrange(6)
+            key = rng.randrange(40)
+            if op == 0:
+                entry = (rng.random(), rng.choice([None, rng.random()]))
+                ref[key] = entry
+                store[key] = entry
+            elif op == 1 and key in ref:
+                ref.move_to_end(key)
+                store.move_to_end(key)
+            elif op == 2:
+                self.assertEqual(store.pop(key, None), ref.pop(key, None))
+            elif op == 3 and ref:
+                last = rng.random() < 0.5
+                self.assertEqual(store.popitem(last=last), ref.popitem(last=last))
+            elif op == 4 and key in ref:
+                del ref[key]
+                del store[key]
+            else:
+                self.assertEqual(store.get(key), ref.get(key))
+            self.assertEqual(len(store), len(ref))
+        
+        self.assertEqual(list(store.items()), list(ref.items()))
+        self.assertEqual(list(store), list(ref))
+    
+    def test_slots_are_reused(self):
+        """Released slots should be reused instead of growing the arrays."""
+        store = CompactLRUStore()
+        for i in range(100):
+            store[i] = (i, None)
+        for i in range(100):
+            del store[i]
+        for i in range(100, 200):
+            store[i] = (i, None)
+        self.assertEqual(len(store._keys), 101)  # 100 slots + sentinel
+    
+    def test_errors_match_ordered_dict(self):
+        store = CompactLRUStore()
+        with self.assertRaises(KeyError):
+            store.popitem()
+        with self.assertRaises(KeyError):
+            store.pop("missing")
+        with self.assertRaises(KeyError):
+            store["missing"]
+    
+    def test_cache_semantics(self):
+        """LRU, TTL and persistence should work on the compact engine."""
+        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=3, persist_path=self.path, now_fn=self.clock,
+            storage="compact"
+        )
+        cache.set("a", 1)
+        cache.set("b", 2, ttl_seconds=5.0)
+        cache.set("c", 3)
+        cache.get("a")
+        cache.set("d", 4)  # Evicts 'b' (LRU)
+        self.assertIsNone(cache.get("b"))
+        
+        cache.set("e", 5, ttl_seconds=5.0)  # Evicts 'c'
+        self.clock.advance(10.0)
+        self.assertNotIn("e", cache)
+        self.assertEqual(len(cache), 2)
+        cache.flush()
+        
+        reloaded: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
+            max_size=3, persist_path=self.path, now_fn=self.clock,
+            storage="compact"
+        )
+        self.assertEqual(
+            [k for k, _, _ in reloaded._debug_state()["entries"]], ["a", "d"]
+        )
+    
+    def test_invalid_storage(self):
+        with self.assertRaises(ValueError):
+            PersistentLRUTTLCache(max_size=1, persist_path=self.path, storage="btree")
+    
+    def test_uses_less_memory(self):
+        """Compact layout should need fewer bytes per entry."""
+        import tracemalloc
+        keys = [f"key{i}" for i in range(20_000)]
+        
+        def traced(storage: str) -> int:
+            tracemalloc.start()
+            cache = PersistentLRUTTLCache(
+                max_size=len(keys), persist_path=self.path, now_fn=self.clock,
+                storage=storage
+            )
+            for i, key in enumerate(keys):
+                # Distinct expiry per entry, as real TTLs produce
+                cache._cache[key] = (1, 2000.0 + i)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return size
+        
+        self.assertLess(traced("compact"), traced("ordered") * 0.75)
+
+
+class TestSlabArena(TestCase):
+    """SlabArena storage and its integration with the cache."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def _cache(self, max_size: int = 100, **kwargs) -> PersistentLRUTTLCache:
+        return PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock, **kwargs
+        )
+    
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            SlabArena(min_chunk=4)
+        with self.assertRaises(ValueError):
+            SlabArena(slab_size=32, min_chunk=64)
+        with self.assertRaises(ValueError):
+            SlabArena(growth=1.0)
+    
+    def test_size_classes(self):
+        arena = SlabArena(slab_size=4096, min_chunk=64, growth=2.0)
+        self.assertEqual(arena.chunk_sizes, (64, 128, 256, 512, 1024, 2048, 4096))
+        self.assertTrue(all(s % 8 == 0 for s in SlabArena().chunk_sizes))
+    
+    def test_put_get_free(self):
+        arena = SlabArena(slab_size=4096, min_chunk=64, growth=2.0)
+        small = arena.put(b"a" * 10)
+        large = arena.put(b"b" * 1000)
+        huge = arena.put(b"c" * 5000)  # Larger than a slab
+        self.assertEqual(bytes(arena.get(small)), b"a" * 10)
+        self.assertEqual(bytes(arena.get(large)), b"b" * 1000)
+        self.assertEqual(bytes(arena.get(huge)), b"c" * 5000)
+        self.assertEqual(len(arena), 3)
+        self.assertEqual(arena.used_bytes, 6010)
+        
+        arena.free(small)
+        arena.free(huge)
+        self.assertEqual(len(arena), 1)
+        self.assertEqual(arena.used_bytes, 1000)
+        self.assertEqual(arena.snapshot()["oversize_values"], 0)
+    
+    def test_chunks_are_reused(self):
+        """Freed chunks should be reused before new slabs are allocated."""
+        arena = SlabArena(slab_size=1024, min_chunk=64, growth=2.0)
+        handles = [arena.put(bytes([i]) * 50) for i in range(64)]
+        allocated = arena.allocated_bytes
+        self.assertEqual(allocated, 4 * 1024)  # 16 chunks of 64 per slab
+        
+        for handle in handles[::2]:
+            arena.free(handle)
+        for i in range(32):
+            arena.put(b"z" * 60)
+        self.assertEqual(arena.allocated_bytes, allocated)
+        for i, handle in enumerate(handles[1::2]):
+            self.assertEqual(bytes(arena.get(handle)), bytes([2 * i + 1]) * 50)
+        
+        arena.clear()
+        self.assertEqual(arena.allocated_bytes, 0)
+        self.assertEqual(len(arena), 0)
+    
+    def test_cache_stores_handles(self):
+        cache = self._cache(arena=SlabArena())
+        value = {"name": "x", "tags": ["a", "b"], "n": 3}
+        cache.set("k", value)
+        
+        stored, _ = cache._cache["k"]
+        self.assertIsInstance(stored, int)
+        self.assertEqual(cache.get("k"), value)
+        self.assertEqual(cache._debug_state()["entries"], [("k", value, None)])
+    
+    def test_chunks_reclaimed_on_every_removal_path(self):
+        arena = SlabArena()
+        cache = self._cache(max_size=3, arena=arena)
+        
+        cache.set("a", 1, ttl_seconds=10)
+        cache.set("b", 2)
+        cache.set("a", 3)  # Overwrite
+        self.assertEqual(len(arena), 2)
+        
+        cache.set("c", 4, ttl_seconds=10)
+        cache.set("d", 5)  # Evicts "b"
+        self.assertEqual(len(arena), 3)
+        
+        self.clock.advance(20)
+        self.assertIsNone(cache.get("c"))  # Expired on read
+        self.assertEqual(len(arena), 2)
+        
+        cache.set("e", 6, ttl_seconds=0)  # Rejected
+        cache.delete("a")
+        cache.set("d", 7, ttl_seconds=-1)  # Removes existing "d"
+        self.assertEqual(len(arena), 0)
+        
+        cache.set("f", 8)
+        cache.clear()
+        self.assertEqual(len(arena), 0)
+    
+    def test_matches_plain_cache(self):
+        """Random operations should give identical results with and without an arena."""
+        import random
+        rng = random.Random(7)
+        plain = self._cache(max_size=20)
+        packed = PersistentLRUTTLCache(
+            max_size=20, persist_path=self.path + ".arena",
+            now_fn=self.clock, arena=SlabArena(slab_size=1024)
+        )
+        
+        for _ in range(3000):
+            key = f"k{rng.randrange(40)}"
+            op = rng.randrange(4)
+            if op == 0:
+                value = {"v": "x" * rng.randrange(2000), "n": rng.random()}
+                ttl = rng.choice([None, 1.0, 5.0])
+                plain.set(key, value, ttl_seconds=ttl)
+                packed.set(key, value, ttl_seconds=ttl)
+            elif op == 1:
+                self.assertEqual(packed.get(key), plain.get(key))
+            elif op == 2:
+                self.assertEqual(packed.delete(key), plain.delete(key))
+            else:
+                self.clock.advance(0.5)
+        
+        self.assertEqual(packed._debug_state(), plain._debug_state())
+        self.assertEqual(len(packed._arena), len(packed._cache))
+    
+    def test_persistence_round_trip(self):
+        cache = self._cache(arena=SlabArena())
+        cache.set("a", [1, 2, 3])
+        cache.set("b", {"x": "ü"}, ttl_seconds=100)
+        cache.flush()
+        
+        arena = SlabArena()
+        loaded = self._cache(arena=arena)
+        self.assertEqual(loaded.get("a"), [1, 2, 3])
+        self.assertEqual(loaded.get("b"), {"x": "ü"})
+        self.assertEqual(len(arena), 2)
+    
+    def test_non_serializable_value_raises(self):
+        cache = self._cache(arena=SlabArena())
+        with self.assertRaises(SerializationError):
+            cache.set("k", {1, 2})
+        self.assertEqual(len(cache._cache), 0)
+    
+    def test_freeze_gc_after_load(self):
+        cache = self._cache()
+        cache.set("a", {"x": 1})
+        cache.flush()
+        
+        gc.unfreeze()
+        try:
+            self._cache(freeze_gc=True)
+            self.assertGreater(gc.get_freeze_count(), 0)
+        finally:
+            gc.unfreeze()
+
+
+class TestCompression(TestCase):
+    """ValueCompressor in memory, in the arena and on persist."""
+    
+    DOC = {"items": [{"id": i, "name": "item", "tags": ["a", "b"]} for i in range(200)]}
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.json')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def _cache(self, **kwargs) -> PersistentLRUTTLCache:
+        return PersistentLRUTTLCache(
+            max_size=100, persist_path=self.path, now_fn=self.clock, **kwargs
+        )
+    
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            ValueCompressor("snappy")
+        with self.assertRaises(ValueError):
+            ValueCompressor(threshold=-1)
+    
+    def test_pack_round_trip_all_algorithms(self):
+        data = json.dumps(self.DOC).encode()
+        for algorithm in ("zlib", "bz2", "lzma"):
+            comp = ValueCompressor(algorithm, level=1, threshold=100)
+            blob = comp.pack(data)
+            self.assertLess(len(blob), len(data) // 5)
+            self.assertEqual(bytes(comp.unpack(blob)), data)
+            self.assertEqual(comp.compressed, 1)
+            self.assertEqual(comp.decompressions, 1)
+            self.assertGreater(comp.ratio, 5.0)
+    
+    def test_threshold_and_incompressible(self):
+        comp = ValueCompressor(threshold=100)
+        self.assertEqual(comp.pack(b"small"), b"\x00small")
+        noise = os.urandom(1000)
+        self.assertEqual(comp.pack(noise), b"\x00" + noise)
+        self.assertEqual(comp.below_threshold, 1)
+        self.assertEqual(comp.incompressible, 1)
+        self.assertEqual(comp.compressed, 0)
+        self.assertEqual(comp.ratio, 1.0)
+    
+    def test_cache_round_trip(self):
+        comp = ValueCompressor(threshold=256)
+        cache = self._cache(compressor=comp)
+        cache.set("big", self.DOC)
+        cache.set("small", {"x": 1})
+        
+        stored, _ = cache._cache["big"]
+        self.assertLess(len(stored), len(json.dumps(self.DOC)) // 5)
+        self.assertEqual(cache.get("big"), self.DOC)
+        self.assertEqual(cache.get("small"), {"x": 1})
+        snap = comp.snapshot()
+        self.assertEqual(snap["compressed"], 1)
+        self.assertEqual(snap["below_threshold"], 1)
+        self.assertGreaterEqual(snap["compress_seconds"], 0.0)
+    
+    def test_with_arena(self):
+        arena = SlabArena()
+        cache = self._cache(compressor=ValueCompressor(threshold=256), arena=arena)
+        cache.set("big", self.DOC)
+        self.assertLess(arena.used_bytes, len(json.dumps(self.DOC)) // 5)
+        self.assertEqual(cache.get("big"), self.DOC)
+        cache.delete("big")
+        self.assertEqual(len(arena), 0)
+    
+    def test_persisted_compressed(self):
+        cache = self._cache(compressor=ValueCompressor(threshold=256))
+        cache.set("big", self.DOC, ttl_seconds=100)
+        cache.set("small", [1, 2])
+        cache.flush()
+        
+        with open(self.path, encoding='utf-8') as f:
+            entries = json.load(f)["entries"]
+        self.assertEqual(entries[0]["compressed"], "zlib")
+        self.assertIsInstance(entries[0]["value"], str)
+        self.assertEqual(entries[1], {"key": "small", "value": [1, 2], "expires_at": None})
+        
+        # Same algorithm: payload adopted without recompressing
+        comp = ValueCompressor(threshold=256)
+        loaded = self._cache(compressor=comp)
+        self.assertEqual(comp.compressed, 0)
+        self.assertEqual(loaded.get("big"), self.DOC)
+        
+        # Different or no compressor: payload decoded on load
+        self.assertEqual(self._cache(compressor=ValueCompressor("lzma")).get("big"), self.DOC)
+        self.assertEqual(self._cache().get("big"), self.DOC)
+    
+    def test_corrupt_compressed_entry_skipped(self):
+        data = {"version": 3, "max_size": 100, "entries": [
+            {"key": "bad", "value": "not base64!", "expires_at": None, "compressed": "zlib"},
+            {"key": "junk", "value": "AAAA", "expires_at": None, "compressed": "zlib"},
+            {"key": "odd", "value": "AAAA", "expires_at": None, "compressed": "rot13"},
+            {"key": "ok", "value": 1, "expires_at": None},
+        ]}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        cache = self._cache()
+        self.assertEqual(cache._debug_state()["entries"], [("ok", 1, None)])
+
+
+class _Point:
+    """Picklable non-JSON value for codec tests."""
+    
+    def __init__(self, x: int, y: int):
+        self.x = x
+        self.y = y
+    
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Point) and (self.x, self.y) == (other.x, other.y)
+
+
+class TestPickleCodec(TestCase):
+    """Pluggable codecs and the pickle protocol 5 binary path."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.path = tempfile.mktemp(suffix='.bin')
+    
+    def tearDown(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    
+    def _cache(self, **kwargs) -> PersistentLRUTTLCache:
+        kwargs.setdefault("codec", PickleCodec())
+        return PersistentLRUTTLCache(
+            max_size=100, persist_path=self.path, now_fn=self.clock, **kwargs
+        )
+    
+    def test_large_bytes_stored_out_of_band(self):
+        payload = os.urandom(1 << 16)
+        cache = self._cache()
+        cache.set("blob", payload)
+        
+        header, buffers = cache._cache["blob"][0]
+        self.assertLess(len(header), 100)
+        self.assertIs(buffers[0].obj, payload)  # Referenced, not copied
+        
+        value = cache.get("blob")
+        self.assertIsInstance(value, memoryview)
+        self.assertTrue(value.readonly)
+        self.assertEqual(value, payload)
+    
+    def test_writable_buffer_copied_once(self):
+        data = bytearray(b"a" * 4096)
+        cache = self._cache()
+        cache.set("buf", data)
+        data[0] = ord("z")
+        self.assertEqual(bytes(cache.get("buf")[:1]), b"a")
+    
+    def test_small_and_non_json_values(self):
+        cache = self._cache()
+        cache.set("small", b"abc")
+        cache.set("point", _Point(1, 2))
+        cache.set("mixed", {"t": (1, 2), "s": {3}})
+        self.assertEqual(cache.get("small"), b"abc")
+        self.assertEqual(cache.get("point"), _Point(1, 2))
+        self.assertEqual(cache.get("mixed"), {"t": (1, 2), "s": {3}})
+    
+    def test_unpicklable_value_raises(self):
+        cache = self._cache()
+        with self.assertRaises(SerializationError):
+            cache.set("k", lambda: None)
+        with self.assertRaises(SerializationError):
+            cache.set({"not": "hashable-json"}.get, 1)  # Key stays JSON-validated
+        self.assertEqual(len(cache._cache), 0)
+    
+    def test_binary_round_trip(self):
+        payload = os.urandom(10_000)
+        cache = self._cache()
+        cache.set("blob", payload)
+        cache.set("point", _Point(3, 4), ttl_seconds=50)
+        cache.set("gone", 1, ttl_seconds=5)
+        cache.flush()
+        
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read(16).startswith(_BINARY_MAGIC))
+        
+        self.clock.advance(10)
+        loaded = self._cache()
+        self.assertEqual(loaded.get("blob"), payload)
+        self.assertIsInstance(loaded.get("blob"), memoryview)
+        self.assertEqual(loaded.get("point"), _Point(3, 4))
+        self.assertIsNone(loaded.get("gone"))
+        self.assertEqual(
+            [k for k, _, _ in loaded._debug_state()["entries"]], ["blob", "point"]
+        )
+    
+    def test_with_arena_and_compressor(self):
+        arena = SlabArena()
+        comp = ValueCompressor(threshold=64)
+        cache = self._cache(arena=arena, compressor=comp)
+        doc = {"rows": [_Point(i, i) for i in range(100)]}
+        cache.set("doc", doc)
+        self.assertEqual(cache.get("doc"), doc)
+        self.assertEqual(comp.compressed, 1)
+        cache.flush()
+        
+        # Binary file readable with the plain frames layout too
+        self.assertEqual(self._cache().get("doc"), doc)
+    
+    def test_json_cache_ignores_binary_file(self):
+        cache = self._cache()
+        cache.set("k", 1)
+        cache.flush()
+        plain = PersistentLRUTTLCache(
+            max_size=10, persist_path=self.path, now_fn=self.clock
+        )
+        self.assertEqual(len(plain._cache), 0)
+    
+    def test_pickle_cache_reads_json_file(self):
+        plain = PersistentLRUTTLCache(
+            max_size=10, persist_path=self.path, now_fn=self.clock
+        )
+        plain.set("k", [1, 2])
+        plain.flush()
+        self.assertEqual(self._cache().get("k"), [1, 2])
+    
+    def test_truncated_binary_file_starts_empty(self):
+        cache = self._cache()
+        cache.set("blob", os.urandom(5000))
+        cache.flush()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 100)
+        self.assertEqual(len(self._cache()._cache), 0)
+
+
+class TestBlobStore(TestCase):
+    """Large values in content-addressed, reference-counted blob files."""
+    
+    BIG = {"data": "x" * 5000}
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cache.json")
+        self.blob_dir = os.path.join(self.dir, "blobs")
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir, ignore_errors=True)
+    
+    def _cache(self, max_size: int = 10, **kwargs) -> PersistentLRUTTLCache:
+        kwargs.setdefault("blob_store", BlobStore(self.blob_dir, threshold=1024))
+        return PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock, **kwargs
+        )
+    
+    def _blob_files(self) -> list[str]:
+        return sorted(
+            name for _, _, files in os.walk(self.blob_dir) for name in files
         )
     
-    def tearDown(self):
-        try:
-            os.unlink(self.path)
-        except OSError:
-            pass
+    def test_large_values_go_to_blobs(self):
+        cache = self._cache()
+        cache.set("big", self.BIG)
+        cache.set("small", [1, 2])
+        
+        stored, _ = cache._cache["big"]
+        self.assertIsInstance(stored, BlobRef)
+        self.assertEqual(self._blob_files(), [stored.digest])
+        self.assertEqual(cache.get("big"), self.BIG)
+        self.assertEqual(cache.get("small"), [1, 2])
     
-    def test_entry_expires_after_ttl(self):
-        """Entry should be accessible before TTL, None after."""
-        self.cache.set("key", "value", ttl_seconds=10.0)
+    def test_snapshot_holds_references_only(self):
+        cache = self._cache()
+        cache.set("big", self.BIG, ttl_seconds=100)
+        cache.flush()
+        self.assertLess(os.path.getsize(self.path), 1000)
         
-        # Before expiration
-        self.clock.advance(9.9)
-        self.assertEqual(self.cache.get("key"), "value")
+        store = BlobStore(self.blob_dir, threshold=1024)
+        loaded = self._cache(blob_store=store)
+        self.assertEqual(store.reads, 0)  # Lazy: nothing read on load
+        self.assertEqual(loaded.get("big"), self.BIG)
+        self.assertEqual(store.reads, 1)
+    
+    def test_identical_values_share_a_blob(self):
+        cache = self._cache()
+        cache.set("a", self.BIG)
+        cache.set("b", self.BIG)
+        digest = cache._cache["a"][0].digest
+        self.assertEqual(cache._blobs.refcount(digest), 2)
+        self.assertEqual(len(self._blob_files()), 1)
         
-        # At exactly expiration time
-        self.clock.advance(0.1)  # Now at 1010.0, expires_at = 1010.0
-        self.assertIsNone(self.cache.get("key"))
+        cache.delete("a")
+        cache.flush()
+        self.assertEqual(len(self._blob_files()), 1)  # Still used by "b"
     
-    def test_expired_entry_removed_on_get(self):
-        """get() on expired entry should remove it from cache."""
-        self.cache.set("key", "value", ttl_seconds=5.0)
-        self.clock.advance(10.0)
+    def test_orphans_collected_after_flush(self):
+        cache = self._cache(max_size=2)
+        cache.set("a", {"data": "a" * 5000})
+        cache.set("b", {"data": "b" * 5000}, ttl_seconds=5)
+        cache.flush()
         
-        # Verify entry exists in raw cache
-        self.assertIn("key", self.cache._cache)
+        cache.set("a", {"data": "c" * 5000})  # Overwrite orphans the old blob
+        self.clock.advance(10)
+        cache.set("d", 1)  # Prunes expired "b"
+        self.assertEqual(len(self._blob_files()), 3)  # Old snapshot still valid
         
-        # get() should return None and remove
-        self.assertIsNone(self.cache.get("key"))
-        self.assertNotIn("key", self.cache._cache)
-    
-    def test_no_ttl_never_expires(self):
-        """Entry with no TTL should never expire."""
-        self.cache.set("permanent", "value")
+        cache.flush()
+        self.assertEqual(self._blob_files(), [cache._cache["a"][0].digest])
         
-        self.clock.advance(1_000_000.0)  # Far future
-        self.assertEqual(self.cache.get("permanent"), "value")
+        cache.clear()
+        cache.flush()
+        self.assertEqual(self._blob_files(), [])
     
-    def test_zero_ttl_not_inserted(self):
-        """Zero or negative TTL should not insert entry."""
-        self.cache.set("zero", "value", ttl_seconds=0)
-        self.assertIsNone(self.cache.get("zero"))
+    def test_load_sweeps_unreferenced_and_skips_missing(self):
+        cache = self._cache()
+        cache.set("a", {"data": "a" * 5000})
+        cache.set("b", {"data": "b" * 5000})
+        cache.flush()
+        os.unlink(cache._blobs.path(cache._cache["a"][0].digest))
+        stray = os.path.join(self.blob_dir, "ab", "ab" + "0" * 62)
+        os.makedirs(os.path.dirname(stray), exist_ok=True)
+        with open(stray, 'wb') as f:
+            f.write(b"left by a crash")
         
-        self.cache.set("negative", "value", ttl_seconds=-5)
-        self.assertIsNone(self.cache.get("negative"))
+        loaded = self._cache()
+        self.assertNotIn("a", loaded)
+        self.assertEqual(loaded.get("b"), {"data": "b" * 5000})
+        self.assertFalse(os.path.exists(stray))
     
-    def test_ttl_update_on_set(self):
-        """set() on existing key should update TTL."""
-        self.cache.set("key", "v1", ttl_seconds=5.0)
-        self.clock.advance(3.0)
-        
-        # Update with new TTL
-        self.cache.set("key", "v2", ttl_seconds=10.0)
+    def test_stream(self):
+        cache = self._cache(compressor=ValueCompressor(threshold=64))
+        value = {"rows": list(range(20000))}
+        cache.set("big", value)
+        cache.set("small", "hi")
+        self.assertIsInstance(cache._cache["big"][0], BlobRef)
         
-        # Original would expire at t=1005, we're at t=1003
-        # New expires at t=1013
-        self.clock.advance(5.0)  # t=1008
-        self.assertEqual(self.cache.get("key"), "v2")
+        chunks = list(cache.stream("big", chunk_size=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(json.loads(b"".join(chunks)), value)
+        self.assertEqual(b"".join(cache.stream("small")), b'"hi"')
+        self.assertIsNone(cache.stream("missing"))
+    
+    def test_stream_counts_as_get(self):
+        sql = SqliteBackend()
+        journal = MutationJournal()
+        cache = self._cache(
+            max_size=2, compressor=ValueCompressor(threshold=64), backend=sql,
+            journal=journal, hot_keys=HeavyHitters(8),
+            recorder=AccessRecorder(os.path.join(self.dir, "access.json"), sample_rate=1)
+        )
+        cache.set("big", {"rows": list(range(2000))})
+        cache.set("small", "hi")
+        before = journal.seq
+        list(cache.stream("big"))
+        cache.set("new", 1)  # Evicts "small": "big" was streamed last
+        self.assertEqual(list(cache._cache), ["big", "new"])
+        self.assertIn("big", sql._changed)
+        self.assertEqual(cache.stats.hits, 1)
+        self.assertEqual(cache._recorder.hottest(), ["big"])
+        self.assertEqual(cache.hot_keys(1)[0]["key"], "big")
+        self.assertIsNone(cache.stream("small"))
+        self.assertEqual(cache.stats.misses, 1)
+    
+    def test_pickle_binary_snapshot(self):
+        payload = os.urandom(4096)
+        cache = self._cache(codec=PickleCodec())
+        cache.set("blob", payload)
+        cache.flush()
+        self.assertLess(os.path.getsize(self.path), 1000)
+        self.assertEqual(self._cache(codec=PickleCodec()).get("blob"), payload)
+    
+    def test_config_change_reencodes(self):
+        cache = self._cache(compressor=ValueCompressor(threshold=64))
+        value = {"rows": list(range(2000))}
+        cache.set("big", value)
+        cache.flush()
         
-        self.clock.advance(5.0)  # t=1013
-        self.assertIsNone(self.cache.get("key"))
+        plain = self._cache()
+        self.assertEqual(plain.get("big"), value)
+        self.assertEqual(len(self._blob_files()), 2)  # Snapshot's blob kept
+        plain.flush()
+        self.assertEqual(len(self._blob_files()), 1)
+        self.assertFalse(self._cache(blob_store=None)._cache)  # Needs a store
 
 
-class TestLRUOrdering(TestCase):
-    """Test 2: LRU order updates on get()."""
+class TestTagIndex(TestCase):
+    """Tag and prefix invalidation stay consistent with every removal path."""
     
     def setUp(self):
         self.clock = MockClock(1000.0)
         self.path = tempfile.mktemp(suffix='.json')
-        self.cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=3,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
     
     def tearDown(self):
         try:
@@ -501,58 +6082,189 @@ class TestLRUOrdering(TestCase):
         except OSError:
             pass
     
-    def test_get_moves_to_mru(self):
-        """get() should move entry to MRU position."""
-        self.cache.set("a", 1)
-        self.cache.set("b", 2)
-        self.cache.set("c", 3)
-        # Order: a(LRU), b, c(MRU)
-        
-        # Access 'a' - should move to MRU
-        self.cache.get("a")
-        # Order: b(LRU), c, a(MRU)
+    def _cache(self, max_size: int = 100, **kwargs) -> PersistentLRUTTLCache:
+        kwargs.setdefault("tag_index", TagIndex())
+        return PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock, **kwargs
+        )
+    
+    def test_sorted_keys_against_sorted_list(self):
+        import random
+        rng = random.Random(5)
+        _SortedKeys.LOAD, load = 4, _SortedKeys.LOAD  # Force many splits
+        try:
+            index = _SortedKeys()
+            ref: set[str] = set()
+            for _ in range(3000):
+                key = f"k{rng.randrange(300):03d}"
+                if key in ref and rng.random() < 0.5:
+                    index.discard(key)
+                    ref.discard(key)
+                elif key not in ref:
+                    index.add(key)
+                    ref.add(key)
+                self.assertEqual(len(index), len(ref))
+            self.assertEqual(list(index.iter_from("")), sorted(ref))
+            self.assertEqual(
+                list(index.iter_from("k150")), [k for k in sorted(ref) if k >= "k150"]
+            )
+        finally:
+            _SortedKeys.LOAD = load
+    
+    def test_invalidate_tag(self):
+        cache = self._cache()
+        cache.set("a", 1, tags=["user:1"])
+        cache.set("b", 2, tags=["user:1", "team:9"])
+        cache.set("c", 3, tags=["user:2"])
         
-        # Add 'd' - should evict 'b' (new LRU)
-        self.cache.set("d", 4)
+        self.assertEqual(cache.invalidate_tag("user:1"), 2)
+        self.assertEqual(cache._debug_state()["entries"], [("c", 3, None)])
+        self.assertEqual(cache.invalidate_tag("team:9"), 0)
+        self.assertEqual(cache.invalidate_tag("missing"), 0)
+    
+    def test_invalidate_prefix(self):
+        cache = self._cache()
+        for key in ["user:1:profile", "user:1:cart", "user:10:cart", "user:2", 7]:
+            cache.set(key, key)
         
-        self.assertIsNone(self.cache.get("b"))  # Evicted
-        self.assertEqual(self.cache.get("c"), 3)
-        self.assertEqual(self.cache.get("a"), 1)
-        self.assertEqual(self.cache.get("d"), 4)
+        self.assertEqual(cache.invalidate_prefix("user:1:"), 2)
+        self.assertEqual(
+            sorted(map(str, cache._cache)), ["7", "user:10:cart", "user:2"]
+        )
+        self.assertEqual(cache.invalidate_prefix("user:"), 2)
+        self.assertEqual(list(cache._cache), [7])
     
-    def test_set_moves_existing_to_mru(self):
-        """set() on existing key should move to MRU."""
-        self.cache.set("a", 1)
-        self.cache.set("b", 2)
-        self.cache.set("c", 3)
-        # Order: a(LRU), b, c(MRU)
+    def test_overwrite_replaces_tags(self):
+        cache = self._cache()
+        cache.set("a", 1, tags=["x"])
+        cache.set("a", 2, tags=["y"])
+        self.assertEqual(cache.invalidate_tag("x"), 0)
+        self.assertEqual(cache.invalidate_tag("y"), 1)
+    
+    def test_consistent_with_eviction_and_expiry(self):
+        cache = self._cache(max_size=2)
+        cache.set("a", 1, tags=["t"])
+        cache.set("b", 2, ttl_seconds=5, tags=["t"])
+        cache.set("c", 3, tags=["t"])  # Evicts "a"
+        self.clock.advance(10)
+        self.assertIsNone(cache.get("b"))  # Expired on read
+        cache.delete("c")
         
-        # Update 'a' - should move to MRU
-        self.cache.set("a", 100)
-        # Order: b(LRU), c, a(MRU)
+        index = cache._index
+        self.assertEqual(index.keys_with_tag("t"), [])
+        self.assertEqual(index.keys_with_prefix(""), [])
+        self.assertEqual(index.snapshot(), {"tags": 0, "tagged_keys": 0, "prefix_keys": 0})
         
-        # Add 'd' - should evict 'b'
-        self.cache.set("d", 4)
+        cache.set("d", 4, tags=["t"])
+        cache.clear()
+        self.assertEqual(index.keys_with_tag("t"), [])
+    
+    def test_tags_persisted(self):
+        cache = self._cache()
+        cache.set("a", 1, tags=["x"])
+        cache.set("b", 2)
+        cache.flush()
         
-        self.assertIsNone(self.cache.get("b"))
-        self.assertEqual(self.cache.get("a"), 100)
+        loaded = self._cache()
+        self.assertEqual(loaded.invalidate_tag("x"), 1)
+        self.assertEqual(loaded.invalidate_prefix("b"), 1)
     
-    def test_failed_get_does_not_affect_lru(self):
-        """get() on missing/expired key should not affect LRU order."""
-        self.cache.set("a", 1)
-        self.cache.set("b", 2)
-        self.cache.set("c", 3)
+    def test_invalid_usage(self):
+        plain = PersistentLRUTTLCache(max_size=10, persist_path=self.path)
+        with self.assertRaises(ValueError):
+            plain.set("a", 1, tags=["x"])
+        with self.assertRaises(RuntimeError):
+            plain.invalidate_tag("x")
         
-        # Access missing key
-        self.cache.get("nonexistent")
+        cache = self._cache(tag_index=TagIndex(prefixes=False))
+        with self.assertRaises(ValueError):
+            cache.set("a", 1, tags=[1])
+        self.assertNotIn("a", cache)
+        with self.assertRaises(RuntimeError):
+            cache.invalidate_prefix("a")
+    
+    def test_cost_proportional_to_matches(self):
+        """Invalidation should not scan unrelated entries."""
+        cache = self._cache(max_size=20_000)
+        for i in range(20_000):
+            cache._cache[f"other:{i}"] = (i, None)  # Bypass set() for speed
+            cache._index.add(f"other:{i}")
+        cache.set("target:1", 1, tags=["t"])
         
-        # Add 'd' - should still evict 'a' (original LRU)
-        self.cache.set("d", 4)
-        self.assertIsNone(self.cache.get("a"))
+        class CountingDict(OrderedDict):
+            items_calls = 0
+            
+            def items(self):
+                CountingDict.items_calls += 1
+                return super().items()
+        
+        cache._cache = CountingDict(cache._cache)
+        self.assertEqual(cache.invalidate_tag("t"), 1)
+        self.assertEqual(cache.invalidate_prefix("other:1999"), 11)
+        self.assertEqual(CountingDict.items_calls, 0)
 
 
-class TestEvictionCorrectness(TestCase):
-    """Test 3: Eviction correctness under max_size."""
+class TestHeavyHitters(TestCase):
+    """Space-Saving bounds hold and the cache feeds the tracker."""
+    
+    def test_exact_below_capacity(self):
+        clock = MockClock(0.0)
+        hh = HeavyHitters(4, now_fn=clock)
+        for key in "aaabbc":
+            hh.record(key)
+        clock.advance(2)
+        top = hh.top(2)
+        self.assertEqual([t["key"] for t in top], ["a", "b"])
+        self.assertEqual(top[0]["count"], 3)
+        self.assertEqual(top[0]["error"], 0)
+        self.assertAlmostEqual(top[0]["rate"], 1.5)
+        self.assertAlmostEqual(top[0]["share"], 0.5)
+    
+    def test_guarantees_on_skewed_stream(self):
+        import random
+        rng = random.Random(11)
+        hh = HeavyHitters(32)
+        exact: dict[int, int] = {}
+        for _ in range(50_000):
+            # Zipf-like: a few hot keys over a long tail
+            key = int(1000 ** rng.random()) if rng.random() < 0.5 else rng.randrange(10**6)
+            hh.record(key)
+            exact[key] = exact.get(key, 0) + 1
+        self.assertEqual(len(hh), 32)
+        for key, count in exact.items():
+            if count > hh.total / 32:
+                self.assertGreaterEqual(hh.estimate(key), count)
+        for entry in hh.top(32):
+            true = exact[entry["key"]]
+            self.assertLessEqual(entry["count"] - entry["error"], true)
+            self.assertGreaterEqual(entry["count"], true)
+        hottest = max(exact, key=exact.get)
+        self.assertEqual(hh.top(1)[0]["key"], hottest)
+    
+    def test_cache_hooks(self):
+        path = tempfile.mktemp(suffix='.json')
+        try:
+            cache = PersistentLRUTTLCache(
+                max_size=10, persist_path=path, hot_keys=HeavyHitters(8)
+            )
+            cache.set("hot", 1)
+            for _ in range(5):
+                cache.get("hot")
+            cache.get("cold")
+            self.assertEqual(cache.hot_keys(1)[0]["key"], "hot")
+            self.assertEqual(cache.hot_keys(1)[0]["count"], 6)
+            plain = PersistentLRUTTLCache(max_size=10, persist_path=path)
+            with self.assertRaises(RuntimeError):
+                plain.hot_keys()
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+        with self.assertRaises(ValueError):
+            HeavyHitters(0)
+
+
+class TestNegativeCache(TestCase):
+    """Negatives are distinguishable, short-lived and separately bounded."""
     
     def setUp(self):
         self.clock = MockClock(1000.0)
@@ -564,67 +6276,86 @@ class TestEvictionCorrectness(TestCase):
         except OSError:
             pass
     
-    def test_evicts_lru_when_full(self):
-        """Should evict LRU entry when at capacity."""
-        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=2,
-            persist_path=self.path,
-            now_fn=self.clock
+    def _cache(self, max_size: int = 10, **kwargs) -> PersistentLRUTTLCache:
+        kwargs.setdefault("negative_cache", NegativeCache(max_size=5, ttl_seconds=10))
+        return PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock, **kwargs
         )
-        
-        cache.set("a", 1)
-        cache.set("b", 2)
-        cache.set("c", 3)  # Should evict 'a'
-        
-        self.assertIsNone(cache.get("a"))
-        self.assertEqual(cache.get("b"), 2)
-        self.assertEqual(cache.get("c"), 3)
-        self.assertEqual(len(cache), 2)
     
-    def test_multiple_evictions(self):
-        """Should handle multiple sequential evictions."""
-        cache: PersistentLRUTTLCache[int, str] = PersistentLRUTTLCache(
-            max_size=2,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
-        
-        for i in range(10):
-            cache.set(i, f"value_{i}")
-        
-        # Only last 2 should remain
-        self.assertEqual(len(cache), 2)
-        self.assertIsNone(cache.get(7))
-        self.assertEqual(cache.get(8), "value_8")
-        self.assertEqual(cache.get(9), "value_9")
+    def test_lookup_distinguishes_results(self):
+        cache = self._cache()
+        cache.set("none", None)
+        cache.set("v", 1)
+        cache.set_negative("gone")
+        self.assertIs(cache.lookup("unknown"), MISS)
+        self.assertIs(cache.lookup("gone"), NEGATIVE)
+        self.assertIsNone(cache.lookup("none"))
+        self.assertEqual(cache.lookup("v"), 1)
+        self.assertIsNone(cache.get("gone"))  # get() is unchanged
+        self.assertFalse(NEGATIVE or MISS)
     
-    def test_size_one_cache(self):
-        """Cache with max_size=1 should work correctly."""
-        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=1,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
-        
-        cache.set("a", "1")
-        self.assertEqual(cache.get("a"), "1")
-        
-        cache.set("b", "2")
-        self.assertIsNone(cache.get("a"))
-        self.assertEqual(cache.get("b"), "2")
+    def test_negative_ttl(self):
+        cache = self._cache()
+        cache.set_negative("a")
+        cache.set_negative("b", ttl_seconds=100)
+        self.clock.advance(10)
+        self.assertIs(cache.lookup("a"), MISS)
+        self.assertIs(cache.lookup("b"), NEGATIVE)
+        self.assertEqual(cache._negatives.expired, 1)
+        with self.assertRaises(ValueError):
+            cache.set_negative("c", ttl_seconds=0)
+    
+    def test_set_and_negative_replace_each_other(self):
+        cache = self._cache()
+        cache.set_negative("k")
+        cache.set("k", 2)
+        self.assertEqual(cache.lookup("k"), 2)
+        cache.set_negative("k")
+        self.assertIs(cache.lookup("k"), NEGATIVE)
+        self.assertNotIn("k", cache)
+        cache.delete("k")
+        self.assertIs(cache.lookup("k"), MISS)
+    
+    def test_flood_does_not_evict_positives(self):
+        cache = self._cache(max_size=3)
+        for i in range(3):
+            cache.set(i, i)
+        for i in range(1000):
+            cache.set_negative(f"missing{i}")
+        self.assertEqual([cache.get(i) for i in range(3)], [0, 1, 2])
+        negatives = cache._negatives
+        self.assertEqual(len(negatives), 5)
+        self.assertEqual(negatives.evictions, 995)
+        self.assertIs(cache.lookup("missing999"), NEGATIVE)
+        self.assertIs(cache.lookup("missing0"), MISS)
+    
+    def test_not_persisted_and_cleared(self):
+        cache = self._cache()
+        cache.set("k", 1)
+        cache.set_negative("gone")
+        cache.flush()
+        reloaded = self._cache()
+        self.assertIs(reloaded.lookup("gone"), MISS)
+        cache.clear()
+        self.assertEqual(len(cache._negatives), 0)
+    
+    def test_requires_negative_cache(self):
+        cache = self._cache(negative_cache=None)
+        with self.assertRaises(RuntimeError):
+            cache.set_negative("k")
+        self.assertIs(cache.lookup("k"), MISS)
+        with self.assertRaises(ValueError):
+            NegativeCache(max_size=0)
+        with self.assertRaises(ValueError):
+            NegativeCache(ttl_seconds=0)
 
 
-class TestExpiredPrunedBeforeEviction(TestCase):
-    """Test 4: Expired entries pruned before eviction."""
+class TestMutationJournal(TestCase):
+    """Caller-visible mutations are journaled in order; internal ones are not."""
     
     def setUp(self):
         self.clock = MockClock(1000.0)
         self.path = tempfile.mktemp(suffix='.json')
-        self.cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=3,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
     
     def tearDown(self):
         try:
@@ -632,49 +6363,74 @@ class TestExpiredPrunedBeforeEviction(TestCase):
         except OSError:
             pass
     
-    def test_expired_pruned_instead_of_valid_lru(self):
-        """Expired entries should be removed before evicting valid LRU."""
-        # Add entries with TTL
-        self.cache.set("expire1", 1, ttl_seconds=5.0)
-        self.cache.set("expire2", 2, ttl_seconds=5.0)
-        self.cache.set("permanent", 3)
-        # Order: expire1(LRU), expire2, permanent(MRU)
-        
-        # Let TTL entries expire
-        self.clock.advance(10.0)
-        
-        # Cache is "full" with 3 entries, but 2 are expired
-        self.assertEqual(len(self.cache._cache), 3)
-        
-        # Add new entry - should prune expired, NOT evict permanent
-        self.cache.set("new", 4)
+    def test_records_mutations(self):
+        journal = MutationJournal()
+        cache = PersistentLRUTTLCache(
+            max_size=2, persist_path=self.path, now_fn=self.clock,
+            journal=journal, tag_index=TagIndex()
+        )
+        start = journal.seq
+        cache.set("a", 1, ttl_seconds=10, tags=["t"])
+        cache.set("b", 2)
+        cache.set("c", 3)  # Evicts "a", journaled before the set
+        cache.delete("missing")  # Journaled: other caches may hold it
+        cache.delete("b")
+        cache.set("d", 4, tags=["t"])
+        cache.invalidate_tag("t")
+        cache.clear()
+        ops = [(op, key) for _, op, key, _, _ in journal.since(start)]
+        self.assertEqual(ops, [
+            ("set", "a"), ("set", "b"), ("evict", "a"), ("set", "c"), ("delete", "missing"),
+            ("delete", "b"), ("set", "d"), ("delete", "d"), ("clear", None),
+        ])
+        self.assertEqual(journal.since(start)[0][4], 1010.0)
         
-        self.assertEqual(self.cache.get("permanent"), 3)
-        self.assertEqual(self.cache.get("new"), 4)
-        self.assertIsNone(self.cache.get("expire1"))
-        self.assertIsNone(self.cache.get("expire2"))
+        cache.set("e", 5)
+        cache.flush()
+        before = journal.seq
+        cache.load()
+        self.assertEqual([e[1] for e in journal.since(before)], ["reset"])
     
-    def test_mixed_expired_and_eviction(self):
-        """When expired pruning isn't enough, also evict LRU."""
-        self.cache.set("a", 1, ttl_seconds=5.0)  # Will expire
-        self.cache.set("b", 2)  # Permanent, LRU among valid
-        self.cache.set("c", 3)  # Permanent, MRU among valid
-        
-        self.clock.advance(10.0)  # 'a' expires
-        
-        # Add two new entries
-        self.cache.set("d", 4)  # Prunes 'a', fits
-        self.cache.set("e", 5)  # Must evict 'b'
-        
-        self.assertIsNone(self.cache.get("a"))
-        self.assertIsNone(self.cache.get("b"))
-        self.assertEqual(self.cache.get("c"), 3)
-        self.assertEqual(self.cache.get("d"), 4)
-        self.assertEqual(self.cache.get("e"), 5)
+    def test_load_journals_reset_on_every_path(self):
+        journal = MutationJournal()
+        cache = PersistentLRUTTLCache(
+            max_size=10, persist_path=self.path, now_fn=self.clock, journal=journal
+        )
+        cases = {
+            "missing file": None,
+            "binary without PickleCodec": _BINARY_MAGIC + b"\0" * 8,
+            "not a dict": b"[1, 2]",
+            "no entries list": b'{"version": 3, "entries": 5}',
+            "corrupt": b"{not json",
+        }
+        for name, content in cases.items():
+            with self.subTest(name):
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                if content is not None:
+                    with open(self.path, 'wb') as f:
+                        f.write(content)
+                cache.set("k", 1)
+                before = journal.seq
+                cache.load()
+                self.assertEqual(len(cache), 0)
+                self.assertEqual([e[1] for e in journal.since(before)], ["reset"])
+    
+    def test_bounded(self):
+        journal = MutationJournal(capacity=3)
+        for i in range(5):
+            journal.append("delete", i)
+        self.assertEqual(len(journal), 3)
+        self.assertEqual(journal.first_seq, 3)
+        self.assertEqual([e[0] for e in journal.since(2)], [3, 4, 5])
+        self.assertIsNone(journal.since(1))  # Seq 2 was dropped
+        self.assertEqual(journal.since(5), [])
+        with self.assertRaises(ValueError):
+            MutationJournal(capacity=0)
 
 
-class TestPersistenceRoundTrip(TestCase):
-    """Test 5: Persistence round-trip preserves order + TTL semantics."""
+class TestNamespaces(TestCase):
+    """Namespaces share one budget and one snapshot file."""
     
     def setUp(self):
         self.clock = MockClock(1000.0)
@@ -686,148 +6442,333 @@ class TestPersistenceRoundTrip(TestCase):
         except OSError:
             pass
     
-    def test_basic_round_trip(self):
-        """Basic save and load preserves data."""
-        cache1: PersistentLRUTTLCache[str, dict] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
-        
-        cache1.set("str", "value")
-        cache1.set("int", 42)
-        cache1.set("dict", {"nested": [1, 2, 3]})
-        cache1.flush()
-        
-        # Load into new cache
-        cache2: PersistentLRUTTLCache[str, dict] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+    def _ns(self, max_size: int = 10, **kwargs) -> NamespacedCache:
+        return NamespacedCache(max_size, self.path, now_fn=self.clock, **kwargs)
+    
+    def test_shared_budget_and_isolation(self):
+        nc = self._ns(10)
+        a, b = nc.namespace("a"), nc.namespace("b")
+        self.assertIs(nc.namespace("a"), a)
+        a.set("k", 1)
+        b.set("k", 2)
+        self.assertEqual((a.get("k"), b.get("k")), (1, 2))
+        for i in range(20):
+            a.set(f"a{i}", i)
+            b.set(f"b{i}", i)
+        self.assertEqual(nc.entry_count(), 10)
+        self.assertEqual((len(a), len(b)), (5, 5))  # Equal weights share evenly
+        self.assertEqual(a.get("a19"), 19)  # LRU within the namespace
+        self.assertIsNone(a.get("a0"))
+    
+    def test_min_and_max_quotas(self):
+        nc = self._ns(10)
+        small = nc.namespace("small", min_size=3)
+        capped = nc.namespace("capped", max_size=4)
+        big = nc.namespace("big")
+        for i in range(3):
+            small.set(i, i)
+        for i in range(20):
+            capped.set(i, i)
+            big.set(i, i)
+        self.assertEqual(len(capped), 4)
+        self.assertEqual(len(small), 3)  # Never squeezed below its minimum
+        self.assertEqual(nc.entry_count(), 10)
+        with self.assertRaises(ValueError):
+            nc.namespace("greedy", min_size=8)
+        with self.assertRaises(ValueError):
+            nc.namespace("bad", min_size=5, max_size=2)
+        with self.assertRaises(ValueError):
+            nc.namespace("zero", weight=0)
+    
+    def test_weighted_eviction_prefers_expired(self):
+        nc = self._ns(9)
+        heavy = nc.namespace("heavy", weight=2.0)
+        light = nc.namespace("light")
+        for i in range(30):
+            heavy.set(i, i)
+            light.set(i, i)
+        self.assertEqual((len(heavy), len(light)), (6, 3))
         
-        self.assertEqual(cache2.get("str"), "value")
-        self.assertEqual(cache2.get("int"), 42)
-        self.assertEqual(cache2.get("dict"), {"nested": [1, 2, 3]})
+        nc2 = NamespacedCache(4, self.path + ".2", now_fn=self.clock)
+        x, y = nc2.namespace("x"), nc2.namespace("y")
+        x.set("live", 1)
+        y.set("old1", 1, ttl_seconds=1)
+        y.set("old2", 1, ttl_seconds=1)
+        x.set("live2", 1)
+        self.clock.advance(2)
+        x.set("live3", 1)
+        x.set("live4", 1)
+        self.assertEqual(len(x), 4)  # Expired entries went first
+        self.assertEqual(len(y), 0)
     
-    def test_lru_order_preserved(self):
-        """LRU order should be preserved across persistence."""
-        cache1: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=3,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+    def test_clear_is_constant_time_and_reclaimed(self):
+        nc = self._ns(1000, reclaim_batch=100)
+        a, b = nc.namespace("a"), nc.namespace("b")
+        for i in range(500):
+            a.set(i, i)
+        old = a.cache._cache
+        a.clear()
+        self.assertEqual(len(a), 0)
+        self.assertIsNone(a.get(1))
+        self.assertEqual(len(old), 500)  # Nothing released yet
+        self.assertEqual(nc.snapshot()["retired_entries"], 500)
+        b.set("x", 1)
+        self.assertEqual(len(old), 400)
+        for i in range(4):
+            b.set(i, i)
+        self.assertEqual(nc.snapshot()["retired_entries"], 0)
+        with self.assertRaises(KeyError):
+            nc.clear_namespace("missing")
+    
+    def test_combined_snapshot_round_trip(self):
+        nc = self._ns(10)
+        a, b = nc.namespace("a", min_size=2), nc.namespace("b")
+        a.set("k", {"v": 1})
+        b.set("k", [1, 2], ttl_seconds=100)
+        nc.namespace("empty")
+        nc.flush()
         
-        cache1.set("a", 1)
-        cache1.set("b", 2)
-        cache1.set("c", 3)
-        cache1.get("a")  # Move 'a' to MRU
-        # Order: b(LRU), c, a(MRU)
-        cache1.flush()
+        with open(self.path) as f:
+            data = json.load(f)
+        self.assertEqual(set(data["namespaces"]), {"a", "b", "empty"})
+        self.assertEqual(data["namespaces"]["a"]["min_size"], 2)
         
-        # Load and verify order by adding new entry
-        cache2: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=3,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+        reloaded = self._ns(10)
+        self.assertEqual(reloaded.namespace("a").get("k"), {"v": 1})
+        self.assertEqual(reloaded.namespace("b").get("k"), [1, 2])
+        self.clock.advance(101)
+        reloaded.load()
+        self.assertIsNone(reloaded["b"].get("k"))
+        self.assertEqual(reloaded["a"].get("k"), {"v": 1})
+    
+    def test_namespace_cache_cannot_overwrite_snapshot(self):
+        nc = self._ns(10)
+        a = nc.namespace("a")
+        a.set("k", 1)
+        nc.flush()
+        with self.assertRaises(RuntimeError):
+            a.cache.flush()
+        with self.assertRaises(RuntimeError):
+            a.cache.load()
+        self.assertEqual(self._ns(10).namespace("a").get("k"), 1)
+    
+    def test_load_trims_to_smaller_budget(self):
+        nc = self._ns(20)
+        a, b = nc.namespace("a"), nc.namespace("b")
+        for i in range(10):
+            a.set(i, i)
+            b.set(i, i)
+        nc.flush()
         
-        cache2.set("d", 4)  # Should evict 'b'
+        smaller = self._ns(8)
+        smaller.namespace("a")
+        smaller.namespace("b")
+        self.assertEqual(smaller.entry_count(), 8)
+        self.assertEqual(smaller["b"].get(9), 9)  # MRU entries survive
+    
+    def test_corrupt_snapshot_starts_empty(self):
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        nc = self._ns(5)
+        self.assertEqual(len(nc.namespace("a")), 0)
+
+
+class TestSqliteBackend(TestCase):
+    """flush() writes only the delta; load() restores MRU entries in LRU order."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+        self.backends = []
+    
+    def tearDown(self):
+        import shutil
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+    
+    def make(self, max_size=10, **kwargs):
+        backend = SqliteBackend(**kwargs)
+        self.backends.append(backend)
+        return PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock,
+            backend=backend
+        ), backend
+    
+    def rows(self, backend):
+        return backend._conn.execute(
+            "SELECT key, seq FROM entries ORDER BY seq"
+        ).fetchall()
+    
+    def test_round_trip(self):
+        cache, _ = self.make()
+        cache.set("a", {"x": [1, 2]})
+        cache.set("b", "two", ttl_seconds=60)
+        cache.set("c", 3)
+        cache.get("a")  # a becomes MRU
+        cache.flush()
         
-        self.assertIsNone(cache2.get("b"))
-        self.assertEqual(cache2.get("c"), 3)
-        self.assertEqual(cache2.get("a"), 1)
-        self.assertEqual(cache2.get("d"), 4)
+        restored, _ = self.make()
+        self.assertEqual(list(restored._cache), ["b", "c", "a"])
+        self.assertEqual(restored.get("a"), {"x": [1, 2]})
+        self.assertEqual(restored._cache["b"][1], 1060.0)
     
-    def test_ttl_preserved_and_enforced(self):
-        """TTL should be preserved and enforced after reload."""
-        cache1: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+    def test_incremental(self):
+        cache, backend = self.make(batch_size=2)
+        for i in range(5):
+            cache.set(f"k{i}", i)
+        cache.flush()
+        self.assertEqual(backend.rows_written, 5)
+        self.assertEqual(backend.transactions, 3 + 1)  # 3 upsert batches + expiry
         
-        cache1.set("short", "expires", ttl_seconds=10.0)
-        cache1.set("long", "lasts", ttl_seconds=100.0)
-        cache1.flush()
+        cache.get("k0")  # Seq only
+        cache.set("k1", 10)  # Upsert
+        cache.delete("k2")
+        self.assertEqual(backend.pending, 3)
+        cache.flush()
+        self.assertEqual(backend.rows_written, 7)
+        self.assertEqual(backend.rows_deleted, 1)
+        self.assertEqual([k for k, _ in self.rows(backend)],
+                         ['"k3"', '"k4"', '"k0"', '"k1"'])
         
-        # Advance time and reload
-        self.clock.advance(50.0)
+        cache.flush()  # Nothing changed
+        self.assertEqual(backend.rows_written, 7)
+    
+    def test_eviction_expiry_and_clear(self):
+        cache, backend = self.make(max_size=2)
+        cache.set("a", 1, ttl_seconds=5)
+        cache.set("b", 2)
+        cache.set("c", 3)  # Evicts a
+        cache.flush()
+        self.assertEqual(len(self.rows(backend)), 2)
         
-        cache2: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+        cache.set("d", 4, ttl_seconds=5)  # Evicts b
+        cache.flush()
+        self.clock.advance(10)
+        cache.flush()  # d expired in the table
+        self.assertEqual([k for k, _ in self.rows(backend)], ['"c"'])
         
-        # 'short' should be discarded on load (expired)
-        self.assertIsNone(cache2.get("short"))
-        # 'long' should still exist
-        self.assertEqual(cache2.get("long"), "lasts")
+        cache.clear()
+        cache.flush()
+        self.assertEqual(self.rows(backend), [])
     
-    def test_expired_discarded_on_load(self):
-        """Expired entries should not be loaded."""
-        cache1: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+    def test_load_limits_to_max_size(self):
+        cache, _ = self.make(max_size=10)
+        for i in range(10):
+            cache.set(i, i)
+        cache.flush()
         
-        cache1.set("expire1", 1, ttl_seconds=5.0)
-        cache1.set("expire2", 2, ttl_seconds=5.0)
-        cache1.set("permanent", 3)
-        cache1.flush()
+        small, backend = self.make(max_size=3)
+        self.assertEqual(list(small._cache), [7, 8, 9])
+        small.flush()  # Rows that did not fit are dropped
+        self.assertEqual([k for k, _ in self.rows(backend)], ['7', '8', '9'])
+    
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            SqliteBackend(batch_size=0)
+        with self.assertRaises(ValueError):
+            SqliteBackend(synchronous="sometimes")
+
+
+class TestShardedSnapshot(TestCase):
+    """Shards concatenate back into the global LRU order."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.json')
+        self.sharded = ShardedSnapshot(4, workers=2, min_shard_entries=3)
+    
+    def tearDown(self):
+        import shutil
+        self.sharded.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+    
+    def make(self, max_size=100, sharded=None, **kwargs):
+        return PersistentLRUTTLCache(
+            max_size=max_size, persist_path=self.path, now_fn=self.clock,
+            sharded=sharded or self.sharded, **kwargs
+        )
+    
+    def shard_files(self):
+        return sorted(n for n in os.listdir(self.tmpdir) if '.shard-' in n)
+    
+    def test_round_trip_in_lru_order(self):
+        cache = self.make(tag_index=TagIndex())
+        for i in range(20):
+            cache.set(f"k{i}", {"n": i}, ttl_seconds=100 if i % 2 else None,
+                      tags=["odd"] if i % 2 else None)
+        cache.get("k0")
+        cache.flush()
         
-        self.clock.advance(10.0)
+        with open(self.path) as f:
+            manifest = json.load(f)
+        self.assertEqual([s["entries"] for s in manifest["shards"]], [5, 5, 5, 5])
+        self.assertEqual(len(self.shard_files()), 4)
         
-        cache2: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+        restored = self.make(tag_index=TagIndex())
+        self.assertEqual(list(restored._cache), [f"k{i}" for i in range(1, 20)] + ["k0"])
+        self.assertEqual(restored.get("k7"), {"n": 7})
+        self.assertEqual(restored.invalidate_tag("odd"), 10)
         
-        # Should only have permanent entry
-        self.assertEqual(len(cache2), 1)
-        self.assertEqual(cache2.get("permanent"), 3)
+        # Readable without a ShardedSnapshot too
+        serial = PersistentLRUTTLCache(max_size=100, persist_path=self.path,
+                                       now_fn=self.clock)
+        self.assertEqual(len(serial._cache), 20)
     
-    def test_missing_file_starts_empty(self):
-        """Missing persistence file should start empty cache."""
-        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path="/nonexistent/path/cache.json",
-            now_fn=self.clock
-        )
+    def test_load_reads_only_mru_shards(self):
+        cache = self.make()
+        for i in range(20):
+            cache.set(i, i)
+        cache.flush()
+        os.unlink(os.path.join(self.tmpdir, self.shard_files()[0]))  # LRU shard
         
-        self.assertEqual(len(cache), 0)
-        cache.set("key", "value")
-        self.assertEqual(cache.get("key"), "value")
+        restored = self.make(max_size=8)
+        self.assertEqual(list(restored._cache), list(range(12, 20)))
     
-    def test_corrupted_file_starts_empty(self):
-        """Corrupted persistence file should start empty cache."""
-        # Write garbage to file
-        with open(self.path, 'w') as f:
-            f.write("not valid json {{{")
-        
-        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+    def test_old_generation_removed(self):
+        cache = self.make()
+        for i in range(20):
+            cache.set(i, i)
+        cache.flush()
+        first = self.shard_files()
+        cache.delete(0)
+        cache.flush()
+        second = self.shard_files()
+        self.assertEqual(len(second), 4)
+        self.assertFalse(set(first) & set(second))
         
-        self.assertEqual(len(cache), 0)
+        small = self.make(sharded=ShardedSnapshot(4, workers=1))
+        small.clear()
+        small.set("only", 1)
+        small.flush()  # One entry: a single shard
+        self.assertEqual(len(self.shard_files()), 1)
+        self.assertEqual(list(self.make()._cache), ["only"])
+    
+    def test_missing_shard_starts_fresh(self):
+        cache = self.make()
+        for i in range(20):
+            cache.set(i, i)
+        cache.flush()
+        os.unlink(os.path.join(self.tmpdir, self.shard_files()[-1]))
+        self.assertEqual(len(self.make()._cache), 0)
+    
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            ShardedSnapshot(0)
+        with self.assertRaises(ValueError):
+            ShardedSnapshot(workers=0)
+        with self.assertRaises(ValueError):
+            self.make(codec=PickleCodec())
 
 
-class TestSerializationValidation(TestCase):
-    """Test serialization error handling."""
+class TestScan(TestCase):
+    """items()/keys()/scan() skip expired entries and survive mutation."""
     
     def setUp(self):
         self.clock = MockClock(1000.0)
         self.path = tempfile.mktemp(suffix='.json')
-        self.cache: PersistentLRUTTLCache = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
     
     def tearDown(self):
         try:
@@ -835,36 +6776,201 @@ class TestSerializationValidation(TestCase):
         except OSError:
             pass
     
-    def test_non_serializable_value_raises(self):
-        """Non-JSON-serializable value should raise SerializationError."""
-        with self.assertRaises(SerializationError) as ctx:
-            self.cache.set("key", lambda x: x)
+    def make(self, storage, **kwargs):
+        cache = PersistentLRUTTLCache(
+            max_size=1000, persist_path=self.path, now_fn=self.clock,
+            storage=storage, **kwargs
+        )
+        for i in range(10):
+            cache.set(f"k{i}", i, ttl_seconds=5 if i in (3, 4) else None)
+        return cache
+    
+    def scan_all(self, cache, count, **kwargs):
+        cursor, found, calls = 0, [], 0
+        while True:
+            cursor, keys = cache.scan(cursor, count, **kwargs)
+            found.extend(keys)
+            calls += 1
+            if not cursor:
+                return found, calls
+    
+    def test_items_and_keys(self):
+        for storage in STORAGE_ENGINES:
+            with self.subTest(storage=storage):
+                cache = self.make(storage, compressor=ValueCompressor(threshold=1))
+                cache.get("k0")
+                self.clock.advance(10)
+                keys = list(cache.keys())
+                self.assertEqual(sorted(keys), [f"k{i}" for i in (0, 1, 2, 5, 6, 7, 8, 9)])
+                if storage == "ordered":
+                    self.assertEqual(keys[-1], "k0")
+                self.assertEqual(dict(cache.items())["k7"], 7)
+                self.assertEqual(len(cache._cache), 10)  # Read-only: nothing pruned
+    
+    def test_mutation_while_iterating(self):
+        for storage in STORAGE_ENGINES:
+            with self.subTest(storage=storage):
+                cache = self.make(storage)
+                seen = []
+                for key in cache.keys():
+                    seen.append(key)
+                    cache.get("k0")  # Reorders
+                    cache.delete("k9")
+                    cache.set(f"new-{key}", 0)
+                self.assertNotIn("k9", seen)
+                self.assertEqual(len([k for k in seen if k.startswith("k")]), 9)
+    
+    def test_scan_pages(self):
+        for storage in STORAGE_ENGINES:
+            with self.subTest(storage=storage):
+                cache = self.make(storage)
+                found, calls = self.scan_all(cache, 3)
+                self.assertEqual(sorted(found), sorted(f"k{i}" for i in range(10)))
+                self.assertGreaterEqual(calls, 4)
+                
+                cache.set(7, "int key")
+                found, _ = self.scan_all(cache, 100, match="k[0-2]")
+                self.assertEqual(sorted(found), ["k0", "k1", "k2"])
+    
+    def test_scan_survives_mutation(self):
+        for storage in STORAGE_ENGINES:
+            with self.subTest(storage=storage):
+                cache = self.make(storage)
+                cursor, found = cache.scan(0, 4)
+                for i in range(10):
+                    cache.get(f"k{i}")  # Reorder everything
+                cache.delete("k8")
+                cache.set("added", 1)
+                while cursor:
+                    cursor, keys = cache.scan(cursor, 4)
+                    found.extend(keys)
+                kept = [f"k{i}" for i in range(10) if i != 8]
+                self.assertEqual(sorted(k for k in found if k in kept), kept)
+                self.assertNotIn("k8", found[4:])
+    
+    def test_ordered_snapshot_is_released(self):
+        cache = self.make("ordered")
+        cursor, _ = cache.scan(0, 4)
+        self.assertEqual(len(cache._scans), 1)
+        while cursor:
+            cursor, _ = cache.scan(cursor, 4)
+        self.assertEqual(len(cache._scans), 0)
+    
+    def test_scan_errors(self):
+        cache = self.make("ordered")
+        with self.assertRaises(ValueError):
+            cache.scan(0, 0)
+        with self.assertRaises(ValueError):
+            cache.scan(12345 << 40 | 1, 10)
+        cursors = [cache.scan(0, 1)[0] for _ in range(cache.MAX_SCANS + 1)]
+        with self.assertRaises(ValueError):
+            cache.scan(cursors[0], 1)  # Oldest open scan dropped
+        cache.scan(cursors[-1], 1)
+
+
+class TestPrefetch(TestCase):
+    """AccessRecorder ranks recent frequent keys; Prefetcher loads them."""
+    
+    def setUp(self):
+        self.clock = MockClock(1000.0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'access.json')
+        self.path = os.path.join(self.tmpdir, 'cache.json')
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+    
+    def recorder(self, **kwargs):
+        return AccessRecorder(self.log, sample_rate=1.0, half_life=100.0,
+                              now_fn=self.clock, **kwargs)
+    
+    def test_ranking_decays(self):
+        rec = self.recorder()
+        for _ in range(8):
+            rec.record("old")
+        self.clock.advance(300)  # old decays to 1
+        for _ in range(3):
+            rec.record("new")
+        rec.record("once")
+        self.assertEqual(rec.hottest(), ["new", "old", "once"])
+        self.assertEqual(rec.hottest(1), ["new"])
+    
+    def test_sampling_and_capacity(self):
+        import random
+        rng = random.Random(3)
+        rec = AccessRecorder(self.log, sample_rate=0.1, capacity=5,
+                             now_fn=self.clock, rng=rng.random)
+        for i in range(1000):
+            rec.record(i % 20 if i % 2 else "hot")
+        self.assertTrue(60 <= rec.sampled <= 140)
+        self.assertLess(len(rec), 10)
+        self.assertEqual(rec.hottest(1), ["hot"])
+        with self.assertRaises(ValueError):
+            AccessRecorder(self.log, sample_rate=0)
+    
+    def test_saved_by_flush_and_reloaded(self):
+        rec = self.recorder(capacity=2)
+        cache = PersistentLRUTTLCache(max_size=10, persist_path=self.path,
+                                      now_fn=self.clock, recorder=rec)
+        for key in ["a", "b", "b", "c", "c", "c"]:
+            cache.get(key)
+        cache.flush()
         
-        self.assertIn("value", str(ctx.exception))
-        self.assertIn("not JSON-serializable", str(ctx.exception))
+        self.clock.advance(100)
+        reloaded = self.recorder(capacity=2)
+        self.assertEqual(reloaded.hottest(), ["c", "b"])
+        reloaded.record("b")  # b: 1 + 1 = 2 now beats c: 3 halved = 1.5
+        self.assertEqual(reloaded.hottest(), ["b", "c"])
+        
+        with open(self.log, 'w') as f:
+            f.write("{not json")
+        self.assertEqual(len(self.recorder()), 0)
     
-    def test_non_serializable_key_raises(self):
-        """Non-JSON-serializable key should raise SerializationError."""
-        with self.assertRaises(SerializationError) as ctx:
-            self.cache.set(object(), "value")
+    def test_prefetch(self):
+        cache = PersistentLRUTTLCache(max_size=100, persist_path=self.path,
+                                      now_fn=self.clock)
+        cache.set("present", "kept")
         
-        self.assertIn("key", str(ctx.exception))
+        def loader(key):
+            if key == "boom":
+                raise KeyError(key)
+            if key == "set":
+                return {1, 2}  # Not JSON-serializable: rejected by set()
+            return None if key == "absent" else f"value-{key}"
+        
+        keys = ["present", "absent", "boom", "set"] + [f"k{i}" for i in range(20)]
+        result = Prefetcher(loader, workers=3, ttl_seconds=60).run(cache, keys)
+        self.assertEqual(
+            {k: result[k] for k in ("loaded", "cached", "missing", "errors", "rejected", "skipped")},
+            {"loaded": 20, "cached": 1, "missing": 1, "errors": 1, "rejected": 1, "skipped": 0}
+        )
+        self.assertNotIn("set", cache)
+        self.assertEqual(cache.get("k7"), "value-k7")
+        self.assertEqual(cache.get("present"), "kept")
+        self.assertEqual(cache._cache["k7"][1], 1060.0)
     
-    def test_mutation_not_applied_on_error(self):
-        """Cache should not be modified if serialization fails."""
-        self.cache.set("existing", "value")
+    def test_rate_and_timeout(self):
+        cache = PersistentLRUTTLCache(max_size=100, persist_path=self.path,
+                                      now_fn=self.clock)
+        result = Prefetcher(str, rate=200).run(cache, range(11))
+        self.assertEqual(result["loaded"], 11)
+        self.assertGreaterEqual(result["seconds"], 0.045)
         
-        try:
-            self.cache.set("existing", lambda x: x)  # Will fail
-        except SerializationError:
-            pass
+        result = Prefetcher(str, rate=100, timeout=0.05).run(cache, range(100, 200))
+        self.assertLess(result["loaded"], 20)
+        self.assertEqual(result["loaded"] + result["skipped"], 100)
         
-        # Original value should be preserved
-        self.assertEqual(self.cache.get("existing"), "value")
+        # A slow rate never sleeps past the deadline
+        result = Prefetcher(str, rate=0.5, timeout=0.1).run(cache, range(200, 203))
+        self.assertEqual((result["loaded"], result["skipped"]), (1, 2))
+        self.assertLess(result["seconds"], 1.0)
+        with self.assertRaises(ValueError):
+            Prefetcher(str, workers=0)
 
 
-class TestEdgeCases(TestCase):
-    """Additional edge case tests."""
+class TestVersions(TestCase):
+    """cas() only wins against the version it read; counters keep TTL."""
     
     def setUp(self):
         self.clock = MockClock(1000.0)
@@ -876,82 +6982,72 @@ class TestEdgeCases(TestCase):
         except OSError:
             pass
     
-    def test_invalid_max_size(self):
-        """max_size < 1 should raise ValueError."""
-        with self.assertRaises(ValueError):
-            PersistentLRUTTLCache(max_size=0, persist_path=self.path)
-        
-        with self.assertRaises(ValueError):
-            PersistentLRUTTLCache(max_size=-1, persist_path=self.path)
-    
-    def test_delete_returns_correct_bool(self):
-        """delete() should return True if key existed."""
-        cache: PersistentLRUTTLCache[str, str] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
-        
-        cache.set("key", "value")
-        self.assertTrue(cache.delete("key"))
-        self.assertFalse(cache.delete("key"))
-        self.assertFalse(cache.delete("never_existed"))
+    def make(self, **kwargs):
+        return PersistentLRUTTLCache(max_size=3, persist_path=self.path,
+                                     now_fn=self.clock, versioned=True, **kwargs)
     
-    def test_clear(self):
-        """clear() should remove all entries."""
-        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
-        
-        cache.set("a", 1)
-        cache.set("b", 2)
-        cache.set("c", 3)
+    def test_cas(self):
+        cache = self.make()
+        cache.set("a", [1])
+        value, version = cache.gets("a")
+        self.assertEqual(value, [1])
+        self.assertTrue(cache.cas("a", value + [2], version))
+        self.assertFalse(cache.cas("a", [0], version))  # Stale
         
-        cache.clear()
+        value, version = cache.gets("a")
+        self.assertEqual(value, [1, 2])
+        cache.set("a", [3])  # Concurrent writer
+        self.assertFalse(cache.cas("a", [9], version))
+        self.assertEqual(cache.get("a"), [3])
         
-        self.assertEqual(len(cache), 0)
-        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.gets("missing"))
+        self.assertFalse(cache.cas("missing", 1, version))
     
-    def test_contains_does_not_update_lru(self):
-        """'in' operator should not update LRU order."""
-        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=2,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
-        
+    def test_versions_never_reused(self):
+        cache = self.make()
+        cache.set("a", 1, ttl_seconds=5)
+        _, version = cache.gets("a")
+        self.clock.advance(10)
+        self.assertFalse(cache.cas("a", 2, version))  # Expired
+        cache.delete("a")
         cache.set("a", 1)
-        cache.set("b", 2)
-        # Order: a(LRU), b(MRU)
-        
-        # Check 'a' with 'in' - should NOT move to MRU
-        _ = "a" in cache
-        
-        # Add 'c' - should evict 'a' if 'in' didn't update LRU
-        cache.set("c", 3)
+        self.assertNotEqual(cache.gets("a")[1], version)
+        for key in "bcd":
+            cache.set(key, 0)  # Evicts a
+        self.assertEqual(set(cache._versions), set("bcd"))
+        cache.clear()
+        self.assertEqual(cache._versions, {})
         
-        self.assertIsNone(cache.get("a"))  # Evicted
-        self.assertEqual(cache.get("b"), 2)
+        cache.set("x", 1)
+        cache.flush()
+        self.assertIn("x", self.make()._versions)
+        with self.assertRaises(RuntimeError):
+            PersistentLRUTTLCache(max_size=3, persist_path=self.path).gets("x")
     
-    def test_len_excludes_expired(self):
-        """__len__ should only count non-expired entries."""
-        cache: PersistentLRUTTLCache[str, int] = PersistentLRUTTLCache(
-            max_size=10,
-            persist_path=self.path,
-            now_fn=self.clock
-        )
+    def test_incr_decr(self):
+        cache = self.make(tag_index=TagIndex())
+        self.assertIsNone(cache.incr("n"))
+        self.assertEqual(cache.incr("n", initial=10, ttl_seconds=60), 10)
+        cache.set("n", 10, ttl_seconds=60, tags=["counters"])
+        _, version = cache.gets("n")
+        self.clock.advance(20)
+        self.assertEqual(cache.incr("n", 5), 15)
+        self.assertEqual(cache.decr("n", 20), -5)
+        self.assertEqual(cache._cache["n"][1], 1060.0)
+        self.assertFalse(cache.cas("n", 0, version))
+        self.assertEqual(cache.invalidate_tag("counters"), 1)
         
-        cache.set("a", 1, ttl_seconds=5.0)
-        cache.set("b", 2, ttl_seconds=5.0)
-        cache.set("c", 3)  # Permanent
-        
-        self.assertEqual(len(cache), 3)
-        
-        self.clock.advance(10.0)
+        cache.set("s", "text")
+        with self.assertRaises(TypeError):
+            cache.incr("s")
         
-        self.assertEqual(len(cache), 1)
+        packed = PersistentLRUTTLCache(max_size=3, persist_path=self.path,
+                                       now_fn=self.clock, codec=PickleCodec())
+        packed.set("c", 1)
+        self.assertEqual(packed.incr("c"), 2)
+        packed.set("b", b"5")
+        self.assertEqual(packed.decr("b", 9), 0)  # memcached: stops at 0
+        self.assertEqual(packed.get("b"), b"0")
 
 
 def run_tests():
@@ -967,6 +7063,25 @@ def run_tests():
     suite.addTests(loader.loadTestsFromTestCase(TestPersistenceRoundTrip))
     suite.addTests(loader.loadTestsFromTestCase(TestSerializationValidation))
     suite.addTests(loader.loadTestsFromTestCase(TestEdgeCases))
+    suite.addTests(loader.loadTestsFromTestCase(TestCoarseClock))
+    suite.addTests(loader.loadTestsFromTestCase(TestCacheStats))
+    suite.addTests(loader.loadTestsFromTestCase(TestShardsMRC))
+    suite.addTests(loader.loadTestsFromTestCase(TestMemoryAutoSizer))
+    suite.addTests(loader.loadTestsFromTestCase(TestCompactStorage))
+    suite.addTests(loader.loadTestsFromTestCase(TestSlabArena))
+    suite.addTests(loader.loadTestsFromTestCase(TestCompression))
+    suite.addTests(loader.loadTestsFromTestCase(TestPickleCodec))
+    suite.addTests(loader.loadTestsFromTestCase(TestBlobStore))
+    suite.addTests(loader.loadTestsFromTestCase(TestTagIndex))
+    suite.addTests(loader.loadTestsFromTestCase(TestHeavyHitters))
+    suite.addTests(loader.loadTestsFromTestCase(TestNegativeCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestNamespaces))
+    suite.addTests(loader.loadTestsFromTestCase(TestMutationJournal))
+    suite.addTests(loader.loadTestsFromTestCase(TestSqliteBackend))
+    suite.addTests(loader.loadTestsFromTestCase(TestShardedSnapshot))
+    suite.addTests(loader.loadTestsFromTestCase(TestScan))
+    suite.addTests(loader.loadTestsFromTestCase(TestPrefetch))
+    suite.addTests(loader.loadTestsFromTestCase(TestVersions))
     
     runner = unittest.TextTestRunner(verbosity=2)
     result = runner.run(suite)
@@ -1027,6 +7142,42 @@ MANUAL TEST CHECKLIST
    □ Insert 100K entries - verify no memory leak
    □ Time get/set operations - should be O(1)
    □ Time flush with large cache - acceptable for file size
+   □ Compare get() throughput with and without a started CoarseClock
+   □ Compare get() throughput with stats=True and stats=False
+   □ Attach ShardsMRC to a production-like workload, compare its curve
+     with cache_sim.py results for the same trace
+   □ Run in a memory-limited container with a MemoryAutoSizer, push RSS
+     toward the limit, verify max_size shrinks gradually and recovers
+   □ Run cache_bench.py --impls v3 v3c --workloads memory and compare
+     bytes_per_entry for the two storage engines
+   □ Load a large file with arena=SlabArena(), freeze_gc=True and compare
+     gc.callbacks-measured collection pauses against the default cache
+   □ Store real JSON documents with compressor=ValueCompressor(...) at a few
+     levels; compare compressor.ratio and compress_seconds per algorithm
+   □ Cache 100MB bytes values with codec=PickleCodec(); check get() returns
+     memoryviews and flush() RSS stays flat (no per-value copies)
+   □ Store a 50MB value with a BlobStore; verify flush() time and snapshot
+     size no longer depend on it and the blob directory is cleaned up
+   □ With 1M entries and a TagIndex, time invalidate_tag() for a tag with
+     10 keys; it should not grow with cache size
+   □ Fill a NamespacedCache namespace with 1M entries, clear it and time
+     the next set() calls; each should release at most reclaim_batch
+   □ Flood set_negative() with 1M distinct keys; verify positive entries
+     and len(cache) are unaffected and the NegativeCache stays at max_size
+   □ Replay a Zipf trace through a cache with HeavyHitters(64); compare
+     hot_keys(10) with exact counts and check get() throughput cost
+   □ Start a replica (cache_replication.py) against a primary taking
+     writes, kill and restart it; verify it resumes without a snapshot
+   □ With a SqliteBackend and 1M entries, change 1% and time flush();
+     it should scale with the change, not the cache size
+   □ With a ShardedSnapshot and 1M entries, time flush() and load() at
+     workers=1, 4, 16; both should drop close to linearly
+   □ With storage="compact" and 10M entries, walk scan() to the end and
+     check peak RSS barely moves
+   □ Record a day of traffic with an AccessRecorder, restart, prefetch the
+     hottest 10k keys and compare the first-minute hit ratio with a cold start
+   □ Run 8 clients doing incr() and gets()/cas() retry loops against one
+     CacheServer; verify no update is lost
 """
 
 